@@ -6,7 +6,8 @@ import datetime
 import configparser
 import logging
 import argparse
-from lib import umm_on_fhir, umm_db_lib
+from lib import umm_on_fhir, umm_db_lib, checkpoint
+from lib import hapi_writer, hapi_bulk_writer, ndjson_writer, sqlite_writer, null_writer
 
 def is_valid_file(arg):
   if not os.path.exists(arg):
@@ -30,9 +31,11 @@ def main():
     parser.add_argument('-c', '--path_to_config', dest='path_to_config', help='path to config',
                         required=True, metavar="FILE", type=lambda x: is_valid_file(x))
     parser.add_argument('-d', '--dest', dest='dest_type', help='where to store the FHIR records',
-                        required=True, type=str, choices=['psql', 'hapi'])
+                        required=True, type=str, choices=['psql', 'hapi', 'hapi-bulk', 'ndjson', 'sqlite', 'null'])
     parser.add_argument('-n', '--no_lab', dest='lab', help='exclude lab data for mapping',
                         action='store_false')
+    parser.add_argument('-r', '--resume', dest='resume', help='resume aborted ETL job '
+                        'from checkpoint', action='store_true')
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
@@ -44,12 +47,52 @@ def main():
     db_con_fhir = db_con_fhir_raw.get_engine()
     db_con_dwh = db_con_dwh_raw.create_con()
     new_period = umm_on_fhir.UMMPeriod(args.start_date, args.end_date)
+    new_checkpoint = checkpoint.Checkpoint(logger,
+                                           config.get('checkpoint', 'path',
+                                                      fallback='checkpoint.json'),
+                                           new_period, args.resume)
     if args.dest_type == 'psql':
       new_dest = umm_on_fhir.UMMDestination('psql', db_con_fhir)
     else:
-      new_dest = umm_on_fhir.UMMDestination('hapi', config['server']['url_hapi_fhir'])
-
-    new_processor = umm_on_fhir.UMMonFHIR(config, logger)
+      if args.dest_type in ('hapi', 'hapi-bulk'):
+        new_hapi_writer = hapi_writer.HAPIWriter(
+          logger, config['server']['url_hapi_fhir'],
+          bundle_size=config.getint('hapi', 'bundle_size', fallback=500),
+          max_workers=config.getint('hapi', 'max_workers', fallback=4),
+          bundle_type=config.get('hapi', 'bundle_type', fallback='transaction'),
+          max_retries=config.getint('hapi', 'max_retries', fallback=3),
+          compress=config.getboolean('hapi', 'compress', fallback=False))
+      if args.dest_type in ('ndjson', 'hapi-bulk'):
+        ndjson_section = 'ndjson' if args.dest_type == 'ndjson' else 'hapi_bulk'
+        new_ndjson_writer = ndjson_writer.NDJSONWriter(
+          logger, config[ndjson_section]['outdir'],
+          compress=config.getboolean(ndjson_section, 'compress', fallback=False),
+          max_file_bytes=config.getint(ndjson_section, 'max_file_bytes', fallback=1000000000),
+          state=new_checkpoint.writer_state)
+
+      if args.dest_type == 'hapi':
+        new_dest = umm_on_fhir.UMMDestination('hapi', new_hapi_writer)
+      elif args.dest_type == 'ndjson':
+        new_dest = umm_on_fhir.UMMDestination('ndjson', new_ndjson_writer)
+      elif args.dest_type == 'sqlite':
+        new_sqlite_writer = sqlite_writer.SQLiteWriter(
+          logger, config['sqlite']['path'],
+          batch_size=config.getint('sqlite', 'batch_size', fallback=1000))
+        new_dest = umm_on_fhir.UMMDestination('sqlite', new_sqlite_writer)
+      elif args.dest_type == 'null':
+        new_dest = umm_on_fhir.UMMDestination('null', null_writer.NullWriter(logger))
+      else:
+        new_hapi_bulk_writer = hapi_bulk_writer.HAPIBulkWriter(
+          logger, new_ndjson_writer, new_hapi_writer, config['hapi_bulk']['base_url'],
+          serve_port=config.getint('hapi_bulk', 'serve_port', fallback=None),
+          poll_interval=config.getint('hapi_bulk', 'poll_interval', fallback=10),
+          timeout=config.getint('hapi_bulk', 'timeout', fallback=86400))
+        new_dest = umm_on_fhir.UMMDestination('hapi-bulk', new_hapi_bulk_writer)
+      # files written before a checkpoint are kept and appended to on resume
+      if args.dest_type in ('ndjson', 'hapi-bulk'):
+        new_checkpoint.attach_writer(new_dest.endpoint)
+
+    new_processor = umm_on_fhir.UMMonFHIR(config, logger, new_checkpoint)
     # process patient records
     res_stats = new_processor.process_patients(new_period, db_con_dwh, new_dest, True)
 
@@ -73,6 +116,11 @@ def main():
     if args.lab:
       res_stats = new_processor.process_lab_results(new_period, db_con_dwh, new_dest, True)
 
+    if args.dest_type in ('ndjson', 'hapi-bulk', 'sqlite', 'null'):
+      new_dest.endpoint.close()
+    new_processor.timer.report(logger)
+    new_checkpoint.remove()
+
     logger.info("ETL job was successfully completed")
 
 
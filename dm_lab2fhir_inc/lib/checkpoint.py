@@ -0,0 +1,120 @@
+#!/usr/bin/python3.6
+
+'''Record the progress of the ETL job (completed stages, number of
+   processed records of the current stage) after each flushed bundle so that
+   an aborted job can be resumed; the state of a file writer (see
+   NDJSONWriter.sync) is synced and stored along with it
+   Arguments: logger, path, period, resume
+   Returns: none
+   Date: 10-19-2026'''
+
+import os
+from . import json_codec
+
+class Checkpoint:
+  '''Record the progress of the ETL job after each flushed bundle; without
+     path nothing is persisted'''
+
+  def __init__(self, logger, path=None, period=None, resume=False):
+    self.logger = logger
+    self.path = path
+    self.writer = None
+    self.window = [str(period.start), str(period.end)] if period else None
+    self.state = {'window': self.window, 'completed': [], 'stage': None, 'rows': 0}
+    if resume and path and os.path.exists(path):
+      with open(path, 'rb') as file:
+        state = json_codec.loads(file.read())
+      if state['window'] == self.window:
+        self.state = state
+        self.logger.info(f"Resume ETL job from checkpoint (completed stages: "
+                         f"{', '.join(state['completed']) or 'none'}, stage "
+                         f"'{state['stage']}' at record {state['rows']})")
+      else:
+        self.logger.warning(f"Checkpoint {path} belongs to period {state['window']}, "
+                            "start from scratch")
+
+  def _save(self):
+    if not self.path:
+      return
+    if self.writer is not None:
+      self.state['writer'] = self.writer.sync()
+    tmp_path = f"{self.path}.tmp"
+    with open(tmp_path, 'wb') as file:
+      file.write(json_codec.dumps(self.state))
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(tmp_path, self.path)
+
+  # Writer whose files must be on disk before a checkpoint is saved; it
+  # provides sync returning its state
+  def attach_writer(self, writer):
+    self.writer = writer
+
+  # State of the file writer stored with the resumed checkpoint
+  @property
+  def writer_state(self):
+    return self.state.get('writer')
+
+  def is_completed(self, stage):
+    return stage in self.state['completed']
+
+  def start_stage(self, stage):
+    skip = self.state['rows'] if self.state['stage'] == stage else 0
+    self.state['stage'] = stage
+    self.state['rows'] = skip
+    return StageProgress(self, stage, skip)
+
+  def save(self, stage, rows):
+    self.state['stage'] = stage
+    self.state['rows'] = rows
+    self._save()
+
+  def complete_stage(self, stage):
+    self.state['completed'].append(stage)
+    self.state['stage'] = None
+    self.state['rows'] = 0
+    self._save()
+
+  # Remove checkpoint after the job was completed
+  def remove(self):
+    if self.path and os.path.exists(self.path):
+      os.remove(self.path)
+
+class StageProgress:
+  '''Count the processed records of a stage and skip the records which were
+     already processed and flushed before the job was aborted'''
+
+  def __init__(self, checkpoint, stage, skip=0):
+    self.checkpoint = checkpoint
+    self.stage = stage
+    self.skip = skip
+    self.rows_done = 0
+
+  # Yield records not processed before; a record counts as processed once
+  # it is yielded, as bundles are only flushed at the end of a record (see
+  # StreamingFHIRBundle.end_record)
+  def records(self, iterable):
+    for record in iterable:
+      self.rows_done += 1
+      if self.rows_done <= self.skip:
+        continue
+      yield record
+
+  # Return the rows of a chunk not processed before without counting them;
+  # used if records are mapped ahead of the bundle (mapping pool, stage
+  # pipeline), a record is counted by done once its resources were added.
+  # Skipped rows precede all processed ones, so rows_done is only updated
+  # here before done is called by another thread
+  def pending_rows(self, chunk):
+    nof_skip = min(max(self.skip - self.rows_done, 0), len(chunk))
+    if nof_skip:
+      self.rows_done += nof_skip
+    return chunk.iloc[nof_skip:]
+
+  def done(self):
+    self.rows_done += 1
+
+  # Called after a bundle was flushed at the end of a record; all counted
+  # records were sent
+  def on_flush(self):
+    self.checkpoint.save(self.stage, self.rows_done)
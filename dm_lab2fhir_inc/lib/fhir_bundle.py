@@ -7,9 +7,30 @@
    Author: Lukas Goetz, Lukas.Goetz@medma.uni-heidelberg.de
    Date: 04-19-2020'''
 
-import json
-import requests
-import sqlalchemy
+import time
+from collections import OrderedDict
+from itertools import repeat
+from hashlib import sha256, blake2b
+from . import hapi_writer, json_codec, phase_timer
+
+UPSERT_BATCH_SIZE = 1000
+# columns to derive the (sub)type of a resource for statistics
+SQL_RETURNING_STATS_TYPE = ("type, data->'code'->'coding'->0->>'code', "
+                            "data->'meta'->>'source'")
+SQL_UPSERT = ('''INSERT INTO stg_fhir_dm.resources_inc (fhir_id, type, data, hash, is_deleted)
+                 VALUES {values}
+                 ON CONFLICT (fhir_id, type) DO UPDATE
+                 SET data = EXCLUDED.data,
+                     hash = EXCLUDED.hash,
+                     last_updated_at = NOW(),
+                     is_deleted = false
+                 WHERE resources_inc.hash IS DISTINCT FROM EXCLUDED.hash OR
+                       resources_inc.is_deleted
+                 RETURNING ''' + SQL_RETURNING_STATS_TYPE + ", (xmax = 0) AS inserted")
+# (sub)types of observations as used by umm_db_lib.get_ups_rm_num_fhir
+OBS_CODE_STATS_TYPES = {'74201-5': 'Obs_vent', 'intercurrent-dialysis': 'Obs_dial',
+                        '74200-7': 'Obs_icu'}
+OBS_SOURCE_STATS_TYPES = {'#lufu-cwd': 'Obs_lufu', '#laboratory': 'Obs_lab'}
 
 class FHIRBundle:
   '''Create FHIR bundle consisting of FHIR resources and send
@@ -20,41 +41,66 @@ class FHIRBundle:
       self.dtype = dtype
       self.endpoint = endpoint
 
-  def __init__(self, logger):
+  def __init__(self, logger, dedup_policy='first', fingerprint=False, entry_mode='conditional'):
+    if dedup_policy not in ('first', 'last'):
+      raise ValueError(f"Unknown policy '{dedup_policy}' for duplicate FHIR resources")
+    if entry_mode not in ('conditional', 'put'):
+      raise ValueError(f"Unknown entry mode '{entry_mode}' for FHIR bundle entries")
     self.logger = logger
+    self.entry_mode = entry_mode
+    self.dedup_policy = dedup_policy
+    self.fingerprint = fingerprint
     self.reset()
 
   def reset(self):
     self.bundle = {"resourceType": "Bundle", "type": "transaction", "entry": []}
     self.canceled_ids = {'Patient': [], 'Encounter': [], 'Condition': [],
                          'Procedure': [], 'MedicationStatement': [], 'Observation': []}
+    self._res_keys = {}
+    self._nof_flushed = 0
+    self.nof_duplicates = 0
+    self.stats = {}
+
+  # Key of a FHIR resource for duplicate detection; with fingerprint set, an
+  # 8 byte digest is used instead of the (type, id) tuple to save memory
+  def _get_res_key(self, res_type, res_id):
+    if self.fingerprint:
+      return blake2b(f"{res_type}/{res_id}".encode('utf-8'), digest_size=8).digest()
+    return (res_type, res_id)
+
+  def _remember_res_key(self, res_key, res_pos):
+    self._res_keys[res_key] = res_pos
 
   def _rm_canceled_encounters(self, enc_id, db_con):
       sql_delete = f'''UPDATE resources_inc
                        SET is_deleted = TRUE
-                       WHERE fhir_id = '{enc_id}' AND type = 'Encounter' '''
-      db_con.execute(sql_delete)
+                       WHERE fhir_id = '{enc_id}' AND type = 'Encounter'
+                       RETURNING {SQL_RETURNING_STATS_TYPE}'''
+      self._count_deleted(db_con.execute(sql_delete))
       sql_update = f'''UPDATE resources_inc
-                       SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE)
+                       SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE), hash = NULL
                        WHERE data->'encounter'->'reference' = '"Encounter/{enc_id}"' '''
       db_con.execute(sql_update, '''{"encounter","reference"}''')
       sql_update_med = f'''UPDATE resources_inc
-                           SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE)
+                           SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE), hash = NULL
                            WHERE data->'context'->'reference' = '"Encounter/{enc_id}"' '''
       db_con.execute(sql_update_med, '''{"context","reference"}''')
 
   def _rm_canceled_patients(self, pat_id, db_con):
     sql_delete = f'''UPDATE resources_inc
                      SET is_deleted = TRUE, last_updated_at = NOW()
-                     WHERE fhir_id = '{pat_id}' AND type = 'Patient' '''
-    db_con.execute(sql_delete)
+                     WHERE fhir_id = '{pat_id}' AND type = 'Patient'
+                     RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete))
     sql_delete_2 = f'''UPDATE resources_inc
                        SET is_deleted = TRUE, last_updated_at = NOW()
                        WHERE data->'subject'->'reference' = '"Patient/{pat_id}"' AND
-                       (type = 'Condition' OR type = 'Procedure' OR type = 'Observation') '''
-    db_con.execute(sql_delete_2)
+                       (type = 'Condition' OR type = 'Procedure' OR type = 'Observation')
+                       RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete_2))
     sql_update = f'''UPDATE resources_inc
-                     SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE), last_updated_at = NOW()
+                     SET data = jsonb_set(data, %s, '"UNKNOWN"', TRUE), hash = NULL,
+                         last_updated_at = NOW()
                      WHERE data->'subject'->'reference' = '"Patient/{pat_id}"' AND
                      (type = 'Encounter' OR type = 'MedicationStatement') '''
     db_con.execute(sql_update, '''{"subject","reference"}''')
@@ -62,8 +108,9 @@ class FHIRBundle:
   def _rm_canceled_conditions(self, cond_id, db_con):
     sql_delete = f'''UPDATE resources_inc
                      SET is_deleted = TRUE
-                     WHERE fhir_id = '{cond_id}' AND type = 'Condition' '''
-    db_con.execute(sql_delete)
+                     WHERE fhir_id = '{cond_id}' AND type = 'Condition'
+                     RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete))
 
     sql_get_index = f'''SELECT index-1
                         FROM resources_inc, jsonb_array_elements(data->'diagnosis')
@@ -74,7 +121,7 @@ class FHIRBundle:
     result = result.fetchone()
     if result:
       sql_update = f'''UPDATE resources_inc
-                       SET data = jsonb_set(data, %s, '"UNKNOWN"', false)
+                       SET data = jsonb_set(data, %s, '"UNKNOWN"', false), hash = NULL
                        WHERE type = 'Encounter' '''
       db_con.execute(sql_update, '''{"diagnosis", ''' + str(result[0]) +
                                  ''', "condition", "reference"}''')
@@ -82,75 +129,128 @@ class FHIRBundle:
   def _rm_canceled_procedures(self, prod_id, db_con):
     sql_delete = f'''UPDATE resources_inc
                      SET is_deleted = TRUE
-                     WHERE fhir_id = '{prod_id}' AND type = 'Procedure' '''
-    db_con.execute(sql_delete)
+                     WHERE fhir_id = '{prod_id}' AND type = 'Procedure'
+                     RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete))
 
   def _rm_canceled_medications(self, med_id, db_con):
     sql_delete = f'''UPDATE resources_inc
                      SET is_deleted = TRUE
-                     WHERE fhir_id = '{med_id}' AND type = 'MedicationStatement' '''
-    db_con.execute(sql_delete)
+                     WHERE fhir_id = '{med_id}' AND type = 'MedicationStatement'
+                     RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete))
 
   def _rm_canceled_observations(self, obs_id, db_con):
     sql_delete = f'''UPDATE resources_inc
                      SET is_deleted = TRUE
-                     WHERE fhir_id = '{obs_id}' AND type = 'Observation' '''
-    db_con.execute(sql_delete)
+                     WHERE fhir_id = '{obs_id}' AND type = 'Observation'
+                     RETURNING {SQL_RETURNING_STATS_TYPE}'''
+    self._count_deleted(db_con.execute(sql_delete))
+
+  def _count(self, stats_row, action):
+    stats_type = get_stats_type(*stats_row)
+    type_stats = self.stats.setdefault(stats_type, {'inserted': 0, 'updated': 0, 'deleted': 0})
+    type_stats[action] += 1
+
+  def _count_deleted(self, result):
+    for stats_row in result.fetchall():
+      self._count(stats_row, 'deleted')
 
-  # Add FHIR resource(s) to bundle
+  # Return number of upserted and removed resources of type/ subtype
+  # res_type (see get_stats_type) sent by this bundle
+  def get_ups_rm_num(self, res_type):
+    type_stats = self.stats.get(res_type, {'inserted': 0, 'updated': 0, 'deleted': 0})
+    return type_stats['inserted'] + type_stats['updated'], type_stats['deleted']
+
+  # Request of bundle entry: 'conditional' creates the resource only if no
+  # resource with the same identifier exists, 'put' creates/ updates the
+  # resource by its id
+  def _get_entry_request(self, res, res_json):
+    if self.entry_mode == 'put':
+      return {"method": "PUT", "url": f"{res.resource_type}/{res.id}"}
+    return {"method": "POST", "url": f"{res.resource_type}",
+            "ifNoneExist": f"identifier={res_json['identifier'][0].get('system')}|{res.id}"}
+
+  # Add FHIR resource(s) to bundle; duplicates (same type and id) within the
+  # bundle are either dropped (policy 'first') or replace the entry added
+  # before (policy 'last')
   def add_resources(self, res_list):
     try:
-      res_ids = []
       for res in res_list:
-        if res.id in res_ids:
+        res_key = self._get_res_key(res.resource_type, res.id)
+        res_pos = self._res_keys.get(res_key)
+        if res_pos is not None and self.dedup_policy == 'first':
+          self._remember_res_key(res_key, res_pos)
+          self.nof_duplicates += 1
           continue
-        else:
-          res_ids.append(res.id)
 
+        res_json = res.as_json()
         res_entry = {"fullurl": f"{res.resource_type}/{res.id}",
-                     "resource": {},
-                     "request": {"method": "POST", "url": f"{res.resource_type}",
-                                 "ifNoneExist": f"identifier={res.identifier[0].system}|{res.id}"}}
-        res_entry['resource'] = res.as_json()
-        self.bundle['entry'].append(res_entry)
+                     "resource": res_json,
+                     "request": self._get_entry_request(res, res_json)}
+
+        # entries which were already flushed cannot be replaced anymore
+        if res_pos is not None and res_pos >= self._nof_flushed:
+          self._store_entry(res_entry, res_pos - self._nof_flushed)
+          self._remember_res_key(res_key, res_pos)
+          self.nof_duplicates += 1
+        else:
+          self._remember_res_key(res_key, self._nof_flushed + len(self.bundle['entry']))
+          self._store_entry(res_entry)
 
     except Exception as exc:
       self.logger.error(f"In '{__name__}': FHIR resource(s) could not be added to bundle ({exc})",
                         exc_info=True)
       raise
 
+  # Append entry to bundle or replace the entry at index
+  def _store_entry(self, res_entry, index=None):
+    if index is None:
+      self.bundle['entry'].append(res_entry)
+    else:
+      self.bundle['entry'][index] = res_entry
+
+  # Serialized resources of the bundle entries if they are kept; None lets
+  # the destination serialize them
+  def _get_entries_json(self):
+    return None
+
   def rm_resources(self, type, id):
     self.canceled_ids[type].append(id)
 
   # Print FHIR bundle as indented json
   def print_as_json(self):
-    print(json.dumps(self.bundle, indent=2))
+    print(json_codec.dumps_pretty(self.bundle))
 
   # Send FHIR bundle to PostgreSQL DB
   def execute(self, dest):
     try:
 
+      entries_json = self._get_entries_json()
       if dest.dtype == 'psql':
-        # execute upsertions
-        ins_val_tup = ()
-        cursor = dest.endpoint.raw_connection().cursor()
+        # execute upsertions in batches; only inserted/ updated rows are
+        # returned, unchanged resources (same content hash) are skipped to
+        # avoid rewriting the row and bumping last_updated_at
         self.logger.info(f"Send FHIR resources to FHIR DB for upsert ...")
-        for entry in self.bundle['entry']:
-          res_id = entry['resource']['id']
-          res_type = entry['resource']['resourceType']
-
-          res_body = json.dumps(entry['resource'])
-          ins_val_tup = (cursor.mogrify("(%s, %s, %s, %s)",
-                                        (res_id, res_type, res_body, 'False')).decode("utf-8"),)
-
-          ins_val_str = ','.join(ins_val_tup)
-          dest.endpoint.execute(
-            sqlalchemy.text("INSERT INTO stg_fhir_dm.resources_inc (fhir_id, type, data, is_deleted) VALUES " +
-                                              ins_val_str +
-                                              ''' ON CONFLICT (fhir_id, type) DO UPDATE
-                                                  set data = EXCLUDED.data,
-                                                      last_updated_at = NOW(),
-                                                      is_deleted = false'''))
+        con = dest.endpoint.raw_connection()
+        try:
+          cursor = con.cursor()
+          for i in range(0, len(self.bundle['entry']), UPSERT_BATCH_SIZE):
+            batch_json = (entries_json[i:i + UPSERT_BATCH_SIZE] if entries_json is not None
+                          else repeat(None))
+            ins_val_str = ','.join(
+              cursor.mogrify("(%s, %s, %s, %s, %s)",
+                             (entry['resource']['id'], entry['resource']['resourceType'],
+                              get_json_str(entry['resource'], res_json),
+                              get_content_hash(entry['resource']), 'False')).decode("utf-8")
+              for entry, res_json in zip(self.bundle['entry'][i:i + UPSERT_BATCH_SIZE],
+                                         batch_json))
+            cursor.execute(SQL_UPSERT.format(values=ins_val_str))
+            for *stats_row, inserted in cursor.fetchall():
+              self._count(stats_row, 'inserted' if inserted else 'updated')
+          con.commit()
+        finally:
+          con.close()
         # execute deletions
         if (self.canceled_ids['Encounter'] or self.canceled_ids['Patient'] or
             self.canceled_ids['Condition'] or self.canceled_ids['Procedure'] or
@@ -169,16 +269,153 @@ class FHIRBundle:
           for obs_id in self.canceled_ids['Observation']:
             self._rm_canceled_observations(obs_id, dest.endpoint)
       else:
-        headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
-
-        session = requests.Session()
-        session.trust_env = False
-
-        response = session.post(dest.endpoint, headers=headers, json=self.bundle)
-        response.raise_for_status()
-        self.logger.info(f"FHIR bundle was sent to FHIR server")
+        # HAPI FHIR server or file writer
+        writer = dest.endpoint
+        if isinstance(writer, str):
+          writer = hapi_writer.HAPIWriter(self.logger, writer)
+        writer.write(self.bundle['entry'], entries_json)
+        # execute deletions
+        writer.delete(self.canceled_ids)
 
     except Exception as exc:
       self.logger.error(f"In '{__name__}': FHIR bundle could not be sent to FHIR DB ({exc})",
                         exc_info=True)
       raise
+
+class StreamingFHIRBundle(FHIRBundle):
+  '''FHIR bundle which is sent to FHIR DB/ server at the end of a record
+     (see end_record) once it holds max_entries entries (incl. requests for
+     deletion) or max_bytes bytes of serialized resources, so that memory
+     stays constant over a stage run and the resources of a record are never
+     split across bundles. Duplicate resources are detected using the
+     max_seen_ids most recently added resource keys; keys of entries not
+     flushed yet are never dropped, as a flush only happens at the end of a
+     record and a buffer may exceed max_entries
+   Arguments: logger, dest, max_entries, max_bytes, max_seen_ids,
+              dedup_policy, fingerprint, entry_mode, timer, on_flush'''
+
+  def __init__(self, logger, dest, max_entries=5000, max_bytes=50000000,
+               max_seen_ids=100000, dedup_policy='first', fingerprint=False,
+               entry_mode='conditional', timer=None, on_flush=None):
+    self.dest = dest
+    self.on_flush = on_flush
+    self.timer = timer if timer else phase_timer.PhaseTimer()
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.max_seen_ids = max_seen_ids
+    super().__init__(logger, dedup_policy, fingerprint, entry_mode)
+
+  def reset(self):
+    super().reset()
+    self._res_keys = OrderedDict()
+    self._entries_json = []
+    self._buffer_bytes = 0
+    self._buffer_canceled = 0
+    self.flush_stats = []
+
+  def _reset_buffer(self):
+    self.bundle['entry'] = []
+    self._entries_json = []
+    for res_type in self.canceled_ids:
+      self.canceled_ids[res_type] = []
+    self._buffer_bytes = 0
+    self._buffer_canceled = 0
+
+  # Drop the least recently added keys beyond max_seen_ids, but keep keys
+  # of buffered entries, so that their duplicates are still merged; they can
+  # be dropped after the next flush
+  def _remember_res_key(self, res_key, res_pos):
+    self._res_keys[res_key] = res_pos
+    self._res_keys.move_to_end(res_key)
+    while len(self._res_keys) > self.max_seen_ids:
+      oldest_key = next(iter(self._res_keys))
+      if self._res_keys[oldest_key] >= self._nof_flushed:
+        break
+      del self._res_keys[oldest_key]
+
+  def _is_full(self):
+    return (len(self.bundle['entry']) + self._buffer_canceled >= self.max_entries or
+            (self.max_bytes and self._buffer_bytes >= self.max_bytes))
+
+  # With max_bytes set, the resource of an entry is serialized once when it
+  # is added; the JSON is kept for the destination, a replaced entry
+  # (policy 'last') no longer counts
+  def _store_entry(self, res_entry, index=None):
+    res_json = json_codec.dumps(res_entry['resource']) if self.max_bytes else None
+    super()._store_entry(res_entry, index)
+    if index is None:
+      self._entries_json.append(res_json)
+    else:
+      if self._entries_json[index] is not None:
+        self._buffer_bytes -= len(self._entries_json[index])
+      self._entries_json[index] = res_json
+    if res_json is not None:
+      self._buffer_bytes += len(res_json)
+
+  def _get_entries_json(self):
+    return self._entries_json if self.max_bytes else None
+
+  def add_resources(self, res_list):
+    with self.timer.phase('serialize'):
+      super().add_resources(res_list)
+
+  def rm_resources(self, type, id):
+    super().rm_resources(type, id)
+    self._buffer_canceled += 1
+
+  # Called after all resources of a record were added/ removed; flushes the
+  # bundle if it is full, so that resources referencing each other (e.g. an
+  # encounter and its conditions) are sent in the same bundle
+  def end_record(self):
+    if self._is_full():
+      self.flush()
+
+  # Send buffered upsertions/ deletions to FHIR DB/ server and empty buffer
+  def flush(self):
+    nof_entries = len(self.bundle['entry'])
+    if not nof_entries and not self._buffer_canceled:
+      return
+    start_ts = time.monotonic()
+    with self.timer.phase('load'):
+      super().execute(self.dest)
+    flush_stats = {'entries': nof_entries, 'canceled': self._buffer_canceled,
+                   'bytes': self._buffer_bytes, 'duration': time.monotonic() - start_ts}
+    self.flush_stats.append(flush_stats)
+    self.logger.info(f"Flushed {flush_stats['entries']} FHIR resources/ "
+                     f"{flush_stats['canceled']} requests for deletion "
+                     f"({flush_stats['bytes']} bytes) in {flush_stats['duration']:.2f}s")
+    self._nof_flushed += nof_entries
+    self._reset_buffer()
+    if self.on_flush:
+      self.on_flush()
+
+  # Send remaining FHIR resources to FHIR DB/ server
+  def execute(self, dest=None):
+    if dest is not None and dest is not self.dest:
+      raise ValueError("Streaming FHIR bundle can only be sent to its own destination")
+    self.flush()
+    if self.nof_duplicates:
+      self.logger.info(f"Dropped {self.nof_duplicates} duplicate FHIR resources "
+                       f"(policy: {self.dedup_policy})")
+
+# helper functions
+def get_json_str(resource, res_json=None):
+  '''Return compact JSON of a FHIR resource as str, reusing its serialized
+     JSON res_json if given'''
+  if res_json is not None:
+    return res_json.decode('utf-8')
+  return json_codec.dumps_str(resource)
+
+def get_content_hash(resource):
+  '''Return sha256 hash of the canonical JSON representation (sorted keys,
+     no whitespace) of a FHIR resource'''
+  return sha256(json_codec.dumps_canonical(resource)).hexdigest()
+
+def get_stats_type(res_type, code, source):
+  '''Return resource type or subtype of observations (e.g. 'Obs_lab') for
+     statistics'''
+  if res_type == 'Observation':
+    if code in OBS_CODE_STATS_TYPES:
+      return OBS_CODE_STATS_TYPES[code]
+    return OBS_SOURCE_STATS_TYPES.get(source, res_type)
+  return res_type
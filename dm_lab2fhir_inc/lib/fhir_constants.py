@@ -0,0 +1,102 @@
+#!/usr/bin/python3.6
+
+'''Constant FHIR elements shared by all resources the mappers create
+   (meta sources, identifier types, categories, encounter class, medication
+   ingredients). Each element is built and validated once and frozen: it
+   cannot be modified anymore and as_json returns its pre-serialized JSON,
+   which is shared by all resources and therefore read-only as well
+   Arguments: none
+   Returns: frozen FHIR elements
+   Date: 10-19-2026'''
+
+from lib.mii_profiles import (codeableconcept, meta, mii_codeableconcept, mii_coding)
+
+_frozen_classes = {}
+_elements = {}
+
+def _immutable(self, *args, **kwargs):
+  raise TypeError("JSON of constant FHIR elements cannot be modified")
+
+class FrozenDict(dict):
+  '''Read-only dict of shared constant JSON; serialized like a dict'''
+
+  __setitem__ = __delitem__ = __ior__ = _immutable
+  clear = pop = popitem = setdefault = update = _immutable
+
+  # Unpickling a dict subclass would set its items after creation
+  def __reduce__(self):
+    return (type(self), (dict(self),))
+
+class FrozenList(list):
+  '''Read-only list of shared constant JSON; serialized like a list'''
+
+  __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+  append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+  def __reduce__(self):
+    return (type(self), (list(self),))
+
+# Return read-only copy of JSON value, so that a resource modifying its
+# JSON cannot change the constant parts of all other resources
+def freeze_json(value):
+  if isinstance(value, (FrozenDict, FrozenList)):
+    return value
+  if isinstance(value, dict):
+    return FrozenDict((key, freeze_json(item)) for key, item in value.items())
+  if isinstance(value, list):
+    return FrozenList(freeze_json(item) for item in value)
+  return value
+
+def _frozen_as_json(self):
+  return self._frozen_json
+
+def _frozen_setattr(self, name, value):
+  raise AttributeError(f"Constant FHIR element {type(self).__name__} cannot be modified")
+
+# Validate element and freeze it by switching to a subclass of its class,
+# so that type checks of the resources it is assigned to still pass
+def freeze(element):
+  element_json = freeze_json(element.as_json())
+  cls = type(element)
+  if cls not in _frozen_classes:
+    # module global, so that frozen elements can be pickled
+    name = f"Frozen_{cls.__module__.rsplit('.', 1)[-1]}_{cls.__name__}"
+    _frozen_classes[cls] = type(name, (cls,), {'__module__': __name__,
+                                               'as_json': _frozen_as_json,
+                                               '__setattr__': _frozen_setattr})
+    globals()[name] = _frozen_classes[cls]
+  element._frozen_json = element_json
+  element.__class__ = _frozen_classes[cls]
+  return element
+
+# Return constant element registered under key; elements depending on data
+# (e.g. the ingredients of a substance) are created by factory on first use
+def get(key, factory=None):
+  element = _elements.get(key)
+  if element is None:
+    element = freeze(factory())
+    _elements[key] = element
+  return element
+
+META_SAP_ISH = freeze(meta.Meta({"source": "#sap-ish"}))
+META_LABORATORY = freeze(meta.Meta({"source": "#laboratory"}))
+META_LUFU_CWD = freeze(meta.Meta({"source": "#lufu-cwd"}))
+
+IDENTIFIER_TYPE_MR = freeze(codeableconcept.CodeableConcept(
+  {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "code": "MR"}]}))
+IDENTIFIER_TYPE_VN = freeze(mii_codeableconcept.CodeableConcept(
+  {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "code": "VN"}]}))
+
+ENCOUNTER_CLASS_IMP = freeze(mii_coding.Coding(
+  {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "IMP",
+   "display": "inpatient encounter"}))
+
+OBSERVATION_CATEGORY_LABORATORY = freeze(mii_codeableconcept.CodeableConcept(
+  {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+               "display": "Laboratory", "code": "laboratory"}]}))
+OBSERVATION_CATEGORY_EXAM = freeze(codeableconcept.CodeableConcept(
+  {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+               "code": "exam"}]}))
+
+PROCEDURE_CATEGORY = freeze(mii_codeableconcept.CodeableConcept(
+  {"coding": [{"system": "http://snomed.info/sct", "code": "387713003"}]}))
@@ -0,0 +1,40 @@
+#!/usr/bin/python3.6
+
+'''Format timestamps of the datamart as FHIR dateTime strings (local time
+   of the timestamp without offset and fractional seconds, e.g.
+   '2020-12-01T08:30:00'); whole timestamp columns of a chunk are formatted
+   at once by numpy instead of strftime per value
+   Arguments: timestamp(s)
+   Returns: FHIR dateTime string(s)
+   Date: 10-19-2026'''
+
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Format timestamp, None for missing values; values of columns formatted by
+# format_datetime_columns are returned as they are
+def format_datetime(value):
+  if isinstance(value, str):
+    return value
+  if value is None or pd.isna(value):
+    return None
+  return datetime(value.year, value.month, value.day,
+                  value.hour, value.minute, value.second).isoformat()
+
+# Format timestamp columns of a chunk in place (NaT -> None); columns which
+# are not of a datetime dtype are left to format_datetime
+def format_datetime_columns(chunk, columns):
+  for column in columns:
+    values = chunk[column]
+    if not pd.api.types.is_datetime64_any_dtype(values):
+      continue
+    if values.dt.tz is not None:
+      values = values.dt.tz_localize(None)
+    formatted = np.datetime_as_string(values.to_numpy(dtype='datetime64[s]'),
+                                      unit='s').astype(object)
+    formatted[values.isna().to_numpy()] = None
+    # explicit object dtype, otherwise the strings are inferred as string
+    # dtype and None becomes NaN
+    chunk[column] = pd.Series(formatted, index=chunk.index, dtype=object)
+  return chunk
@@ -0,0 +1,202 @@
+#!/usr/bin/python3.6
+
+'''Create FHIR resources from templates: the skeleton of a resource type
+   is declared once and validated once against its mii_profiles class
+   (properties, types, non-optional properties, constant values). Per row
+   only the variable fields are filled in and type checked like the object
+   model does; the constant parts of the skeleton are serialized once and
+   shared by all created resources as read-only JSON (see
+   fhir_constants.freeze_json)
+   Arguments: resource class, skeleton
+   Returns: FHIR resources
+   Date: 10-19-2026'''
+
+from lib.mii_profiles.fhirabstractbase import FHIRAbstractBase, FHIRValidationError
+from lib.mii_profiles.fhirabstractresource import FHIRAbstractResource
+from lib.mii_profiles.fhirdate import FHIRDate
+from lib.fhir_constants import freeze_json
+
+class Field:
+  '''Variable value of a skeleton taken from the row values by name;
+     properties with value None are omitted'''
+
+  def __init__(self, name):
+    self.name = name
+
+class Section:
+  '''Optional element or list item of a skeleton, included if the row
+     value of name is true'''
+
+  def __init__(self, name, skeleton):
+    self.name = name
+    self.skeleton = skeleton
+
+_STATIC, _FIELD, _ELEMENT, _LIST, _SECTION = range(5)
+
+# Type check of FHIRAbstractBase._matches_type; dates are filled in as
+# JSON strings
+def _matches_type(value, typ):
+  if typ is FHIRDate:
+    return isinstance(value, str)
+  if isinstance(value, typ):
+    return True
+  if typ is int or typ is float:
+    return isinstance(value, (int, float))
+  return False
+
+def _is_element_type(typ):
+  return isinstance(typ, type) and issubclass(typ, FHIRAbstractBase)
+
+# Compile skeleton value of a property to (kind, payload)
+def _compile(value, typ, is_list):
+  if isinstance(value, Section):
+    return _SECTION, (value.name, _compile(value.skeleton, typ, is_list))
+  if isinstance(value, Field):
+    if is_list or _is_element_type(typ):
+      raise FHIRValidationError([TypeError(f"Field \"{value.name}\" is only supported for "
+                                           f"primitive properties, expecting {typ}")])
+    return _FIELD, (value.name, typ)
+  if is_list:
+    if not isinstance(value, list) or not value:
+      raise FHIRValidationError([TypeError(f"Expecting non-empty list of {typ}, "
+                                           f"but is {type(value)}")])
+    items = []
+    for pos, item in enumerate(value):
+      try:
+        items.append(_compile(item, typ, False))
+      except FHIRValidationError as exc:
+        raise exc.prefixed(str(pos)) from None
+    if all(kind == _STATIC for kind, _ in items):
+      return _STATIC, freeze_json([payload for _, payload in items])
+    return _LIST, items
+  if _is_element_type(typ):
+    if isinstance(value, typ):
+      return _STATIC, freeze_json(value.as_json())
+    if not isinstance(value, dict):
+      raise FHIRValidationError([TypeError(f"Expecting {typ} or skeleton dict, "
+                                           f"but is {type(value)}")])
+    element = _Element(typ, value)
+    if element.is_static:
+      return _STATIC, freeze_json(element.fill({}))
+    return _ELEMENT, element
+  if not _matches_type(value, typ):
+    raise FHIRValidationError([TypeError(f"Expecting {typ}, but is {type(value)}")])
+  return _STATIC, value
+
+# Value of a compiled property for the row values; None if omitted
+def _fill_value(kind, payload, values):
+  if kind == _STATIC:
+    return payload
+  if kind == _FIELD:
+    name, typ = payload
+    value = values[name]
+    if value is not None and not _matches_type(value, typ):
+      raise FHIRValidationError([TypeError(f"Expecting field \"{name}\" to be {typ}, "
+                                           f"but is {type(value)}")])
+    return value
+  if kind == _ELEMENT:
+    return payload.fill(values)
+  if kind == _SECTION:
+    name, (inner_kind, inner_payload) = payload
+    if not values[name]:
+      return None
+    return _fill_value(inner_kind, inner_payload, values)
+  items = []
+  for item_kind, item_payload in payload:
+    item = _fill_value(item_kind, item_payload, values)
+    if item is not None:
+      items.append(item)
+  return items or None
+
+class _Element:
+  '''Skeleton of an element compiled against its class; properties are
+     serialized in the order of elementProperties like the object model'''
+
+  def __init__(self, cls, skeleton):
+    self.cls = cls
+    self.resource_type = (cls.resource_type if issubclass(cls, FHIRAbstractResource)
+                          else None)
+    self.entries = []
+    self.groups = {}
+    self.nonoptionals = set()
+    errs = []
+    properties = cls().elementProperties()
+    known = {prop[1] for prop in properties}
+    for key in skeleton:
+      if key not in known:
+        errs.append(AttributeError(f"Superfluous entry \"{key}\" in skeleton for {cls}"))
+    for _, jsname, typ, is_list, of_many, not_optional in properties:
+      if not_optional:
+        self.nonoptionals.add(of_many or jsname)
+      if jsname not in skeleton:
+        continue
+      self.groups[jsname] = of_many or jsname
+      try:
+        self.entries.append((jsname,) + _compile(skeleton[jsname], typ, is_list))
+      except FHIRValidationError as exc:
+        errs.append(exc.prefixed(jsname))
+    for nonop in self.nonoptionals - set(self.groups.values()):
+      errs.append(KeyError(f"Property \"{nonop}\" on {cls} is not optional, it is missing "
+                           "in the skeleton"))
+    if errs:
+      raise FHIRValidationError(errs)
+    self.is_static = all(kind == _STATIC for _, kind, _ in self.entries)
+
+  def fill(self, values):
+    js = {}
+    for jsname, kind, payload in self.entries:
+      try:
+        value = _fill_value(kind, payload, values)
+      except FHIRValidationError as exc:
+        raise exc.prefixed(jsname) from None
+      if value is not None:
+        js[jsname] = value
+    missing = self.nonoptionals.difference(self.groups[jsname] for jsname in js)
+    if missing:
+      raise FHIRValidationError([KeyError(f"Property \"{nonop}\" on {self.cls} is not "
+                                          "optional, you must provide a value for it")
+                                 for nonop in missing])
+    if self.resource_type:
+      js['resourceType'] = self.resource_type
+    return js
+
+class ResourceTemplate:
+  '''Skeleton of a FHIR resource type, validated once against the resource
+     class (e.g. mii_observation.Observation); raises FHIRValidationError if
+     the skeleton does not match the class'''
+
+  def __init__(self, resource_class, skeleton):
+    self.resource_type = resource_class.resource_type
+    self.id_field = skeleton['id'].name if isinstance(skeleton.get('id'), Field) else None
+    self.id = None if self.id_field else skeleton.get('id')
+    self._root = _Element(resource_class, skeleton)
+
+  # Return JSON of resource filled with the row values, raises
+  # FHIRValidationError
+  def fill(self, values):
+    return self._root.fill(values)
+
+  def create(self, values):
+    return TemplateResource(self, values)
+
+class TemplateResource:
+  '''FHIR resource created from a template; provides resource_type, id and
+     as_json (validated on first call) like the resources of the object
+     model'''
+
+  __slots__ = ('template', 'values', 'id', '_json')
+
+  def __init__(self, template, values):
+    self.template = template
+    self.values = values
+    self.id = values[template.id_field] if template.id_field else template.id
+    self._json = None
+
+  @property
+  def resource_type(self):
+    return self.template.resource_type
+
+  def as_json(self):
+    if self._json is None:
+      self._json = self.template.fill(self.values)
+    return self._json
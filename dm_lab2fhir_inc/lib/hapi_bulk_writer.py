@@ -0,0 +1,128 @@
+#!/usr/bin/python3.6
+
+'''Write FHIR resources to NDJSON files and load them into HAPI FHIR
+   server with the bulk $import operation
+   Arguments: logger, ndjson_writer, hapi_writer, base_url, serve_port,
+              poll_interval, timeout
+   Returns: none
+   Date: 10-19-2026'''
+
+import functools
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlsplit
+from . import json_codec
+
+DELETE_BATCH_SIZE = 5000
+
+class HAPIBulkWriter:
+  '''Write FHIR resources to NDJSON files and load them into HAPI FHIR
+     server with the bulk $import operation. The NDJSON files are fetched
+     by the FHIR server from base_url, which is either a shared file server
+     or a local HTTP server on serve_port started during the import'''
+
+  def __init__(self, logger, ndjson_writer, hapi_writer, base_url, serve_port=None,
+               poll_interval=10, timeout=86400):
+    self.logger = logger
+    self.ndjson_writer = ndjson_writer
+    self.hapi_writer = hapi_writer
+    self.base_url = base_url.rstrip('/')
+    self.serve_port = serve_port
+    self.poll_interval = poll_interval
+    self.timeout = timeout
+
+  def write(self, entries, entries_json=None):
+    self.ndjson_writer.write(entries, entries_json)
+
+  # Canceled resources are deleted via transaction bundles after the import
+  def delete(self, canceled_ids):
+    self.ndjson_writer.delete(canceled_ids)
+
+  def sync(self):
+    return self.ndjson_writer.sync()
+
+  # The storage type follows the scheme of base_url, the local HTTP server
+  # is served via plain http
+  def _get_import_parameters(self, manifest):
+    parameters = [{"name": "inputFormat", "valueCode": "application/fhir+ndjson"},
+                  {"name": "inputSource", "valueUri": self.base_url},
+                  {"name": "storageDetail",
+                   "part": [{"name": "type",
+                             "valueCode": urlsplit(self.base_url).scheme or 'https'}]}]
+    for part in manifest['output']:
+      parameters.append({"name": "input",
+                         "part": [{"name": "type", "valueCode": part['type']},
+                                  {"name": "url",
+                                   "valueUri": f"{self.base_url}/{part['url']}"}]})
+    return {"resourceType": "Parameters", "parameter": parameters}
+
+  # Start $import and poll its status until it is completed
+  def _import(self, manifest):
+    session = self.hapi_writer.get_session()
+    headers = dict(self.hapi_writer.headers, Prefer='respond-async')
+    headers.pop('Content-Encoding', None)
+    response = session.post(f"{self.hapi_writer.url.rstrip('/')}/$import", headers=headers,
+                            data=json_codec.dumps(self._get_import_parameters(manifest)))
+    response.raise_for_status()
+    poll_url = response.headers.get('Content-Location')
+    if not poll_url:
+      return json_codec.loads(response.content) if response.content else {}
+    self.logger.info(f"Bulk import was started, polling {poll_url} ...")
+    start_ts = time.monotonic()
+    while True:
+      response = session.get(poll_url)
+      response.raise_for_status()
+      if response.status_code != 202:
+        return json_codec.loads(response.content) if response.content else {}
+      if time.monotonic() - start_ts > self.timeout:
+        raise TimeoutError(f"Bulk import did not complete within {self.timeout}s")
+      time.sleep(self.poll_interval)
+
+  def _serve(self):
+    handler = functools.partial(SimpleHTTPRequestHandler,
+                                directory=self.ndjson_writer.outdir)
+    server = ThreadingHTTPServer(('', self.serve_port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+  def _delete_canceled(self, manifest):
+    canceled_ids = {}
+    nof_canceled = 0
+    for part in manifest['deleted']:
+      path = os.path.join(self.ndjson_writer.outdir, part['url'])
+      with self.ndjson_writer.open(path) as file:
+        for line in file:
+          res = json_codec.loads(line)
+          canceled_ids.setdefault(res['resourceType'], []).append(res['id'])
+          nof_canceled += 1
+          if nof_canceled % DELETE_BATCH_SIZE == 0:
+            self.hapi_writer.delete(canceled_ids)
+            canceled_ids = {}
+    self.hapi_writer.delete(canceled_ids)
+
+  # Close NDJSON files, import them into FHIR server and apply deletions
+  def close(self):
+    manifest = self.ndjson_writer.close()
+    if manifest['output']:
+      server = self._serve() if self.serve_port else None
+      try:
+        outcome = self._import(manifest)
+      finally:
+        if server:
+          server.shutdown()
+          server.server_close()
+      self.logger.info("Bulk import was completed")
+      for part in outcome.get('output', []):
+        self.logger.info(f"Imported {part.get('count', '?')} {part.get('type')} resources")
+      for issue in outcome.get('issue', []):
+        self.logger.info(f"Bulk import {issue.get('severity', 'information')}: "
+                         f"{issue.get('diagnostics', '')}")
+      nof_res_types = {}
+      for part in manifest['output']:
+        nof_res_types[part['type']] = nof_res_types.get(part['type'], 0) + part['count']
+      for res_type, nof_res in nof_res_types.items():
+        self.logger.info(f"Sent {nof_res} {res_type} resources for bulk import")
+    self._delete_canceled(manifest)
+    return manifest
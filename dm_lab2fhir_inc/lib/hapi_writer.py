@@ -0,0 +1,318 @@
+#!/usr/bin/python3.6
+
+'''Send FHIR bundle entries to HAPI FHIR server in chunks of transaction/
+   batch bundles using a bounded pool of concurrent workers
+   Arguments: logger, url, bundle_size, max_workers, bundle_type, max_retries,
+              compress
+   Returns: none
+   Date: 10-19-2026'''
+
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from . import json_codec
+
+# tiers are sent one after another, bundles within a tier concurrently
+TIER_PATIENT = 0
+TIER_SHARED = 1
+TIER_CLUSTER = 2
+
+SHARED_RES_TYPES = ('Location', 'Medication', 'Organization')
+# order of resource types within an encounter cluster
+CLUSTER_RES_ORDER = {'Encounter': 0, 'Condition': 1, 'Procedure': 2,
+                     'MedicationStatement': 3, 'Observation': 4, 'DiagnosticReport': 5}
+# clusters containing these types reference each other and cannot be split
+ATOMIC_RES_TYPES = ('Encounter', 'DiagnosticReport')
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+GZIP_CHUNK_SIZE = 65536
+SEARCH_REFS_PER_REQUEST = 50
+SEARCH_PAGE_SIZE = 1000
+# references to canceled resources: (canceled type, referencing type,
+# search parameter, FHIRPath of reference, delete referencing resource)
+CANCEL_REFERENCES = (
+  ('Patient', 'Condition', 'subject', None, True),
+  ('Patient', 'Procedure', 'subject', None, True),
+  ('Patient', 'Observation', 'subject', None, True),
+  ('Patient', 'Encounter', 'subject', 'Encounter.subject', False),
+  ('Patient', 'MedicationStatement', 'subject', 'MedicationStatement.subject', False),
+  ('Encounter', 'Encounter', 'part-of', 'Encounter.partOf', False),
+  ('Encounter', 'Condition', 'encounter', 'Condition.encounter', False),
+  ('Encounter', 'Procedure', 'encounter', 'Procedure.encounter', False),
+  ('Encounter', 'Observation', 'encounter', 'Observation.encounter', False),
+  ('Encounter', 'MedicationStatement', 'context', 'MedicationStatement.context', False),
+  ('Condition', 'Encounter', 'diagnosis',
+   "Encounter.diagnosis.where(condition.reference = '{ref}').condition", False))
+
+class HAPIWriter:
+  '''Send FHIR bundle entries to HAPI FHIR server in chunks of transaction/
+     batch bundles using a bounded pool of concurrent workers'''
+
+  def __init__(self, logger, url, bundle_size=500, max_workers=4,
+               bundle_type='transaction', max_retries=3, compress=False):
+    if bundle_type not in ('transaction', 'batch'):
+      raise ValueError(f"Unknown FHIR bundle type '{bundle_type}'")
+    self.logger = logger
+    self.url = url
+    self.bundle_size = bundle_size
+    self.max_workers = max_workers
+    self.bundle_type = bundle_type
+    self.max_retries = max_retries
+    self.compress = compress
+    self.headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
+    if compress:
+      self.headers['Content-Encoding'] = 'gzip'
+    self._local = threading.local()
+    # retries are counted by the worker threads
+    self._stats_lock = threading.Lock()
+    self.stats = {'bundles': 0, 'entries': 0, 'retries': 0, 'failed': 0}
+
+  def get_session(self):
+    if not hasattr(self._local, 'session'):
+      session = requests.Session()
+      session.trust_env = False
+      self._local.session = session
+    return self._local.session
+
+  def _post(self, bundle):
+    if self.compress:
+      # a generator body is sent with chunked transfer encoding
+      response = self.get_session().post(self.url, headers=self.headers,
+                                          data=iter_gzip_bundle(bundle))
+    else:
+      response = self.get_session().post(self.url, headers=self.headers,
+                                          data=json_codec.dumps(bundle))
+    response.raise_for_status()
+    return response
+
+  # Send one sub-bundle; on failure only this sub-bundle (for batch bundles
+  # only its failed entries) is sent again
+  def _send_with_retry(self, entries):
+    attempt = 0
+    while True:
+      try:
+        bundle = {"resourceType": "Bundle", "type": self.bundle_type, "entry": entries}
+        response = self._post(bundle)
+        if self.bundle_type == 'batch':
+          failed_entries = get_failed_batch_entries(entries,
+                                                    json_codec.loads(response.content))
+          if failed_entries:
+            if attempt >= self.max_retries:
+              raise RuntimeError(f"{len(failed_entries)} entries of batch bundle failed")
+            entries = failed_entries
+            raise requests.exceptions.RetryError(f"{len(failed_entries)} entries of batch "
+                                                  "bundle failed")
+        return len(entries)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+              requests.exceptions.HTTPError, requests.exceptions.RetryError) as exc:
+        status_code = getattr(getattr(exc, 'response', None), 'status_code', None)
+        if ((status_code is not None and status_code not in RETRY_STATUS_CODES) or
+            attempt >= self.max_retries):
+          raise
+        attempt += 1
+        with self._stats_lock:
+          self.stats['retries'] += 1
+        self.logger.warning(f"Sub-bundle of {len(entries)} entries could not be sent to FHIR "
+                            f"server ({exc}), retry {attempt}/{self.max_retries}")
+        time.sleep(2 ** (attempt - 1))
+
+  # Split entries into sub-bundles of at most bundle_size entries per tier
+  def _split(self, entries):
+    tiers = {TIER_PATIENT: [], TIER_SHARED: [], TIER_CLUSTER: {}}
+    for entry in entries:
+      res_type = entry['resource']['resourceType']
+      if res_type == 'Patient':
+        tiers[TIER_PATIENT].append([entry])
+      elif res_type in SHARED_RES_TYPES:
+        tiers[TIER_SHARED].append([entry])
+      else:
+        tiers[TIER_CLUSTER].setdefault(get_cluster_key(entry['resource']), []).append(entry)
+    tiers[TIER_CLUSTER] = list(tiers[TIER_CLUSTER].values())
+
+    chunked_tiers = []
+    for tier in (TIER_PATIENT, TIER_SHARED, TIER_CLUSTER):
+      chunks = []
+      chunk = []
+      for cluster in tiers[tier]:
+        cluster.sort(key=get_cluster_rank)
+        if any(entry['resource']['resourceType'] in ATOMIC_RES_TYPES for entry in cluster):
+          if chunk and len(chunk) + len(cluster) > self.bundle_size:
+            chunks.append(chunk)
+            chunk = []
+          chunk.extend(cluster)
+        else:
+          for entry in cluster:
+            if len(chunk) >= self.bundle_size:
+              chunks.append(chunk)
+              chunk = []
+            chunk.append(entry)
+      if chunk:
+        chunks.append(chunk)
+      if chunks:
+        chunked_tiers.append(chunks)
+    return chunked_tiers
+
+  # Send sub-bundles concurrently, raise if any of them failed
+  def _send_chunks(self, executor, chunks):
+    futures = [executor.submit(self._send_with_retry, chunk) for chunk in chunks]
+    errors = []
+    for future in futures:
+      try:
+        self.stats['entries'] += future.result()
+        self.stats['bundles'] += 1
+      except Exception as exc:
+        self.stats['failed'] += 1
+        errors.append(exc)
+    if errors:
+      raise RuntimeError(f"{len(errors)} of {len(chunks)} sub-bundles could not be sent "
+                         f"to FHIR server ({errors[0]})") from errors[0]
+
+  # Send FHIR bundle entries to FHIR server tier by tier; later tiers
+  # reference resources of former tiers and are not sent if a tier failed.
+  # The sub-bundles are serialized as a whole, entries_json is not used
+  def write(self, entries, entries_json=None):
+    if not entries:
+      return
+    chunked_tiers = self._split(entries)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      for chunks in chunked_tiers:
+        self._send_chunks(executor, chunks)
+    self.logger.info(f"FHIR bundle was sent to FHIR server ({len(entries)} entries in "
+                     f"{sum(len(chunks) for chunks in chunked_tiers)} sub-bundles)")
+
+  # Return ids of resources of type res_type referencing one of refs
+  def _search_ids(self, res_type, search_param, refs, elements='id'):
+    res_ids = {}
+    session = self.get_session()
+    for i in range(0, len(refs), SEARCH_REFS_PER_REQUEST):
+      params = {search_param: ','.join(refs[i:i + SEARCH_REFS_PER_REQUEST]),
+                '_elements': elements, '_count': SEARCH_PAGE_SIZE}
+      url = f"{self.url.rstrip('/')}/{res_type}"
+      while url:
+        response = session.get(url, params=params)
+        response.raise_for_status()
+        search_bundle = json_codec.loads(response.content)
+        for entry in search_bundle.get('entry', []):
+          res_ids[entry['resource']['id']] = entry['resource']
+        url = next((link['url'] for link in search_bundle.get('link', [])
+                    if link.get('relation') == 'next'), None)
+        params = None
+    return res_ids
+
+  # Delete canceled resources from FHIR server: references to them are
+  # replaced by {"display": "UNKNOWN"} (PATCH), resources depending on them
+  # are deleted and finally the canceled resources themselves are deleted
+  def delete(self, canceled_ids):
+    target_refs = {res_type: [f"{res_type}/{res_id}" for res_id in dict.fromkeys(res_ids)]
+                   for res_type, res_ids in canceled_ids.items() if res_ids}
+    if not target_refs:
+      return
+    patches = {}
+    dependent_refs = {}
+    for (target_type, res_type, search_param, path,
+         delete_res) in CANCEL_REFERENCES:
+      if not target_refs.get(target_type):
+        continue
+      res_ids = self._search_ids(res_type, search_param, target_refs[target_type],
+                                 'diagnosis' if target_type == 'Condition' else 'id')
+      for res_id, resource in res_ids.items():
+        res_ref = f"{res_type}/{res_id}"
+        if delete_res:
+          if res_ref not in target_refs.get(res_type, []):
+            dependent_refs[res_ref] = None
+            # conditions of a canceled patient are also referenced by encounters
+            if res_type == 'Condition':
+              target_refs.setdefault('Condition', []).append(res_ref)
+        elif target_type == 'Condition':
+          for diag in resource.get('diagnosis', []):
+            cond_ref = diag.get('condition', {}).get('reference')
+            if cond_ref in target_refs['Condition']:
+              patches.setdefault(res_ref, []).append(path.format(ref=cond_ref))
+        else:
+          patches.setdefault(res_ref, []).append(path)
+
+    deleted_refs = set(dependent_refs)
+    for res_refs in target_refs.values():
+      deleted_refs.update(res_refs)
+    patch_entries = [get_patch_entry(res_ref, paths) for res_ref, paths in patches.items()
+                     if res_ref not in deleted_refs]
+    dependent_entries = [get_delete_entry(res_ref) for res_ref in dependent_refs]
+    target_entries = [get_delete_entry(res_ref) for res_type in target_refs
+                      for res_ref in dict.fromkeys(target_refs[res_type])
+                      if res_ref not in dependent_refs]
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      for entries in (patch_entries, dependent_entries, target_entries):
+        if entries:
+          self._send_chunks(executor, [entries[i:i + self.bundle_size]
+                                       for i in range(0, len(entries), self.bundle_size)])
+    self.logger.info(f"Canceled FHIR resources were deleted from FHIR server "
+                     f"({len(patch_entries)} patched, "
+                     f"{len(dependent_entries) + len(target_entries)} deleted)")
+
+# helper functions
+def get_cluster_key(resource):
+  '''Return the reference of the encounter a FHIR resource belongs to or its
+     own reference if it is not linked to an encounter'''
+  if resource['resourceType'] == 'Encounter':
+    if 'partOf' in resource:
+      return resource['partOf'].get('reference')
+    return f"Encounter/{resource['id']}"
+  for enc_field in ('encounter', 'context'):
+    if enc_field in resource and resource[enc_field].get('reference'):
+      return resource[enc_field]['reference']
+  return f"{resource['resourceType']}/{resource['id']}"
+
+def get_cluster_rank(entry):
+  resource = entry['resource']
+  rank = CLUSTER_RES_ORDER.get(resource['resourceType'], len(CLUSTER_RES_ORDER))
+  # main encounters before sub encounters
+  return (rank, 'partOf' in resource)
+
+def get_patch_entry(res_ref, paths):
+  '''Return bundle entry replacing the references at the FHIRPaths paths of
+     a resource by {"display": "UNKNOWN"}'''
+  parameters = [{"name": "operation",
+                 "part": [{"name": "type", "valueCode": "replace"},
+                          {"name": "path", "valueString": path},
+                          {"name": "value", "valueReference": {"display": "UNKNOWN"}}]}
+                for path in paths]
+  return {"resource": {"resourceType": "Parameters", "parameter": parameters},
+          "request": {"method": "PATCH", "url": res_ref}}
+
+def get_delete_entry(res_ref):
+  return {"request": {"method": "DELETE", "url": res_ref}}
+
+def get_failed_batch_entries(entries, response_bundle):
+  '''Return the entries of a batch bundle whose response status is not 2xx'''
+  failed_entries = []
+  for entry, response_entry in zip(entries, response_bundle.get('entry', [])):
+    status = response_entry.get('response', {}).get('status', '')
+    if not status.startswith('2'):
+      failed_entries.append(entry)
+  return failed_entries
+
+def iter_bundle_json(bundle):
+  '''Serialize bundle to JSON entry by entry'''
+  yield json_codec.dumps({key: value for key, value in bundle.items()
+                          if key != 'entry'})[:-1]
+  yield b',"entry":['
+  for i, entry in enumerate(bundle.get('entry', [])):
+    yield b',' + json_codec.dumps(entry) if i else json_codec.dumps(entry)
+  yield b']}'
+
+def iter_gzip_bundle(bundle, chunk_size=GZIP_CHUNK_SIZE):
+  '''Serialize bundle to JSON and yield it gzip compressed in chunks of about
+     chunk_size bytes without building the whole JSON document in memory'''
+  compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+  buffer = []
+  buffer_size = 0
+  for json_part in iter_bundle_json(bundle):
+    buffer.append(compressor.compress(json_part))
+    buffer_size += len(buffer[-1])
+    if buffer_size >= chunk_size:
+      yield b''.join(buffer)
+      buffer = []
+      buffer_size = 0
+  buffer.append(compressor.flush())
+  yield b''.join(buffer)
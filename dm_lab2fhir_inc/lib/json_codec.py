@@ -0,0 +1,62 @@
+#!/usr/bin/python3.6
+
+'''Serialize FHIR resources/ bundles to JSON using orjson if it is
+   installed and the json module of the standard library otherwise; numpy
+   scalars (e.g. values taken from DataFrames) are serialized as the
+   corresponding Python values by both backends
+   Arguments: none
+   Returns: none
+   Date: 10-19-2026'''
+
+import json
+import numpy as np
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+BACKEND = 'orjson' if orjson else 'json'
+
+def _default(obj):
+  if isinstance(obj, np.generic):
+    return obj.item()
+  raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+if orjson:
+  def dumps(obj):
+    '''Return compact UTF-8 encoded JSON as bytes'''
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+  def dumps_canonical(obj):
+    '''Return canonical JSON (sorted keys, no whitespace) as bytes'''
+    return orjson.dumps(obj, default=_default,
+                        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+
+  def dumps_pretty(obj):
+    return orjson.dumps(obj, default=_default,
+                        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2).decode('utf-8')
+
+  def loads(data):
+    return orjson.loads(data)
+else:
+  def dumps(obj):
+    '''Return compact UTF-8 encoded JSON as bytes'''
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                      default=_default).encode('utf-8')
+
+  def dumps_canonical(obj):
+    '''Return canonical JSON (sorted keys, no whitespace) as bytes'''
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False, default=_default).encode('utf-8')
+
+  def dumps_pretty(obj):
+    return json.dumps(obj, indent=2, ensure_ascii=False, default=_default)
+
+  def loads(data):
+    return json.loads(data)
+
+def dumps_str(obj):
+  '''Return compact JSON as str, e.g. as parameter for psycopg2 which would
+     adapt bytes as bytea'''
+  return dumps(obj).decode('utf-8')
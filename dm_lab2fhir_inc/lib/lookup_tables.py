@@ -0,0 +1,133 @@
+#!/usr/bin/python3.6
+
+'''Build dict indexes of the mapping and code tables (OPS code -> drug,
+   substance -> UNII/ASK/CAS, admission/discharge reasons, departments,
+   lufu parameters)
+   once per job, so that the mappers look up a record instead of filtering
+   the DataFrame for every procedure, encounter or lufu value
+   Arguments: DataFrames of the mapping/code tables
+   Returns: dict indexes
+   Date: 10-19-2026'''
+
+from collections import namedtuple
+from types import MappingProxyType
+import pandas as pd
+
+OPSDrug = namedtuple('OPSDrug', ['name', 'atc', 'text', 'ucum_short', 'ucum_full',
+                                 'dosage_min', 'dosage_max', 'combi'])
+
+Substance = namedtuple('Substance', ['unii', 'ask', 'cas'])
+
+LuFuParameter = namedtuple('LuFuParameter', ['loinc', 'loinc_display', 'i2b2', 'unit'])
+
+LuFuProcedure = namedtuple('LuFuProcedure', ['snomed', 'snomed_display'])
+
+# Value as formerly rendered by Series.to_string, missing values as 'NaN'
+def _to_str(value):
+  return 'NaN' if pd.isna(value) else str(value)
+
+# Index ops_med_mapping.csv by OPS code; for duplicate codes the first row is
+# kept
+def build_ops_drug_index(ops_drug_mapping):
+  index = {}
+  columns = ['ops_code', 'medication', 'atc_code1', 'text', 'ucum_short', 'ucum_full',
+             'dosage_min', 'dosage_max', 'medication_combi']
+  for row in ops_drug_mapping[columns].itertuples(index=False):
+    if row.ops_code in index:
+      continue
+    index[row.ops_code] = OPSDrug(_to_str(row.medication), _to_str(row.atc_code1),
+                                  _to_str(row.text), _to_str(row.ucum_short),
+                                  _to_str(row.ucum_full), _to_str(row.dosage_min),
+                                  _to_str(row.dosage_max),
+                                  not pd.isna(row.medication_combi))
+  return index
+
+# Index alleSubstanzenMapping.csv by the substance named in the OPS code
+def build_substance_index(drug_unii_mapping):
+  index = {}
+  columns = ['Substanzangabe_aus_OPS-Code', 'Substanz_fuer_Dosisberechnung_UNII-number',
+             'Substanz_fuer_Dosisberechnung_ASK-Nr', 'Substanz_fuer_Dosisberechnung_CAS-Nummer']
+  for substance, unii, ask, cas in drug_unii_mapping[columns].itertuples(index=False):
+    if substance in index:
+      continue
+    index[substance] = Substance(_to_str(unii), _to_str(ask), _to_str(cas))
+  return index
+
+# Read-only dict of a code table with integer codes
+def _build_code_index(code_table, *columns):
+  if len(columns) == 1:
+    values = code_table[columns[0]].tolist()
+  else:
+    values = zip(*(code_table[column].tolist() for column in columns))
+  return MappingProxyType(dict(zip(code_table['code'].astype(int).tolist(), values)))
+
+class TerminologyLookup:
+  '''Displays of admission reasons, discharge reasons and department codes
+     (dat/*.csv); the display composed for a full code is memoized'''
+
+  def __init__(self, admission_1_2, admission_3_4, discharge_1_2, discharge_3, departments):
+    self.admission_1_2 = _build_code_index(admission_1_2, 'admissionDisplay')
+    self.admission_3_4 = _build_code_index(admission_3_4, 'admissionDisplay')
+    self.discharge_1_2 = _build_code_index(discharge_1_2, 'dischargeDisplay',
+                                           'dischargeDispositionCode',
+                                           'dischargeDispositionDisplay')
+    self.discharge_3 = _build_code_index(discharge_3, 'dischargeDisplay')
+    self.departments = _build_code_index(departments, 'dep_name')
+    self._admission_cache = {}
+    self._discharge_cache = {}
+    self._department_cache = {}
+
+  # Display of admission reason, e.g. '0101' -> 'Krankenhausbehandlung
+  # vollstationär - Normalfall'
+  def admission_display(self, code):
+    if code not in self._admission_cache:
+      parts = [self.admission_1_2.get(int(code[:2])), self.admission_3_4.get(int(code[2:4]))]
+      self._admission_cache[code] = ' - '.join(part for part in parts if part) or None
+    return self._admission_cache[code]
+
+  # Display, discharge disposition code and display of discharge reason
+  def discharge_display(self, code):
+    if code not in self._discharge_cache:
+      display, dispo_code, dispo_display = self.discharge_1_2.get(int(code[:2]),
+                                                                  (None, None, None))
+      parts = [display, self.discharge_3.get(int(code[2]))]
+      self._discharge_cache[code] = (' - '.join(part for part in parts if part) or None,
+                                     dispo_code, dispo_display)
+    return self._discharge_cache[code]
+
+  def department_name(self, code):
+    if code not in self._department_cache:
+      self._department_cache[code] = self.departments.get(int(code))
+    return self._department_cache[code]
+
+# First unit per code of the cosyconet mapping table
+def _build_unit_index(lufu_loinc_mapping, code_column):
+  codes = lufu_loinc_mapping[[code_column, 'Unit']].dropna(subset=[code_column])
+  return dict(codes.drop_duplicates(code_column).itertuples(index=False))
+
+# Merge LOINC code and display, i2b2 base code and unit (taken from the
+# cosyconet mapping table) per lufu parameter, e.g. 'SP_PRE_bp_vc_actual'
+def build_lufu_parameter_index(logger, loinc_mapper, i2b2_mapper, lufu_loinc_mapping):
+  loinc_units = _build_unit_index(lufu_loinc_mapping, 'RELMA')
+  i2b2_units = _build_unit_index(lufu_loinc_mapping, 'I2B2 Basecode')
+  index = {}
+  for parameter in list(loinc_mapper.umm_loinc_map) + list(i2b2_mapper.umm_i2b2_map):
+    if parameter in index:
+      continue
+    loinc_code = loinc_mapper.codeLookup(parameter)
+    i2b2_code = i2b2_mapper.codeLookup(parameter)
+    unit = None
+    if loinc_code != 'No Code':
+      unit = loinc_units.get(loinc_code)
+    if i2b2_code != 'No Code':
+      unit = i2b2_units.get(i2b2_code)
+    if unit is None:
+      logger.warning(f"No unit found for lufu parameter {parameter}")
+    index[parameter] = LuFuParameter(loinc_code, loinc_mapper.displayLookup(loinc_code),
+                                     i2b2_code, unit)
+  return index
+
+# SNOMED code and display per lufu procedure, e.g. 'SP_PRE'
+def build_lufu_procedure_index(snomed_mapper):
+  return {procedure: LuFuProcedure(code, snomed_mapper.displayLookup(code))
+          for procedure, code in snomed_mapper.umm_snomed_map.items()}
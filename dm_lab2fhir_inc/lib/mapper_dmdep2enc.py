@@ -13,6 +13,7 @@ from datetime import datetime
 from lib.mii_profiles import (mii_coding, mii_codeableconcept, mii_encounter_abfall,
                               identifier, mii_period, fhirdate, fhirreference, meta,
                               location)
+from lib import fhir_constants
 from lib.mii_profiles.fhirabstractbase import FHIRValidationError
 
 #from fhirclient.models import (fhirdate, fhirreference, meta)
@@ -46,12 +47,7 @@ class MapperDMDep2Enc:
     self.data['concat_elements'] = ''.join(concat_elements)
 
   def _dep_name_lookup(self, code):
-    df1 = self.map_table
-
-    record1 = df1.loc[df1['code'] == int(code)]
-    result = record1['dep_name'].to_string(index=False)
-
-    return result
+    return self.map_table.department_name(code)
 
   def map(self):
     try:
@@ -63,10 +59,7 @@ class MapperDMDep2Enc:
                                                          "system": self.systems['subencounter_id'],
                                                          "value": id_value})]
       sub_encounter.status = "in-progress"
-      enc_class_system = "http://terminology.hl7.org/CodeSystem/v3-ActCode"
-      sub_encounter.class_fhir = mii_coding.Coding({"system": enc_class_system,
-                                                "code": "IMP",
-                                                "display": "inpatient encounter"})
+      sub_encounter.class_fhir = fhir_constants.ENCOUNTER_CLASS_IMP
       ref = {"reference": f"Patient/{self.data['patient_psn']}"}
       sub_encounter.subject = fhirreference.FHIRReference(jsondict=ref)
       ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
@@ -81,17 +74,13 @@ class MapperDMDep2Enc:
       sub_encounter.serviceType = service_type
 
       enc_period = mii_period.Period()
-      enc_period.start = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                             '%Y-%m-%dT%H:%M:%S'))
+      enc_period.start = fhirdate.FHIRDate.from_datetime(self.data['admission_dt'])
       if not pd.isna(self.data['discharge_dt']):
         sub_encounter.status = "finished"
-        enc_period.end = fhirdate.FHIRDate(datetime.strftime(self.data['discharge_dt'],
-                                                             '%Y-%m-%dT%H:%M:%S'))
+        enc_period.end = fhirdate.FHIRDate.from_datetime(self.data['discharge_dt'])
       sub_encounter.period = enc_period
 
-      enc_meta = meta.Meta()
-      enc_meta.source = "#sap-ish"
-      sub_encounter.meta = enc_meta
+      sub_encounter.meta = fhir_constants.META_SAP_ISH
 
       sub_encounter.location = []
       location_list = []
@@ -111,12 +100,10 @@ class MapperDMDep2Enc:
         loc = mii_encounter_abfall.EncounterLocation()
         loc.status = 'active'
         loc_period = mii_period.Period()
-        loc_period.start = fhirdate.FHIRDate(datetime.strftime(loc_am_ts,
-                                                               '%Y-%m-%dT%H:%M:%S'))
+        loc_period.start = fhirdate.FHIRDate.from_datetime(loc_am_ts)
         if not pd.isna(loc_dc_ts):
           loc.status = "completed"
-          loc_period.end = fhirdate.FHIRDate(datetime.strftime(loc_dc_ts,
-                                                             '%Y-%m-%dT%H:%M:%S'))
+          loc_period.end = fhirdate.FHIRDate.from_datetime(loc_dc_ts)
         loc.period = loc_period
         ref = {"reference": f"Location/{id_value}"}
         loc.location = fhirreference.FHIRReference(jsondict=ref)
@@ -13,6 +13,8 @@ import pandas as pd
 from datetime import datetime
 from lib.mii_profiles import (mii_codeableconcept, mii_coding, mii_condition, coding, codeableconcept,
                               extension, fhirdate, fhirreference, identifier, meta)
+from lib import fhir_constants, fhir_datetime
+from lib.fhir_template import Field, ResourceTemplate, Section
 
 class MapperDMDiag2Cond:
   '''Map diagnosis table of datamart to FHIR resources of type
@@ -22,6 +24,40 @@ class MapperDMDiag2Cond:
     self.logger = logger
     self.systems = systems
     self.data = {}
+    icd_sys = "http://fhir.de/CodeSystem/dimdi/icd-10-gm"
+    icd_ext_sys = "http://fhir.de/StructureDefinition/icd-10-gm-"
+    icd_loc_sys = "http://fhir.de/CodeSystem/kbv/s_icd_seitenlokalisation"
+    self.template = ResourceTemplate(mii_condition.Condition, {
+      "id": Field('id'),
+      "identifier": [{"system": systems['condition_id'], "value": Field('id')}],
+      "clinicalStatus": {"coding": [{
+        "system": "http://terminology.hl7.org/CodeSystem/condition-clinical",
+        "code": "active"}]},
+      "code": {"coding": [{
+        "system": icd_sys,
+        "code": Field('full_code'),
+        "version": Field('code_ver'),
+        "extension": [
+          Section('has_sec_code', {"url": f"{icd_ext_sys}haupt-kreuz",
+                                   "valueCoding": {"system": icd_sys,
+                                                   "version": Field('code_ver'),
+                                                   "code": Field('main_code')}}),
+          Section('has_excl', {"url": f"{icd_ext_sys}ausrufezeichen",
+                               "valueCoding": {"system": icd_sys,
+                                               "version": Field('code_ver'),
+                                               "code": Field('excl_code')}}),
+          Section('has_star', {"url": f"{icd_ext_sys}stern",
+                               "valueCoding": {"system": icd_sys,
+                                               "version": Field('code_ver'),
+                                               "code": Field('star_code')}})]}]},
+      "onsetString": '2002-01-01',
+      "encounter": {"reference": Field('encounter_ref')},
+      "subject": {"reference": Field('patient_ref')},
+      "recordedDate": Field('recorded'),
+      "bodySite": [
+        Section('left', {"coding": [{"system": icd_loc_sys, "code": "L", "display": "links"}]}),
+        Section('right', {"coding": [{"system": icd_loc_sys, "code": "R", "display": "rechts"}]})],
+      "meta": fhir_constants.META_SAP_ISH})
 
   def read(self, encounter_psn, patient_psn, db_record, logger):
     self.data['encounter_psn'] = encounter_psn
@@ -44,10 +80,42 @@ class MapperDMDiag2Cond:
     #  concat_elements.append(str(value))
     #self.data['concat_elements'] = ''.join(concat_elements)
 
+  # Variable values of the condition, shared by map and map_template
+  def _get_values(self):
+    values = {'id': str(self.data['encounter_psn']) + '_' + str(self.data['diagnosis_nr']),
+              'encounter_ref': f"Encounter/{self.data['encounter_psn']}",
+              'patient_ref': f"Patient/{self.data['patient_psn']}",
+              'full_code': self.data['code'], 'code_ver': self.data['code_ver'],
+              'has_sec_code': False, 'has_excl': False, 'has_star': False,
+              'left': False, 'right': False}
+    #sha256(self.data['concat_elements'].encode('utf-8')).hexdigest()
+
+    if self.data['sec_code']:
+      values['full_code'] = self.data['code'] + " " + self.data['sec_code']
+      values['has_sec_code'] = True
+      values['main_code'] = re.sub(r"[+†]", "", self.data['code'])
+      if '!' in self.data['sec_code']:
+        values['has_excl'] = True
+        values['excl_code'] = re.sub(r"!", "", self.data['sec_code'])
+      if '*' in self.data['sec_code']:
+        values['has_star'] = True
+        values['star_code'] = re.sub(r"\*", "", self.data['sec_code'])
+
+    values['recorded'] = fhir_datetime.format_datetime(self.data['admission_dt'])
+
+    if self.data['loc']:
+      values['left'] = self.data['loc'] == "L" or self.data['loc'] == "B"
+      values['right'] = self.data['loc'] == "R" or self.data['loc'] == "B"
+
+    values['rank'] = 2
+    if self.data['diag_type'] == 1:
+      values['rank'] = 1
+    return values
+
   def map(self):
     try:
-      id_value = str(self.data['encounter_psn']) + '_' + str(self.data['diagnosis_nr'])
-      #sha256(self.data['concat_elements'].encode('utf-8')).hexdigest()
+      values = self._get_values()
+      id_value = values['id']
 
       icd_condition = mii_condition.Condition()
       icd_condition.id = id_value
@@ -59,36 +127,33 @@ class MapperDMDiag2Cond:
                                                 "code":"active"})]
       icd_condition.clinicalStatus = clinic_status
 
-      full_code = self.data['code']
-      if self.data['sec_code']:
-        full_code = self.data['code'] + " " + self.data['sec_code']
       condition_coding = mii_coding.Coding()
       condition_coding.system = "http://fhir.de/CodeSystem/dimdi/icd-10-gm"
-      condition_coding.code = full_code
-      condition_coding.version = self.data['code_ver']
+      condition_coding.code = values['full_code']
+      condition_coding.version = values['code_ver']
 
-      if self.data['sec_code']:
+      if values['has_sec_code']:
         main_cross_ext = extension.Extension()
         main_cross_ext.url = "http://fhir.de/StructureDefinition/icd-10-gm-haupt-kreuz"
         main_cross_ext.valueCoding = coding.Coding({"system": condition_coding.system,
-                                                    "version": self.data['code_ver'],
-                                                    "code": re.sub(r"[+†]", "", self.data['code'])})
+                                                    "version": values['code_ver'],
+                                                    "code": values['main_code']})
         condition_coding.extension = [main_cross_ext]
 
-        if '!' in self.data['sec_code']:
+        if values['has_excl']:
           excl_ext = extension.Extension()
           excl_ext.url = "http://fhir.de/StructureDefinition/icd-10-gm-ausrufezeichen"
           excl_ext.valueCoding = coding.Coding({"system": condition_coding.system,
-                                                "version": self.data['code_ver'],
-                                                "code": re.sub(r"!", "", self.data['sec_code'])})
+                                                "version": values['code_ver'],
+                                                "code": values['excl_code']})
           condition_coding.extension.append(excl_ext)
 
-        if '*' in self.data['sec_code']:
+        if values['has_star']:
           star_ext = extension.Extension()
           star_ext.url = "http://fhir.de/StructureDefinition/icd-10-gm-stern"
           star_ext.valueCoding = coding.Coding({"system": condition_coding.system,
-                                                "version": self.data['code_ver'],
-                                                "code": re.sub(r"\*", "", self.data['sec_code'])})
+                                                "version": values['code_ver'],
+                                                "code": values['star_code']})
           condition_coding.extension.append(star_ext)
 
       condition_code = mii_codeableconcept.CodeableConcept()
@@ -98,18 +163,17 @@ class MapperDMDiag2Cond:
       # todo: what value of the data mart should be mapped?
       icd_condition.onsetString = '2002-01-01'
 
-      ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
+      ref = {"reference": values['encounter_ref']}
       icd_condition.encounter = fhirreference.FHIRReference(jsondict=ref)
-      ref = {"reference": f"Patient/{self.data['patient_psn']}"}
+      ref = {"reference": values['patient_ref']}
       icd_condition.subject = fhirreference.FHIRReference(jsondict=ref)
 
-      if not pd.isna(self.data['admission_dt']):
-        icd_condition.recordedDate = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                                       '%Y-%m-%dT%H:%M:%S'))
+      if values['recorded']:
+        icd_condition.recordedDate = fhirdate.FHIRDate(values['recorded'])
 
       if self.data['loc']:
         icd_condition.bodySite = []
-        if self.data['loc'] == "L" or self.data['loc'] == "B":
+        if values['left']:
           left_body_part = mii_codeableconcept.CodeableConcept()
           icd_loc_sys = "http://fhir.de/CodeSystem/kbv/s_icd_seitenlokalisation"
           left_body_part.coding = [mii_coding.Coding({"system": icd_loc_sys,
@@ -117,7 +181,7 @@ class MapperDMDiag2Cond:
                                                   "display": "links"})]
           icd_condition.bodySite.append(left_body_part)
 
-        if self.data['loc'] == "R" or self.data['loc'] == "B":
+        if values['right']:
           right_body_part = mii_codeableconcept.CodeableConcept()
           icd_loc_sys = "http://fhir.de/CodeSystem/kbv/s_icd_seitenlokalisation"
           right_body_part.coding = [mii_coding.Coding({"system": icd_loc_sys,
@@ -125,13 +189,9 @@ class MapperDMDiag2Cond:
                                                    "display": "rechts"})]
           icd_condition.bodySite.append(right_body_part)
 
-      rank = 2
-      if self.data['diag_type'] == 1:
-        rank = 1
+      rank = values['rank']
 
-      icd_meta = meta.Meta()
-      icd_meta.source = "#sap-ish"
-      icd_condition.meta = icd_meta
+      icd_condition.meta = fhir_constants.META_SAP_ISH
 
       return [icd_condition, rank]
 
@@ -141,3 +201,12 @@ class MapperDMDiag2Cond:
     #except Exception as exc:
     #  self.logger.error(f"In {__name__}: Error occurred in mapping ({exc})")
     #  raise
+
+  # Same resource as map, filled into the template; validated by as_json
+  def map_template(self):
+    try:
+      values = self._get_values()
+      return [self.template.create(values), values['rank']]
+    except KeyError as exc:
+      self.logger.error(f"In {__name__}: Key {exc} not found in dictionary")
+      raise
@@ -12,6 +12,7 @@ from datetime import datetime
 from lib.mii_profiles import (mii_codeableconcept, mii_coding, mii_encounter_verfall,
                               extension, fhirdate, fhirreference, mii_identifier,
                               mii_period, meta)
+from lib import fhir_constants
 
 class MapperDMEnc2Enc:
   '''Map encounter table of datamart to FHIR resources of type
@@ -33,65 +34,31 @@ class MapperDMEnc2Enc:
     self.data['discharge_dt'] = db_record.discharge_timestamp
 
   def _admission_reason_lookup(self, code):
-    df1 = self.map_table[0]
-    df2 = self.map_table[1]
-
-    record1 = df1.loc[df1['code'] == int(code[:2])]
-    element1 = record1['admissionDisplay'].to_string(index=False)
-    record2 = df2.loc[df2['code'] == int(code[2:4])]
-    element2 = record2['admissionDisplay'].to_string(index=False)
-    text = element1[1:]+' -'+element2
-
-    result = []
-    result.append(text)
-
-    return result
+    return [self.map_table.admission_display(code)]
 
   def _discharge_reason_lookup(self, code):
-    df1 = self.map_table[2]
-    df2 = self.map_table[3]
-
-    record1 = df1.loc[df1['code'] == int(code[:2])]
-    element1 = record1['dischargeDisplay'].to_string(index=False)
-    record2 = df2.loc[df2['code'] == int(code[2])]
-    element2 = record2['dischargeDisplay'].to_string(index=False)
-    text = element1[1:]+' -'+element2
-
-    result = []
-    result.append(text)
-    result.append(record1['dischargeDispositionCode'].to_string(index=False))
-    result.append(record1['dischargeDispositionDisplay'].to_string(index=False))
-
-    return result
+    return list(self.map_table.discharge_display(code))
 
   def map(self):
     try:
       pat_encounter = mii_encounter_verfall.Encounter()
       pat_encounter.id = self.data['encounter_psn']
-      identifier_type = mii_codeableconcept.CodeableConcept()
-      identifier_type.coding = [mii_coding.Coding({"system": "http://terminology.hl7.org/CodeSystem/v2-0203",
-                                                   "code": "VN"})]
       pat_encounter.identifier = [mii_identifier.Identifier({"use": "usual",
                                                          "system": self.systems['encounter_id'],
                                                          "value": self.data['encounter_psn'],
                                                          "assigner":{"reference":"Organization/1111"},
-                                                         "type": identifier_type.as_json()})]
-      enc_class_system = "http://terminology.hl7.org/CodeSystem/v3-ActCode"
-      pat_encounter.class_fhir = mii_coding.Coding({"system": enc_class_system,
-                                                    "code": "IMP",
-                                                    "display": "inpatient encounter"})
+                                                         "type": fhir_constants.IDENTIFIER_TYPE_VN.as_json()})]
+      pat_encounter.class_fhir = fhir_constants.ENCOUNTER_CLASS_IMP
       ref = {"reference": f"Patient/{self.data['patient_psn']}"}
       pat_encounter.subject = fhirreference.FHIRReference(jsondict=ref)
 
       enc_period = mii_period.Period()
       pat_encounter.status = "in-progress"
       if not pd.isna(self.data['admission_dt']):
-        enc_period.start = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
+        enc_period.start = fhirdate.FHIRDate.from_datetime(self.data['admission_dt'])
         pat_encounter.period = enc_period
       if not pd.isna(self.data['discharge_dt']):
-        enc_period.end = fhirdate.FHIRDate(datetime.strftime(self.data['discharge_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
+        enc_period.end = fhirdate.FHIRDate.from_datetime(self.data['discharge_dt'])
         pat_encounter.status = "finished"
 
       pat_encounter.extension = []
@@ -138,9 +105,7 @@ class MapperDMEnc2Enc:
           cond_diagnosis.use = diagnosis_use
           pat_encounter.diagnosis.append(cond_diagnosis)
 
-      enc_meta = meta.Meta()
-      enc_meta.source = "#sap-ish"
-      pat_encounter.meta = enc_meta
+      pat_encounter.meta = fhir_constants.META_SAP_ISH
 
       return pat_encounter
 
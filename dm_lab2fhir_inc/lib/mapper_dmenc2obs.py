@@ -13,6 +13,8 @@ from lib.mii_profiles.fhirabstractbase import FHIRValidationError
 from lib.mii_profiles import (miracum_codeableconcept, codeableconcept, miracum_coding, coding,
                               fhirreference, identifier, miracum_observation, period,
                               miracum_quantity, meta, fhirdate)
+from lib import fhir_constants, fhir_datetime
+from lib.fhir_template import Field, ResourceTemplate, Section
 
 class MapperDMEnc2Obs:
   '''Map encounter table of datamart to FHIR resources of type
@@ -22,6 +24,20 @@ class MapperDMEnc2Obs:
     self.logger = logger
     self.systems = systems
     self.data = {}
+    self.template = ResourceTemplate(miracum_observation.Observation, {
+      "id": Field('id'),
+      "identifier": [{"system": systems['p21obs_id'], "value": Field('id')}],
+      "encounter": {"reference": Field('encounter_ref')},
+      "subject": {"reference": Field('patient_ref')},
+      "code": {"text": "Days on Ventilator",
+               "coding": [{"system": "http://loinc.org", "code": "74201-5",
+                           "display": "Days on Ventilator"}]},
+      "valueQuantity": Section('vent_days', {"value": Field('vent_days'), "unit": "d",
+                                             "system": "http://unitsofmeasure.org",
+                                             "code": "d"}),
+      "status": Field('status'),
+      "effectivePeriod": {"start": Field('start'), "end": Field('end')},
+      "meta": fhir_constants.META_SAP_ISH})
 
   def read(self, encounter_psn, patient_psn, db_record):
     self.data['encounter_psn'] = encounter_psn
@@ -33,34 +49,46 @@ class MapperDMEnc2Obs:
     self.data['admission_dt'] = db_record.admission_timestamp
     self.data['discharge_dt'] = db_record.discharge_timestamp
 
+  # Variable values of the ventilation observation, shared by map and
+  # map_template
+  def _get_values(self):
+    values = {'id': f"{self.data['encounter_psn']}-vent",
+              'encounter_ref': f"Encounter/{self.data['encounter_psn']}",
+              'patient_ref': f"Patient/{self.data['patient_psn']}",
+              'status': "preliminary", 'end': None,
+              'vent_days': self.data['vent_days']}
+    values['start'] = fhir_datetime.format_datetime(self.data['admission_dt'])
+    if values['start']:
+      values['end'] = fhir_datetime.format_datetime(self.data['discharge_dt'])
+      if values['end']:
+        values['status'] = "final"
+    return values
+
   def map(self):
     try:
-      obs_status = "preliminary"
-      obs_meta = meta.Meta()
-      obs_meta.source = "#sap-ish"
+      values = self._get_values()
+      obs_status = values['status']
+      obs_meta = fhir_constants.META_SAP_ISH
 
       start_dt = None
       end_dt = None
-      if not pd.isna(self.data['admission_dt']):
-        start_dt = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
-        if not pd.isna(self.data['discharge_dt']):
-          end_dt = fhirdate.FHIRDate(datetime.strftime(self.data['discharge_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
-          obs_status = "final"
+      if values['start']:
+        start_dt = fhirdate.FHIRDate(values['start'])
+      if values['end']:
+        end_dt = fhirdate.FHIRDate(values['end'])
       obs_period = period.Period()
       obs_period.start = start_dt
       obs_period.end = end_dt
 
-      id_value = f"{self.data['encounter_psn']}-vent"
+      id_value = values['id']
       vent_observation = miracum_observation.Observation()
       vent_observation.id = id_value
       vent_observation.identifier = [identifier.Identifier({"system": self.systems['p21obs_id'],
                                                             "value": id_value})]
 
-      ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
+      ref = {"reference": values['encounter_ref']}
       vent_observation.encounter = fhirreference.FHIRReference(jsondict=ref)
-      ref = {"reference": f"Patient/{self.data['patient_psn']}"}
+      ref = {"reference": values['patient_ref']}
       vent_observation.subject = fhirreference.FHIRReference(jsondict=ref)
 
       ventilation_code = miracum_codeableconcept.CodeableConcept()
@@ -69,9 +97,9 @@ class MapperDMEnc2Obs:
                                                         "code": "74201-5",
                                                         "display": "Days on Ventilator"})]
       vent_observation.code = ventilation_code
-      if self.data['vent_days']:
+      if values['vent_days']:
         vent_observation.valueQuantity = miracum_quantity.Quantity({
-                                                          "value": self.data['vent_days'],
+                                                          "value": values['vent_days'],
                                                           "unit": "d",
                                                           "system": "http://unitsofmeasure.org",
                                                           "code": "d"})
@@ -89,3 +117,11 @@ class MapperDMEnc2Obs:
     #except Exception as exc:
     #  self.logger.error(f"In {__name__}: Error occurred in mapping ({exc})")
     #  raise
+
+  # Same resource as map, filled into the template; validated by as_json
+  def map_template(self):
+    try:
+      return self.template.create(self._get_values())
+    except KeyError as exc:
+      self.logger.error(f"In {__name__}: Key {exc} not found in dictionary")
+      raise
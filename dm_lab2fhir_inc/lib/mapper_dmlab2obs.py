@@ -17,6 +17,8 @@ from lib.mii_profiles import (codeableconcept, mii_codeableconcept, coding,
                               mii_coding, fhirdate, fhirreference,
                               mii_identifier, mii_observation, quantity,
                               mii_quantity, meta)
+from lib import fhir_constants, fhir_datetime
+from lib.fhir_template import Field, ResourceTemplate, Section
 from urllib3.exceptions import HTTPError
 
 class MapperDMLab2Obs:
@@ -27,6 +29,36 @@ class MapperDMLab2Obs:
     self.systems = systems
     self.data = {}
     self.loinc_url = loinc_url
+    unit_system = "http://unitsofmeasure.org"
+    self.template = ResourceTemplate(mii_observation.Observation, {
+      "id": Field('id'),
+      "identifier": [{"system": systems['lab_id'],
+                      "value": Field('id'),
+                      "assigner": {"reference": "Organization/1111"},
+                      "type": fhir_constants.IDENTIFIER_TYPE_MR.as_json()}],
+      "encounter": {"reference": Field('encounter_ref')},
+      "subject": {"reference": Field('patient_ref')},
+      "status": "final",
+      "effectiveDateTime": Field('effective'),
+      "valueQuantity": Section('has_quantity', {"value": Field('value'),
+                                                "unit": Field('unit'),
+                                                "comparator": Field('comparator'),
+                                                "system": unit_system,
+                                                "code": Field('unit')}),
+      "valueString": Field('value_string'),
+      "code": {"coding": [{"system": "http://loinc.org", "code": Field('loinc_code')}]},
+      "referenceRange": [Section('has_reference_range', {
+        "high": {"value": Field('ref_high'), "unit": Field('unit'), "system": unit_system,
+                 "code": Field('unit')},
+        "low": {"value": Field('ref_low'), "unit": Field('unit'), "system": unit_system,
+                "code": Field('unit')}})],
+      "method": {"coding": [{"system": "http://methodConcept", "display": Field('method')}]},
+      "meta": fhir_constants.META_LABORATORY,
+      "category": fhir_constants.OBSERVATION_CATEGORY_LABORATORY,
+      "interpretation": [Section('int_flag', {"coding": [{
+        "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
+        "code": Field('int_flag'),
+        "display": Field('int_display')}]})]})
 
   def read(self, encounter_psn, patient_psn, db_record):
     self.data['encounter_psn'] = encounter_psn
@@ -69,123 +101,139 @@ class MapperDMLab2Obs:
       self.logger.error(f"In {__name__}: Response: {response.json()}")
       raise
 
+  # Variable values of the lab observation, shared by map and map_template
+  def _get_values(self):
+    values = {'id': str(self.data['result_id']),
+              'encounter_ref': f"Encounter/{self.data['encounter_psn']}",
+              'patient_ref': f"Patient/{self.data['patient_psn']}",
+              'has_quantity': False, 'value': None, 'comparator': None,
+              'value_string': None}
+    #2sha256(self.data['concat_elements'].encode('utf-8')).hexdigest()
+
+    values['effective'] = fhir_datetime.format_datetime(self.data['collect_ts'])
+
+    if not pd.isna(self.data['value_num']):
+      if (self.data['loinc_code'] and self.data['loinc_code'] != 'noLoinc' and
+          self.data['value_unit']):
+        if self.data['value_unit'] == '10E12/L':
+          self.data['value_unit'] = '10*6/uL'
+        elif self.data['value_unit'] == '10E9/L':
+          self.data['value_unit'] = '10*3/uL'
+        elif self.data['value_unit'] == 'mE/l':
+          self.data['value_unit'] = 'm[IU]/L'
+        elif (self.data['value_unit'] == 'ug/l' or
+              self.data['value_unit'] == 'µg/l'):
+          self.data['value_unit'] = 'ng/mL'
+
+        if self.loinc_url:
+          result = self._convert_loinc()
+          #print(f"{self.data['loinc_code']} {self.data['value_num']} {self.data['value_unit']}")
+          #print(result)
+
+          if result and isinstance(result, list) and not 'error' in result[0]:
+            if result[0]['loinc'] and result[0]['value'] and result[0]['unit']:
+              self.data['loinc_code'] = result[0]['loinc']
+              self.data['value_num'] = result[0]['value']
+              self.data['value_unit'] = result[0]['unit']
+              self.data['value_unit'] = self.data['value_unit'].replace("'", "''")
+        #else:
+        #  print(f"{self.data['loinc_code']} {self.data['value_num']} {self.data['value_unit']}")
+        #  print(result)
+
+      if (self.data['value_comp'] == '!=' or self.data['value_comp'] == '=' or
+          self.data['value_comp'] == '=='):
+        self.data['value_comp'] = None
+
+      values['has_quantity'] = True
+      values['value'] = self.data['value_num']
+      values['comparator'] = self.data['value_comp']
+    elif self.data['value_text']:
+      values['value_string'] = self.data['value_text']
+
+    values['unit'] = self.data['value_unit']
+    values['loinc_code'] = self.data['loinc_code']
+    values['has_reference_range'] = (not pd.isna(self.data['ref_high_num']) and
+                                     not pd.isna(self.data['ref_low_num']))
+    values['ref_high'] = self.data['ref_high_num']
+    values['ref_low'] = self.data['ref_low_num']
+    values['method'] = self.data['method']
+
+    values['int_flag'] = self.data['int_flag']
+    if self.data['int_flag'] == "N":
+      values['int_display'] = "Normal"
+    elif self.data['int_flag'] == "L":
+      values['int_display'] = "Low"
+    elif self.data['int_flag'] == "H":
+      values['int_display'] = "High"
+    else:
+      values['int_display'] = "Unknown"
+    return values
+
   def map(self):
     try:
-      id_value = str(self.data['result_id']) #2sha256(self.data['concat_elements'].encode('utf-8')).hexdigest()
+      values = self._get_values()
 
       lab_observation = mii_observation.Observation()
-      lab_observation.id = id_value
-      identifier_type = mii_codeableconcept.CodeableConcept()
-      identifier_type.coding = [mii_coding.Coding({
-                                "system": "http://terminology.hl7.org/CodeSystem/v2-0203",
-                                "code": "MR"})]
+      lab_observation.id = values['id']
       lab_observation.identifier = [mii_identifier.Identifier({
                                      "system": self.systems['lab_id'],
-                                     "value": id_value,
+                                     "value": values['id'],
                                      "assigner":{"reference":"Organization/1111"},
-                                     "type": identifier_type.as_json()})]
-      ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
+                                     "type": fhir_constants.IDENTIFIER_TYPE_MR.as_json()})]
+      ref = {"reference": values['encounter_ref']}
       lab_observation.encounter = fhirreference.FHIRReference(jsondict=ref)
-      ref = {"reference": f"Patient/{self.data['patient_psn']}"}
+      ref = {"reference": values['patient_ref']}
       lab_observation.subject = fhirreference.FHIRReference(jsondict=ref)
       lab_observation.status = "final"
 
-      if not pd.isna(self.data['collect_ts']):
-        collect_ts_fhir = datetime.strftime(self.data['collect_ts'], '%Y-%m-%dT%H:%M:%S')
-        lab_observation.effectiveDateTime = fhirdate.FHIRDate(collect_ts_fhir)
-
-      if not pd.isna(self.data['value_num']):
-        if (self.data['loinc_code'] and self.data['loinc_code'] != 'noLoinc' and
-            self.data['value_unit']):
-          if self.data['value_unit'] == '10E12/L':
-            self.data['value_unit'] = '10*6/uL'
-          elif self.data['value_unit'] == '10E9/L':
-            self.data['value_unit'] = '10*3/uL'
-          elif self.data['value_unit'] == 'mE/l':
-            self.data['value_unit'] = 'm[IU]/L'
-          elif (self.data['value_unit'] == 'ug/l' or
-                self.data['value_unit'] == 'µg/l'):
-            self.data['value_unit'] = 'ng/mL'
-
-          if self.loinc_url:
-            result = self._convert_loinc()
-            #print(f"{self.data['loinc_code']} {self.data['value_num']} {self.data['value_unit']}")
-            #print(result)
-
-            if result and isinstance(result, list) and not 'error' in result[0]:
-              if result[0]['loinc'] and result[0]['value'] and result[0]['unit']:
-                self.data['loinc_code'] = result[0]['loinc']
-                self.data['value_num'] = result[0]['value']
-                self.data['value_unit'] = result[0]['unit']
-                self.data['value_unit'] = self.data['value_unit'].replace("'", "''")
-          #else:
-          #  print(f"{self.data['loinc_code']} {self.data['value_num']} {self.data['value_unit']}")
-          #  print(result)
-
-        if (self.data['value_comp'] == '!=' or self.data['value_comp'] == '=' or
-            self.data['value_comp'] == '=='):
-          self.data['value_comp'] = None
-
-        lab_quantity = mii_quantity.Quantity({"value": self.data['value_num'],
-                                              "unit": self.data['value_unit'],
-                                              "comparator": self.data['value_comp'],
+      if values['effective']:
+        lab_observation.effectiveDateTime = fhirdate.FHIRDate(values['effective'])
+
+      if values['has_quantity']:
+        lab_quantity = mii_quantity.Quantity({"value": values['value'],
+                                              "unit": values['unit'],
+                                              "comparator": values['comparator'],
                                               "system": "http://unitsofmeasure.org",
-                                              "code": self.data['value_unit']})
+                                              "code": values['unit']})
         lab_observation.valueQuantity = lab_quantity
-      elif self.data['value_text']:
-        lab_observation.valueString = self.data['value_text']
+      elif values['value_string']:
+        lab_observation.valueString = values['value_string']
 
       lab_code = codeableconcept.CodeableConcept()
       lab_code.coding = [coding.Coding({"system": "http://loinc.org",
-                                        "code": self.data['loinc_code']})]
+                                        "code": values['loinc_code']})]
       lab_observation.code = lab_code
 
-      if not pd.isna(self.data['ref_high_num']) and not pd.isna(self.data['ref_low_num']):
+      if values['has_reference_range']:
         reference_range = mii_observation.ObservationReferenceRange()
-        reference_range.high = quantity.Quantity({"value": self.data['ref_high_num'],
-                                                  "unit": self.data['value_unit'],
+        reference_range.high = quantity.Quantity({"value": values['ref_high'],
+                                                  "unit": values['unit'],
                                                   "system": "http://unitsofmeasure.org",
-                                                  "code": self.data['value_unit']})
-        reference_range.low = quantity.Quantity({"value": self.data['ref_low_num'],
-                                                 "unit": self.data['value_unit'],
+                                                  "code": values['unit']})
+        reference_range.low = quantity.Quantity({"value": values['ref_low'],
+                                                 "unit": values['unit'],
                                                  "system": "http://unitsofmeasure.org",
-                                                 "code": self.data['value_unit']})
+                                                 "code": values['unit']})
         lab_observation.referenceRange = [reference_range]
 
       lab_method = codeableconcept.CodeableConcept()
       lab_method.coding = [coding.Coding({"system": "http://methodConcept",
-                                          "display": self.data['method']})]
+                                          "display": values['method']})]
       lab_observation.method = lab_method
 
-      lab_meta = meta.Meta()
-      lab_meta.source = "#laboratory"
-      lab_observation.meta = lab_meta
+      lab_observation.meta = fhir_constants.META_LABORATORY
 
-      lab_cat = mii_codeableconcept.CodeableConcept()
-      lab_cat_sys = "http://terminology.hl7.org/CodeSystem/observation-category"
-      lab_cat.coding = [mii_coding.Coding({"system": lab_cat_sys,
-                                       "display": "Laboratory",
-                                       "code": "laboratory"})]
-      lab_observation.category = lab_cat
+      lab_observation.category = fhir_constants.OBSERVATION_CATEGORY_LABORATORY
 
       #lab_annotation = annotation_model.Annotation({"text": note})
       #lab_observation.note = [lab_annotation]
 
-      if self.data['int_flag']:
-        if self.data['int_flag'] == "N":
-          int_flag_long = "Normal"
-        elif self.data['int_flag'] == "L":
-          int_flag_long = "Low"
-        elif self.data['int_flag'] == "H":
-          int_flag_long = "High"
-        else:
-          int_flag_long = "Unknown"
-
+      if values['int_flag']:
         lab_interpretation = codeableconcept.CodeableConcept()
         lab_int_sys = "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation"
         lab_interpretation.coding = [coding.Coding({"system": lab_int_sys,
-                                                    "code": self.data['int_flag'],
-                                                    "display": int_flag_long})]
+                                                    "code": values['int_flag'],
+                                                    "display": values['int_display']})]
         lab_observation.interpretation = [lab_interpretation]
 
       return lab_observation
@@ -197,3 +245,11 @@ class MapperDMLab2Obs:
     #except Exception as exc:
     #  self.logger.error(f"In {__name__}: Error occurred in mapping ({exc})")
     #  raise
+
+  # Same resource as map, filled into the template; validated by as_json
+  def map_template(self):
+    try:
+      return self.template.create(self._get_values())
+    except KeyError as exc:
+      self.logger.error(f"In {__name__}: Key {exc} not found in dictionary")
+      raise
@@ -12,6 +12,7 @@ import pandas as pd
 from lib.mii_profiles import (mii_address, mii_codeableconcept, mii_coding,
                               fhirdate, mii_identifier_pat, mii_patient, meta,
                               mii_humanname)
+from lib import fhir_constants
 
 class MapperDMPat2Pat:
   '''Map patient table of datamart to FHIR resources of type
@@ -41,14 +42,11 @@ class MapperDMPat2Pat:
     try:
       inpatient = mii_patient.Patient()
       inpatient.id = self.data['patient_psn']
-      identifier_type = mii_codeableconcept.CodeableConcept()      
-      identifier_type.coding = [mii_coding.Coding({"system": "http://terminology.hl7.org/CodeSystem/v2-0203",
-                                                   "code": "MR"})]
       inpatient.identifier = [mii_identifier_pat.Identifier({"use": "official",
                                                      "system": self.systems['patient_id'],
                                                      "value": self.data['patient_psn'],
                                                      "assigner":{"reference":"Organization/1111"},
-                                                     "type": identifier_type.as_json()})]
+                                                     "type": fhir_constants.IDENTIFIER_TYPE_MR.as_json()})]
 
       if self.data['insurance_id']:
         insurance_id_type = mii_codeableconcept.CodeableConcept()
@@ -57,8 +55,6 @@ class MapperDMPat2Pat:
                                                    "code": "GKV",
                                                    "display": "Gesetzliche Krankenversicherung"})]
         gkv_sys = "http://fhir.de/NamingSystem/gkv/kvid-10"
-        identifier_type.coding = [mii_coding.Coding({"system": "http://fhir.de/CodeSystem/identifier-type-de-basi",
-                                                     "code": "GKV"})]
         inpatient.identifier.append(mii_identifier_pat.Identifier({"use": "official",
                                                            "system": gkv_sys,
                                                            "type": insurance_id_type.as_json(),
@@ -92,9 +88,7 @@ class MapperDMPat2Pat:
                                                  "given": [self.data['given_name']]})]
 
 
-      pat_meta = meta.Meta()
-      pat_meta.source = "#sap-ish"
-      inpatient.meta = pat_meta
+      inpatient.meta = fhir_constants.META_SAP_ISH
       
       return inpatient
 
@@ -13,6 +13,7 @@ from hashlib import sha256
 from lib.mii_profiles import (mii_codeableconcept, mii_coding, dosage, fhirdate, fhirreference,
                               identifier, medication, medicationstatement, period, codeableconcept, coding,
                               mii_procedure, quantity, range, meta)
+from lib import lookup_tables, fhir_constants
 
 class MapperDMPro2ProMed:
   '''Map procedure table of datamart to FHIR resources of type
@@ -21,8 +22,8 @@ class MapperDMPro2ProMed:
   def __init__(self, logger, systems, map_table):
     self.logger = logger
     self.systems = systems
-    self.ops_drug_mapping = map_table[0]
-    self.drug_unii_mapping = map_table[1]
+    self.ops_drug_index = map_table[0]
+    self.substance_index = map_table[1]
     self.data = {}
 
   def read(self, encounter_psn, patient_psn, admission_dt, discharge_dt, db_record):
@@ -47,19 +48,37 @@ class MapperDMPro2ProMed:
     #  concat_elements.append(str(value))
     #self.data['concat_elements'] = ''.join(concat_elements)
 
+  def _create_ingredient(self, substance):
+    substance_unii, substance_ask, substance_cas = self.substance_index.get(
+      substance, lookup_tables.Substance(None, None, None))
+
+    ingredient = medication.MedicationIngredient()
+    ingredient_cc = codeableconcept.CodeableConcept()
+    ingredient_cc.coding = [coding.Coding({"system": "http://fdasis.nlm.nih.gov",
+                                           "code": substance_unii,
+                                           "display": substance})]
+    ingredient_cc.coding += [coding.Coding({"system": "http://fhir.de/CodeSystem/ask",
+                                            "code": substance_ask,
+                                            "display": substance})]
+    ingredient_cc.coding += [coding.Coding({"system": "urn:oid:2.16.840.1.113883.6.61",
+                                            "code": substance_cas,
+                                            "display": substance})]
+    ingredient.itemCodeableConcept = ingredient_cc
+    return ingredient
+
   def _map_dmpro2medi(self, encounter_ref, patient_ref):
     new_medication = []
     medication_stm = []
-    mapping_row = self.ops_drug_mapping[self.ops_drug_mapping['ops_code'] == self.data['ops_kode']]
-    if not mapping_row.empty:
-      drug_name = mapping_row['medication'].to_string(index=False)[1:]
-      drug_atc = mapping_row['atc_code1'].to_string(index=False)[1:]
-      dosage_text = mapping_row['text'].to_string(index=False)[1:]
-      ucum_short = mapping_row['ucum_short'].to_string(index=False)[1:]
-      ucum_full = mapping_row['ucum_full'].to_string(index=False)[1:]
-      dosage_min = mapping_row['dosage_min'].to_string(index=False)[1:]
-      dosage_max = mapping_row['dosage_max'].to_string(index=False)[1:]
-      combi_product = mapping_row['medication_combi'].to_string(index=False)
+    drug = self.ops_drug_index.get(self.data['ops_kode'])
+    if drug:
+      drug_name = drug.name
+      drug_atc = drug.atc
+      dosage_text = drug.text
+      ucum_short = drug.ucum_short
+      ucum_full = drug.ucum_full
+      dosage_min = drug.dosage_min
+      dosage_max = drug.dosage_max
+      combi_product = drug.combi
 
       # generate medication statement resources
       new_medication = medication.Medication()
@@ -77,9 +96,7 @@ class MapperDMPro2ProMed:
                                       "display": drug_name})]
       new_medication.code = atc_cc
       new_medication.status = "active"
-      med_meta = meta.Meta()
-      med_meta.source = "#sap-ish"
-      new_medication.meta = med_meta
+      new_medication.meta = fhir_constants.META_SAP_ISH
 
       substances = [drug_name]
       if combi_product:
@@ -88,24 +105,8 @@ class MapperDMPro2ProMed:
       ingredients = []
       if substances != ["UNKLAR"]:
         for substance in substances:
-          mapping_row2 = self.drug_unii_mapping[self.drug_unii_mapping['Substanzangabe_aus_OPS-Code'] == substance]
-          substance_unii = mapping_row2['Substanz_fuer_Dosisberechnung_UNII-number'].to_string(index=False)[1:]
-          substance_ask = mapping_row2['Substanz_fuer_Dosisberechnung_ASK-Nr'].to_string(index=False)[1:]
-          substance_cas = mapping_row2['Substanz_fuer_Dosisberechnung_CAS-Nummer'].to_string(index=False)[1:]
-
-          ingredient = medication.MedicationIngredient()
-          ingredient_cc = codeableconcept.CodeableConcept()
-          ingredient_cc.coding = [coding.Coding({"system": "http://fdasis.nlm.nih.gov",
-                                                 "code": substance_unii,
-                                                 "display": substance})]
-          ingredient_cc.coding += [coding.Coding({"system": "http://fhir.de/CodeSystem/ask",
-                                                  "code": substance_ask,
-                                                  "display": substance})]
-          ingredient_cc.coding += [coding.Coding({"system": "urn:oid:2.16.840.1.113883.6.61",
-                                                  "code": substance_cas,
-                                                  "display": substance})]
-          ingredient.itemCodeableConcept = ingredient_cc
-          ingredients.append(ingredient)
+          ingredients.append(fhir_constants.get(('medication_ingredient', substance),
+                                                lambda: self._create_ingredient(substance)))
       new_medication.ingredient = ingredients
 
       # generate medication statement resources
@@ -117,9 +118,7 @@ class MapperDMPro2ProMed:
       medication_stm.id = id_value
       medication_stm.identifier = [identifier.Identifier({"system": self.systems['med_stm_id'],
                                                           "value": id_value})]
-      med_meta = meta.Meta()
-      med_meta.source = "#sap-ish"
-      medication_stm.meta = med_meta      
+      medication_stm.meta = fhir_constants.META_SAP_ISH
 
       ref = {"reference": f"Medication/{new_medication.id}"}
       medication_ref = fhirreference.FHIRReference(jsondict=ref)
@@ -132,11 +131,9 @@ class MapperDMPro2ProMed:
 
       if not pd.isna(self.data['admission_dt']):
         med_period = period.Period()
-        med_period.start = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
+        med_period.start = fhirdate.FHIRDate.from_datetime(self.data['admission_dt'])
         if not pd.isna(self.data['discharge_dt']):
-          med_period.end = fhirdate.FHIRDate(datetime.strftime(self.data['discharge_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
+          med_period.end = fhirdate.FHIRDate.from_datetime(self.data['discharge_dt'])
           medication_stm.status = "completed"
         medication_stm.effectivePeriod = med_period
 
@@ -185,10 +182,7 @@ class MapperDMPro2ProMed:
       pat_procedure.encounter = encounter_ref
       pat_procedure.subject = patient_ref
 
-      category = mii_codeableconcept.CodeableConcept()
-      category.coding = [mii_coding.Coding({"system":"http://snomed.info/sct",
-                                            "code":"387713003"})]
-      pat_procedure.category = category
+      pat_procedure.category = fhir_constants.PROCEDURE_CATEGORY
 
       procedure_code = mii_codeableconcept.CodeableConcept()
       procedure_code.coding = [mii_coding.Coding({"system": "http://fhir.de/CodeSystem/dimdi/ops",
@@ -200,8 +194,7 @@ class MapperDMPro2ProMed:
         [new_medication, medication_stm] = self._map_dmpro2medi(encounter_ref, patient_ref)
 
       if not pd.isna(self.data['ops_datum']):
-        ops_datum_fhir = datetime.strftime(self.data['ops_datum'], '%Y-%m-%dT%H:%M:%S')
-        pat_procedure.performedDateTime = fhirdate.FHIRDate(ops_datum_fhir)
+        pat_procedure.performedDateTime = fhirdate.FHIRDate.from_datetime(self.data['ops_datum'])
 
       if self.data['lokalisation']:
         pat_procedure.bodySite = []
@@ -224,9 +217,7 @@ class MapperDMPro2ProMed:
                                                    "version": snomed_ver})]
           pat_procedure.bodySite.append(right_body_part)
 
-      pro_meta = meta.Meta()
-      pro_meta.source = "#sap-ish"
-      pat_procedure.meta = pro_meta
+      pat_procedure.meta = fhir_constants.META_SAP_ISH
 
       return [pat_procedure, new_medication, medication_stm]
     except KeyError as exc:
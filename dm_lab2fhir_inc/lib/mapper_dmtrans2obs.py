@@ -14,6 +14,8 @@ from lib.mii_profiles import (codeableconcept, coding, fhirdate, fhirreference,
                               miracum_codeableconcept, miracum_coding,
                               identifier, miracum_observation, period,
                               miracum_quantity, meta)
+from lib import fhir_constants, fhir_datetime
+from lib.fhir_template import Field, ResourceTemplate, Section
 
 class MapperDMTrans2Obs:
   '''Map transfer table of datamart to FHIR resources of type
@@ -23,6 +25,33 @@ class MapperDMTrans2Obs:
     self.logger = logger
     self.systems = systems
     self.data = {}
+    self.dialysis_template = ResourceTemplate(miracum_observation.Observation, {
+      "id": Field('dialysis_id'),
+      "identifier": [{"system": systems['p21obs_id'], "value": Field('dialysis_id')}],
+      "encounter": {"reference": Field('encounter_ref')},
+      "subject": {"reference": Field('patient_ref')},
+      "code": {"text": "Intercurrent dialysis",
+               "coding": [{"system": "https://miracum.org/fhir/CodeSystem/core/observations",
+                           "code": "intercurrent-dialysis",
+                           "display": "Intercurrent dialysis"}]},
+      "valueInteger": Field('dialysis_hours'),
+      "status": Field('status'),
+      "effectivePeriod": {"start": Field('start'), "end": Field('end')},
+      "meta": fhir_constants.META_SAP_ISH})
+    self.icu_template = ResourceTemplate(miracum_observation.Observation, {
+      "id": Field('icu_id'),
+      "identifier": [{"system": systems['p21obs_id'], "value": Field('icu_id')}],
+      "encounter": {"reference": Field('encounter_ref')},
+      "subject": {"reference": Field('patient_ref')},
+      "code": {"text": "Days in intensive care unit",
+               "coding": [{"system": "http://loinc.org", "code": "74200-7",
+                           "display": "Days in intensive care unit", "version": "2.46"}]},
+      "valueQuantity": Section('icu_days', {"value": Field('icu_days'), "unit": "d",
+                                            "system": "http://unitsofmeasure.org",
+                                            "code": "d"}),
+      "status": Field('status'),
+      "effectivePeriod": {"start": Field('start'), "end": Field('end')},
+      "meta": fhir_constants.META_SAP_ISH})
 
   def read(self, encounter_psn, patient_psn, db_record):
     self.data['encounter_psn'] = encounter_psn
@@ -38,34 +67,48 @@ class MapperDMTrans2Obs:
     else:
       self.data['icu_days'] = None
 
+  # Variable values of the dialysis and ICU observations, shared by map and
+  # map_template
+  def _get_values(self):
+    values = {'dialysis_id': f"{self.data['encounter_psn']}-dia",
+              'icu_id': f"{self.data['encounter_psn']}-icu",
+              'encounter_ref': f"Encounter/{self.data['encounter_psn']}",
+              'patient_ref': f"Patient/{self.data['patient_psn']}",
+              'status': "preliminary", 'end': None,
+              'dialysis_hours': self.data['dialysis_hours'],
+              'icu_days': self.data['icu_days']}
+    values['start'] = fhir_datetime.format_datetime(self.data['admission_dt'])
+    if values['start']:
+      values['end'] = fhir_datetime.format_datetime(self.data['discharge_dt'])
+      if values['end']:
+        values['status'] = "final"
+    return values
+
   def map(self):
     try:
-      obs_status = "preliminary"
-      obs_meta = meta.Meta()
-      obs_meta.source = "#sap-ish"
+      values = self._get_values()
+      obs_status = values['status']
+      obs_meta = fhir_constants.META_SAP_ISH
 
       start_dt = None
       end_dt = None
-      if not pd.isna(self.data['admission_dt']):
-        start_dt = fhirdate.FHIRDate(datetime.strftime(self.data['admission_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
-        if not pd.isna(self.data['discharge_dt']):
-          end_dt = fhirdate.FHIRDate(datetime.strftime(self.data['discharge_dt'],
-                                                               '%Y-%m-%dT%H:%M:%S'))
-          obs_status = "final"
+      if values['start']:
+        start_dt = fhirdate.FHIRDate(values['start'])
+      if values['end']:
+        end_dt = fhirdate.FHIRDate(values['end'])
       obs_period = period.Period()
       obs_period.start = start_dt
       obs_period.end = end_dt
 
-      id_value = f"{self.data['encounter_psn']}-dia"
+      id_value = values['dialysis_id']
       dialysis_observation = miracum_observation.Observation()
       dialysis_observation.id = id_value
       dialysis_sys = self.systems['p21obs_id']
       dialysis_observation.identifier = [identifier.Identifier({"system": dialysis_sys,
                                                                 "value": id_value})]
-      ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
+      ref = {"reference": values['encounter_ref']}
       dialysis_observation.encounter = fhirreference.FHIRReference(jsondict=ref)
-      ref = {"reference": f"Patient/{self.data['patient_psn']}"}
+      ref = {"reference": values['patient_ref']}
       dialysis_observation.subject = fhirreference.FHIRReference(jsondict=ref)
 
       dialysis_code = miracum_codeableconcept.CodeableConcept()
@@ -75,21 +118,21 @@ class MapperDMTrans2Obs:
                                                      "code": "intercurrent-dialysis",
                                                      "display": "Intercurrent dialysis"})]
       dialysis_observation.code = dialysis_code
-      dialysis_observation.valueInteger = self.data['dialysis_hours']
+      dialysis_observation.valueInteger = values['dialysis_hours']
 
       dialysis_observation.status = obs_status
       dialysis_observation.effectivePeriod = obs_period
       dialysis_observation.meta = obs_meta
 
-      id_value = f"{self.data['encounter_psn']}-icu"
+      id_value = values['icu_id']
       icu_observation = miracum_observation.Observation()
       icu_observation.id = id_value
       icu_sys = self.systems['p21obs_id']
       icu_observation.identifier = [identifier.Identifier({"system": icu_sys,
                                                            "value": id_value})]
-      ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
+      ref = {"reference": values['encounter_ref']}
       icu_observation.encounter = fhirreference.FHIRReference(jsondict=ref)
-      ref = {"reference": f"Patient/{self.data['patient_psn']}"}
+      ref = {"reference": values['patient_ref']}
       icu_observation.subject = fhirreference.FHIRReference(jsondict=ref)
 
       icu_code = miracum_codeableconcept.CodeableConcept()
@@ -99,8 +142,8 @@ class MapperDMTrans2Obs:
                                                 "display": "Days in intensive care unit",
                                                 "version": "2.46"})]
       icu_observation.code = icu_code
-      if self.data['icu_days']:
-        icu_observation.valueQuantity = miracum_quantity.Quantity({"value": self.data['icu_days'],
+      if values['icu_days']:
+        icu_observation.valueQuantity = miracum_quantity.Quantity({"value": values['icu_days'],
                                                           "unit": "d",
                                                           "system": "http://unitsofmeasure.org",
                                                           "code": "d"})
@@ -117,3 +160,12 @@ class MapperDMTrans2Obs:
     #except Exception as exc:
     #  self.logger.error(f"In {__name__}: Error occurred in mapping ({exc})")
     #  raise
+
+  # Same resources as map, filled into the templates; validated by as_json
+  def map_template(self):
+    try:
+      values = self._get_values()
+      return [self.dialysis_template.create(values), self.icu_template.create(values)]
+    except KeyError as exc:
+      self.logger.error(f"In {__name__}: Key {exc} not found in dictionary")
+      raise
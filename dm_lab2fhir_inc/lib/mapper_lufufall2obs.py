@@ -15,7 +15,139 @@ from lib.mii_profiles import (codeableconcept, coding, fhirdate, fhirreference,
                                identifier, observation, diagnosticreport, period, quantity, meta)
 import numpy as np
 from lib.mii_profiles.observation import ObservationReferenceRange
-
+from lib import lookup_tables, fhir_constants
+
+# Keys of the lufu values (procedure prefix and column name) and the columns
+# of f_med_din_lungenfunktion they are read from
+LUFU_VALUE_COLUMNS = [
+  ('SP_PRE_bp_vc_target', 'bp_vc_target'),
+  ('SP_PRE_bp_vc_actual', 'bp_vc_actual'),
+  ('SP_PRE_bp_fvcex_target', 'bp_fvcex_target'),
+  ('SP_PRE_bp_fvcex_actual', 'bp_fvcex_actual'),
+  ('SP_PRE_bp_fev1_target', 'bp_fev1_target'),
+  ('SP_PRE_bp_fev1_actual', 'bp_fev1_actual'),
+  ('SP_PRE_bp_fev_vc_target', 'bp_fev_vc_target'),
+  ('SP_PRE_bp_fev_vc_actual', 'bp_fev_vc_actual'),
+  ('SP_PRE_bp_mef25_target', 'bp_mef25_target'),
+  ('SP_PRE_bp_mef25_actual', 'bp_mef25_actual'),
+  ('SP_PRE_bp_mef50_target', 'bp_mef50_target'),
+  ('SP_PRE_bp_mef50_actual', 'bp_mef50_actual'),
+  ('SP_PRE_bp_mef75_target', 'bp_mef75_target'),
+  ('SP_PRE_bp_mef75_actual', 'bp_mef75_actual'),
+  ('SP_PRE_bp_ic_target', 'bp_ic_target'),
+  ('SP_PRE_bp_ic_actual', 'bp_ic_actual'),
+  ('B_PRE_bp_rawtot_target', 'bp_rawtot_target'),
+  ('B_PRE_bp_rawtot_actual', 'bp_rawtot_actual'),
+  ('B_PRE_bp_srawtot_target', 'bp_srawtot_target'),
+  ('B_PRE_bp_srawtot_actual', 'bp_srawtot_actual'),
+  ('B_PRE_bp_gtot_target', 'bp_gtot_target'),
+  ('B_PRE_bp_gtot_actual', 'bp_gtot_actual'),
+  ('B_PRE_bp_sgtot_target', 'bp_sgtot_target'),
+  ('B_PRE_bp_sgtot_actual', 'bp_sgtot_actual'),
+  ('B_PRE_bp_rv_target', 'bp_rv_target'),
+  ('B_PRE_bp_rv_actual', 'bp_rv_actual'),
+  ('B_PRE_bp_rv_tlc_actual', 'bp_rv_tlc_actual'),
+  ('B_PRE_bp_rv_tlc_target', 'bp_rv_tlc_target'),
+  ('B_PRE_bp_tlc_target', 'bp_tlc_target'),
+  ('B_PRE_bp_tlc_actual', 'bp_tlc_actual'),
+  ('B_PRE_bp_pef_target', 'bp_pef_target'),
+  ('B_PRE_bp_pef_actual', 'bp_pef_actual'),
+
+  ('SP_POST_bpl_vc_target', 'bpl_vc_target'),
+  ('SP_POST_bpl_vc_actual', 'bpl_vc_actual'),
+  ('SP_POST_bpl_fvcex_target', 'bpl_fvcex_target'),
+  ('SP_POST_bpl_fvcex_actual', 'bpl_fvcex_actual'),
+  ('SP_POST_bpl_fev1_target', 'bpl_fev1_target'),
+  ('SP_POST_bpl_fev1_actual', 'bpl_fev1_actual'),
+  ('SP_POST_bpl_fev_vcmax_target', 'bpl_fev_vcmax_target'),
+  ('SP_POST_bpl_fev_vcmax_actual', 'bpl_fev_vcmax_actual'),
+  ('SP_POST_bpl_mef25_target', 'bpl_mef25_target'),
+  ('SP_POST_bpl_mef25_actual', 'bpl_mef25_actual'),
+  ('SP_POST_bpl_mef50_target', 'bpl_mef50_target'),
+  ('SP_POST_bpl_mef50_actual', 'bpl_mef50_actual'),
+  ('SP_POST_bpl_mef75_target', 'bpl_mef75_target'),
+  ('SP_POST_bpl_mef75_actual', 'bpl_mef75_actual'),
+  ('SP_POST_bpl_ic_target', 'bpl_ic_target2'),
+  ('SP_POST_bpl_ic_actual', 'bpl_ic_actual'),
+  ('B_POST_bpl_rawtot_target', 'bpl_rawtot_target'),
+  ('B_POST_bpl_rawtot_actual', 'bpl_rawtot_actual'),
+  ('B_POST_bpl_srawtot_target', 'bpl_srawtot_target'),
+  ('B_POST_bpl_srawtot_actual', 'bpl_srawtot_actual'),
+  ('B_POST_bpl_gtot_target', 'bpl_gtot_target'),
+  ('B_POST_bpl_gtot_actual', 'bpl_gtot_actual'),
+  ('B_POST_bpl_sgtot_target', 'bpl_sgtot_target'),
+  ('B_POST_bpl_sgtot_actual', 'bpl_sgtot_actual'),
+  ('B_POST_bpl_rv_target', 'bpl_rv_target'),
+  ('B_POST_bpl_rv_actual', 'bpl_rv_actual'),
+  ('B_POST_bpl_rv_tlc_target', 'bpl_rv_tlc_target'),
+  ('B_POST_bpl_rv_tlc_actual', 'bpl_rv_tlc_actual'),
+  ('B_POST_bpl_tlc_target', 'bpl_tlc_target'),
+  ('B_POST_bpl_tlc_actual', 'bpl_tlc_actual'),
+  ('B_POST_bpl_pef_target', 'bpl_pef_target'),
+  ('B_POST_bpl_pef_actual', 'bpl_pef_actual'),
+
+  ('O_PRE_b_r5hz_target', 'b_r5hz_target'),
+  ('O_PRE_b_r5hz_actual', 'b_r5hz_actual'),
+  ('O_PRE_b_x5hz_target', 'b_x5hz_target'),
+  ('O_PRE_b_x5hz_actual', 'b_x5hz_actual'),
+  ('O_PRE_b_fres_target', 'b_fres_target'),
+  ('O_PRE_b_fres_actual', 'b_fres_actual'),
+  ('O_PRE_b_ax_target', 'b_ax_target'),
+  ('O_PRE_b_ax_actual', 'b_ax_actual'),
+  #('O_PRE_bd520actual', 'bd520actual'),
+  #('O_PRE_bd520target', 'bd520target'),
+  #('O_PRE_b_vt_target', 'b_vt_target'),
+  #('O_PRE_b_vt_actual', 'b_vt_actual'),
+
+  ('O_POST_bpl_r5hz_target', 'bpl_r5hz_target'),
+  ('O_POST_bpl_r5hz_actual', 'bpl_r5hz_actual'),
+  ('O_POST_bpl_x5hz_target', 'bpl_x5hz_target'),
+  ('O_POST_bpl_x5hz_actual', 'bpl_x5hz_actual'),
+  ('O_POST_bpl_fres_target', 'bpl_fres_target'),
+  ('O_POST_bpl_fres_actual', 'bpl_fres_actual'),
+  ('O_POST_bpl_ax_target', 'bpl_ax_target'),
+  ('O_POST_bpl_ax_actual', 'bpl_ax_actual'),
+  #('O_POST_bpld520target', 'bpld520target'),
+  #('O_POST_bpld520actual', 'bpld520actual'),
+  #('O_POST_bpl_vt_target', 'bpl_vt_target'),
+  #('O_POST_bpl_vt_actual', 'bpl_vt_actual'),
+
+  ('BGA_bga_ph_target', 'bga_ph_target'),
+  ('BGA_bga_ph_actual', 'bga_ph_actual'),
+  ('BGA_bga_pao2_target', 'bga_pao2_target'),
+  ('BGA_bga_pao2_actual', 'bga_pao2_actual'),
+  ('BGA_bga_paco2_target', 'bga_paco2_target'),
+  ('BGA_bga_paco2_actual', 'bga_paco2_actual'),
+  ('BGA_bga_be_target', 'bga_be_target'),
+  ('BGA_bga_be_actual', 'bga_be_actual'),
+  ('BGA_bp_gerstpo2_target', 'bp_gerstpo2_target'),
+  ('BGA_bp_gerstpo2_actual', 'bp_gerstpo2_actual'),
+  ('BGA_bp_shco3_target', 'bp_shco3_target'),
+  ('BGA_bp_shco3_actual', 'bp_shco3_actual'),
+  ('BGA_bp_cohb_target', 'bp_cohb_target'),
+  ('BGA_bp_cohb_actual', 'bp_cohb_actual'),
+  ('BGA_bp_lactat_target', 'bp_lactat_target'),
+  ('BGA_bp_lactat_actual', 'bp_lactat_actual'),
+
+  ('TRA_bp_dlcosb_target', 'bp_dlcosb_target'),
+  ('TRA_bp_dlcosb_actual', 'bp_dlcosb_actual'),
+  ('TRA_bp_kco_target', 'bp_kco_target'),
+  ('TRA_bp_kco_actual', 'bp_kco_actual'),
+  ('TRA_bp_rvsb_target', 'bp_rvsb_target'),
+  ('TRA_bp_rvsb_actual', 'bp_rvsb_actual'),
+  #('TRA_vinhetargetwert', 'vinhetargetwert'),
+  #('TRA_vinheactualwert', 'vinheactualwert'),
+  ('TRA_bp_hb_target', 'bp_hb_target'),
+  ('TRA_bp_hb_actual', 'bp_hb_actual'),
+
+  ('FE_bp_feno_target', 'bp_feno_target'),
+  ('FE_bp_feno_actual', 'bp_feno_actual')
+]
+LUFU_VALUE_COLUMN = dict(LUFU_VALUE_COLUMNS)
+
+# Value keys per procedure for which observations are created
+LUFU_PROCEDURE_KEYS = {procedure: [key for key, _ in LUFU_VALUE_COLUMNS if procedure in key]
+                       for procedure in ['B_PRE', 'B_POST', 'SP_PRE', 'SP_POST', 'TRA_']}
 
 class MapperLuFuFall2Obs:
   '''Map lufu table data set to FHIR resources of type
@@ -30,8 +162,30 @@ class MapperLuFuFall2Obs:
     self.loinc_mapper = loinc_mapper
     self.snomed_mapper = snomed_mapper
     self.i2b2_mapper = i2b2_mapper
-
-  def read(self, encounter_psn, patient_psn, db_record):
+    self.parameter_index = lookup_tables.build_lufu_parameter_index(logger, loinc_mapper,
+                                                                    i2b2_mapper, map_table)
+    self.procedure_index = lookup_tables.build_lufu_procedure_index(snomed_mapper)
+    self.chunk_items = {}
+    self.chunk_concat = []
+
+  # Precompute for a chunk of lufu records the values present per procedure
+  # (not-null masks over the chunk) and the record strings the observation
+  # ids are hashed from; returns the records as dicts
+  def read_chunk(self, chunk):
+    columns = list(chunk.columns)
+    values = chunk.values
+    self.chunk_items = {}
+    for procedure, keys in LUFU_PROCEDURE_KEYS.items():
+      notnull = chunk[[LUFU_VALUE_COLUMN[key] for key in keys]].notna().to_numpy()
+      self.chunk_items[procedure] = [[keys[idx] for idx in np.flatnonzero(row_notnull)]
+                                     for row_notnull in notnull]
+    str_columns = [[str(value) for value in values[:, idx]]
+                   for idx, column in enumerate(columns) if column != 'quelldatenjahr']
+    self.chunk_concat = [''.join(row) for row in zip(*str_columns)]
+    return [dict(zip(columns, row)) for row in values]
+
+  # Read record row_idx of the chunk passed to read_chunk before
+  def read(self, encounter_psn, patient_psn, db_record, row_idx):
 
     self.data['encounter_psn'] = encounter_psn
     self.data['patient_psn'] = patient_psn
@@ -57,201 +211,31 @@ class MapperLuFuFall2Obs:
     self.data['anmerkung'] = db_record['anmerkung']
     self.data['empfehlung'] = db_record['empfehlung']
 
-    self.data['SP_PRE_bp_vc_target'] = db_record['bp_vc_target']
-    self.data['SP_PRE_bp_vc_actual'] = db_record['bp_vc_actual']
-    self.data['SP_PRE_bp_fvcex_target'] = db_record['bp_fvcex_target']
-    self.data['SP_PRE_bp_fvcex_actual'] = db_record['bp_fvcex_actual']
-    self.data['SP_PRE_bp_fev1_target'] = db_record['bp_fev1_target']
-    self.data['SP_PRE_bp_fev1_actual'] = db_record['bp_fev1_actual']
-    self.data['SP_PRE_bp_fev_vc_target'] = db_record['bp_fev_vc_target']
-    self.data['SP_PRE_bp_fev_vc_actual'] = db_record['bp_fev_vc_actual']
-    self.data['SP_PRE_bp_mef25_target'] = db_record['bp_mef25_target']
-    self.data['SP_PRE_bp_mef25_actual'] = db_record['bp_mef25_actual']
-    self.data['SP_PRE_bp_mef50_target'] = db_record['bp_mef50_target']
-    self.data['SP_PRE_bp_mef50_actual'] = db_record['bp_mef50_actual']
-    self.data['SP_PRE_bp_mef75_target'] = db_record['bp_mef75_target']
-    self.data['SP_PRE_bp_mef75_actual'] = db_record['bp_mef75_actual']
-    self.data['SP_PRE_bp_ic_target'] = db_record['bp_ic_target']
-    self.data['SP_PRE_bp_ic_actual'] = db_record['bp_ic_actual']
-    self.data['B_PRE_bp_rawtot_target'] = db_record['bp_rawtot_target']
-    self.data['B_PRE_bp_rawtot_actual'] = db_record['bp_rawtot_actual']
-    self.data['B_PRE_bp_srawtot_target'] = db_record['bp_srawtot_target']
-    self.data['B_PRE_bp_srawtot_actual'] = db_record['bp_srawtot_actual']
-    self.data['B_PRE_bp_gtot_target'] = db_record['bp_gtot_target']
-    self.data['B_PRE_bp_gtot_actual'] = db_record['bp_gtot_actual']
-    self.data['B_PRE_bp_sgtot_target'] = db_record['bp_sgtot_target']
-    self.data['B_PRE_bp_sgtot_actual'] = db_record['bp_sgtot_actual']
-    self.data['B_PRE_bp_rv_target'] = db_record['bp_rv_target']
-    self.data['B_PRE_bp_rv_actual'] = db_record['bp_rv_actual']
-    self.data['B_PRE_bp_rv_tlc_actual'] = db_record['bp_rv_tlc_actual']
-    self.data['B_PRE_bp_rv_tlc_target'] = db_record['bp_rv_tlc_target']
-    self.data['B_PRE_bp_tlc_target'] = db_record['bp_tlc_target']
-    self.data['B_PRE_bp_tlc_actual'] = db_record['bp_tlc_actual']
-    self.data['B_PRE_bp_pef_target'] = db_record['bp_pef_target']
-    self.data['B_PRE_bp_pef_actual'] = db_record['bp_pef_actual']
-
-    self.data['SP_POST_bpl_vc_target'] = db_record['bpl_vc_target']
-    self.data['SP_POST_bpl_vc_actual'] = db_record['bpl_vc_actual']
-    self.data['SP_POST_bpl_fvcex_target'] = db_record['bpl_fvcex_target']
-    self.data['SP_POST_bpl_fvcex_actual'] = db_record['bpl_fvcex_actual']
-    self.data['SP_POST_bpl_fev1_target'] = db_record['bpl_fev1_target']
-    self.data['SP_POST_bpl_fev1_actual'] = db_record['bpl_fev1_actual']
-    self.data['SP_POST_bpl_fev_vcmax_target'] = db_record['bpl_fev_vcmax_target']
-    self.data['SP_POST_bpl_fev_vcmax_actual'] = db_record['bpl_fev_vcmax_actual']
-    self.data['SP_POST_bpl_mef25_target'] = db_record['bpl_mef25_target']
-    self.data['SP_POST_bpl_mef25_actual'] = db_record['bpl_mef25_actual']
-    self.data['SP_POST_bpl_mef50_target'] = db_record['bpl_mef50_target']
-    self.data['SP_POST_bpl_mef50_actual'] = db_record['bpl_mef50_actual']
-    self.data['SP_POST_bpl_mef75_target'] = db_record['bpl_mef75_target']
-    self.data['SP_POST_bpl_mef75_actual'] = db_record['bpl_mef75_actual']
-    self.data['SP_POST_bpl_ic_target'] = db_record['bpl_ic_target2']
-    self.data['SP_POST_bpl_ic_actual'] = db_record['bpl_ic_actual']
-    self.data['B_POST_bpl_rawtot_target'] = db_record['bpl_rawtot_target']
-    self.data['B_POST_bpl_rawtot_actual'] = db_record['bpl_rawtot_actual']
-    self.data['B_POST_bpl_srawtot_target'] = db_record['bpl_srawtot_target']
-    self.data['B_POST_bpl_srawtot_actual'] = db_record['bpl_srawtot_actual']
-    self.data['B_POST_bpl_gtot_target'] = db_record['bpl_gtot_target']
-    self.data['B_POST_bpl_gtot_actual'] = db_record['bpl_gtot_actual']
-    self.data['B_POST_bpl_sgtot_target'] = db_record['bpl_sgtot_target']
-    self.data['B_POST_bpl_sgtot_actual'] = db_record['bpl_sgtot_actual']
-    self.data['B_POST_bpl_rv_target'] = db_record['bpl_rv_target']
-    self.data['B_POST_bpl_rv_actual'] = db_record['bpl_rv_actual']
-    self.data['B_POST_bpl_rv_tlc_target'] = db_record['bpl_rv_tlc_target']
-    self.data['B_POST_bpl_rv_tlc_actual'] = db_record['bpl_rv_tlc_actual']
-    self.data['B_POST_bpl_tlc_target'] = db_record['bpl_tlc_target']
-    self.data['B_POST_bpl_tlc_actual'] = db_record['bpl_tlc_actual']
-    self.data['B_POST_bpl_pef_target'] = db_record['bpl_pef_target']
-    self.data['B_POST_bpl_pef_actual'] = db_record['bpl_pef_actual']
-
-    self.data['O_PRE_b_r5hz_target'] = db_record['b_r5hz_target']
-    self.data['O_PRE_b_r5hz_actual'] = db_record['b_r5hz_actual']
-    self.data['O_PRE_b_x5hz_target'] = db_record['b_x5hz_target']
-    self.data['O_PRE_b_x5hz_actual'] = db_record['b_x5hz_actual']
-    self.data['O_PRE_b_fres_target'] = db_record['b_fres_target']
-    self.data['O_PRE_b_fres_actual'] = db_record['b_fres_actual']
-    self.data['O_PRE_b_ax_target'] = db_record['b_ax_target']
-    self.data['O_PRE_b_ax_actual'] = db_record['b_ax_actual']
-    #self.data['O_PRE_bd520actual'] = db_record['bd520actual']
-    #self.data['O_PRE_bd520target'] = db_record['bd520target']
-    #self.data['O_PRE_b_vt_target'] = db_record['b_vt_target']
-    #self.data['O_PRE_b_vt_actual'] = db_record['b_vt_actual']
-
-    self.data['O_POST_bpl_r5hz_target'] = db_record['bpl_r5hz_target']
-    self.data['O_POST_bpl_r5hz_actual'] = db_record['bpl_r5hz_actual']
-    self.data['O_POST_bpl_x5hz_target'] = db_record['bpl_x5hz_target']
-    self.data['O_POST_bpl_x5hz_actual'] = db_record['bpl_x5hz_actual']
-    self.data['O_POST_bpl_fres_target'] = db_record['bpl_fres_target']
-    self.data['O_POST_bpl_fres_actual'] = db_record['bpl_fres_actual']
-    self.data['O_POST_bpl_ax_target'] = db_record['bpl_ax_target']
-    self.data['O_POST_bpl_ax_actual'] = db_record['bpl_ax_actual']
-    #self.data['O_POST_bpld520target'] = db_record['bpld520target']
-    #self.data['O_POST_bpld520actual'] = db_record['bpld520actual']
-    #self.data['O_POST_bpl_vt_target'] = db_record['bpl_vt_target']
-    #self.data['O_POST_bpl_vt_actual'] = db_record['bpl_vt_actual']
-
-    self.data['BGA_bga_ph_target'] = db_record['bga_ph_target']
-    self.data['BGA_bga_ph_actual'] = db_record['bga_ph_actual']
-    self.data['BGA_bga_pao2_target'] = db_record['bga_pao2_target']
-    self.data['BGA_bga_pao2_actual'] = db_record['bga_pao2_actual']
-    self.data['BGA_bga_paco2_target'] = db_record['bga_paco2_target']
-    self.data['BGA_bga_paco2_actual'] = db_record['bga_paco2_actual']
-    self.data['BGA_bga_be_target'] = db_record['bga_be_target']
-    self.data['BGA_bga_be_actual'] = db_record['bga_be_actual']
-    self.data['BGA_bp_gerstpo2_target'] = db_record['bp_gerstpo2_target']
-    self.data['BGA_bp_gerstpo2_actual'] = db_record['bp_gerstpo2_actual']
-    self.data['BGA_bp_shco3_target'] = db_record['bp_shco3_target']
-    self.data['BGA_bp_shco3_actual'] = db_record['bp_shco3_actual']
-    self.data['BGA_bp_cohb_target'] = db_record['bp_cohb_target']
-    self.data['BGA_bp_cohb_actual'] = db_record['bp_cohb_actual']
-    self.data['BGA_bp_lactat_target'] = db_record['bp_lactat_target']
-    self.data['BGA_bp_lactat_actual'] = db_record['bp_lactat_actual']
-
-    self.data['TRA_bp_dlcosb_target'] = db_record['bp_dlcosb_target']
-    self.data['TRA_bp_dlcosb_actual'] = db_record['bp_dlcosb_actual']
-    self.data['TRA_bp_kco_target'] = db_record['bp_kco_target']
-    self.data['TRA_bp_kco_actual'] = db_record['bp_kco_actual']
-    self.data['TRA_bp_rvsb_target'] = db_record['bp_rvsb_target']
-    self.data['TRA_bp_rvsb_actual'] = db_record['bp_rvsb_actual']
-    #self.data['TRA_vinhetargetwert'] = db_record['vinhetargetwert']
-    #self.data['TRA_vinheactualwert'] = db_record['vinheactualwert']
-    self.data['TRA_bp_hb_target'] = db_record['bp_hb_target']
-    self.data['TRA_bp_hb_actual'] = db_record['bp_hb_actual']
-
-    self.data['FE_bp_feno_target'] = db_record['bp_feno_target']
-    self.data['FE_bp_feno_actual'] = db_record['bp_feno_actual']
-
-    #self.data['admission_dt'] = db_record['aufnahmedatum']
-    #self.data['discharge_dt'] = db_record['entlassungsdatum']
-    concat_elements = []
-    record_dict = dict(db_record)
-    for key, value in record_dict.items():
-        if key == 'quelldatenjahr':
-            continue
-        concat_elements.append(str(value))
-    self.data['concat_elements'] = ''.join(concat_elements)
+    self.data['record'] = db_record
+    self.data['items'] = {procedure: items[row_idx]
+                          for procedure, items in self.chunk_items.items()}
+    self.data['concat_elements'] = self.chunk_concat[row_idx]
 
   def map(self):
     try:
       lufu_observation_list = []
-      lufu_observation_B_PRE_list = []
-      lufu_observation_B_POST_list = []
-      lufu_observation_SP_PRE_list = []
-      lufu_observation_SP_POST_list = []
-      lufu_observation_BGA_list = []
-      lufu_observation_TRA_list = []
-      lufu_observation_FE_list = []
-
-      lufu_record_has_b_pre_values = False
-      lufu_record_has_b_post_values= False
-      lufu_record_has_sp_pre_values = False
-      lufu_record_has_sp_post_values = False
-      lufu_record_has_bga_values = False
-      lufu_record_has_tra_values = False
-      lufu_record_has_fe_values = False
+      items = self.data['items']
 
       # determine content of lufu record for mapping loinc (pre, post, actual)
-      for item in self.data:
-        if 'B_PRE' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_b_pre_values = True
-            lufu_observation_B_PRE_list.append(item)
-        if 'B_POST' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_b_post_values = True
-            lufu_observation_B_POST_list.append(item)
-        if 'SP_PRE' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_sp_pre_values = True
-            lufu_observation_SP_PRE_list.append(item)
-        if 'SP_POST' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_sp_post_values = True
-            lufu_observation_SP_POST_list.append(item)
-        if 'BGA_' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_bga_values = True
-        if 'TRA_' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_tra_values = True
-            lufu_observation_TRA_list.append(item)
-        if 'FE_' in item:
-          if self.data[item] is not None and not np.isnan(self.data[item]):
-            lufu_record_has_fe_values = True
-
-      if lufu_record_has_b_pre_values and not lufu_record_has_b_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_', lufu_observation_B_PRE_list))
-      if lufu_record_has_b_pre_values and lufu_record_has_b_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_PRE', lufu_observation_B_PRE_list))
-      if lufu_record_has_b_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_POST', lufu_observation_B_POST_list))
-      if lufu_record_has_sp_pre_values and not lufu_record_has_sp_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_', lufu_observation_SP_PRE_list))
-      if lufu_record_has_sp_pre_values and lufu_record_has_sp_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_PRE', lufu_observation_SP_PRE_list))
-      if lufu_record_has_sp_post_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_POST', lufu_observation_SP_POST_list))
-      if lufu_record_has_tra_values:
-        lufu_observation_list.append(mapLufuItems2Obs(self, 'TRA_', lufu_observation_TRA_list))
+      if items['B_PRE'] and not items['B_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_', items['B_PRE']))
+      if items['B_PRE'] and items['B_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_PRE', items['B_PRE']))
+      if items['B_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'B_POST', items['B_POST']))
+      if items['SP_PRE'] and not items['SP_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_', items['SP_PRE']))
+      if items['SP_PRE'] and items['SP_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_PRE', items['SP_PRE']))
+      if items['SP_POST']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'SP_POST', items['SP_POST']))
+      if items['TRA_']:
+        lufu_observation_list.append(mapLufuItems2Obs(self, 'TRA_', items['TRA_']))
 
       lufu_observation_list = [x for x in lufu_observation_list if x != []]
       return lufu_observation_list
@@ -264,8 +248,12 @@ class MapperLuFuFall2Obs:
 
 def mapLufuItems2Obs(self, param, items):
 
-    sct_code = self.snomed_mapper.codeLookup(str(param))
-    sct_display = self.snomed_mapper.displayLookup(str(sct_code))
+    if param in self.procedure_index:
+        sct_code, sct_display = self.procedure_index[param]
+    else:
+        # unknown procedures are looked up as before ('No Text' is logged)
+        sct_code = self.snomed_mapper.codeLookup(str(param))
+        sct_display = self.snomed_mapper.displayLookup(str(sct_code))
 
     lufu_observation = observation.Observation()
     observation_unit = ''
@@ -280,12 +268,7 @@ def mapLufuItems2Obs(self, param, items):
                                              "display": sct_display,
                                              "version": "0.1"})]
     # obs category
-    obs_type_sys = "http://terminology.hl7.org/CodeSystem/observation-category"
-    code = 'exam'
-    observation_cat = codeableconcept.CodeableConcept()
-    observation_cat.coding = [coding.Coding({"system": obs_type_sys,
-                                             "code": code})]
-    lufu_observation.category = [observation_cat]
+    lufu_observation.category = [fhir_constants.OBSERVATION_CATEGORY_EXAM]
     lufu_observation.code = obs_actual_code
 
     ref = {"reference": f"Encounter/{self.data['encounter_psn']}"}
@@ -305,33 +288,29 @@ def mapLufuItems2Obs(self, param, items):
     for item in items:
         if 'actual' in str(item):
             obs_component = observation.ObservationComponent()
-            lufu_value = self.data[item]
+            lufu_value = self.data['record'][LUFU_VALUE_COLUMN[item]]
             lookupParam = item
             if ("PRE" not in param) and ("POST" not in param):
                 lookupParam = str(item).replace("PRE_", "")
-            loinc_code = self.loinc_mapper.codeLookup(lookupParam)
-            loinc_display = self.loinc_mapper.displayLookup(loinc_code)
-            i2b2_code = self.i2b2_mapper.codeLookup(lookupParam)
+            parameter = self.parameter_index.get(lookupParam)
 
             codings = []
 
-            if loinc_code != 'No Code':
+            if parameter and parameter.loinc != 'No Code':
                 codings.append(
                     coding.Coding({"system": "http://loinc.org",
-                                   "code": loinc_code,
-                                   "display": loinc_display,
+                                   "code": parameter.loinc,
+                                   "display": parameter.loinc_display,
                                    "version": "2.46"})
                 )
-                mask = self.map_table[self.map_table['RELMA'] == loinc_code]
-                observation_unit = mask['Unit'].values[0]
-            if i2b2_code != 'No Code':
+                observation_unit = parameter.unit
+            if parameter and parameter.i2b2 != 'No Code':
                 codings.append(
                     coding.Coding({"system": "http://mdr.miracum.org",
-                                   "code": i2b2_code,
+                                   "code": parameter.i2b2,
                                    "version": "0.01"})
                 )
-                mask = self.map_table[self.map_table['I2B2 Basecode'] == i2b2_code]
-                observation_unit = mask['Unit'].values[0]
+                observation_unit = parameter.unit
 
             if len(codings) > 0:
                 obs_component_code = codeableconcept.CodeableConcept()
@@ -342,7 +321,8 @@ def mapLufuItems2Obs(self, param, items):
                                                                      "unit": observation_unit,
                                                                      "system": "http://unitsofmeasure.org",
                                                                      "code": observation_unit})
-                lufu_ref_value = self.data[str(item).replace('actual', 'target')]
+                target_item = str(item).replace('actual', 'target')
+                lufu_ref_value = self.data['record'][LUFU_VALUE_COLUMN[target_item]]
                 low_ref_value = quantity.Quantity({"value": lufu_ref_value,
                                                    "unit": observation_unit,
                                                    "system": "http://unitsofmeasure.org",
@@ -357,9 +337,7 @@ def mapLufuItems2Obs(self, param, items):
     lufu_observation.component = components
     lufu_observation.status = "final"
 
-    lufu_actual_meta = meta.Meta()
-    lufu_actual_meta.source = "#lufu-cwd"
-    lufu_observation.meta = lufu_actual_meta
+    lufu_observation.meta = fhir_constants.META_LUFU_CWD
     if len(lufu_observation.component) > 0:
         return lufu_observation
     else:
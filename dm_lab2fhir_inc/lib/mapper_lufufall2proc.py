@@ -84,8 +84,8 @@ class MapperLuFuFall2Proc:
                                                                   "value": lufu_procedure_identifier})]
       lufu_procedure.id = id_value
 
-      lufu_procedure_identifier_perf_date = fhirdate.FHIRDate(datetime.strftime(datetime.strptime(self.data['untersuchungsdatum'], '%d.%m.%Y %H:%M:%S'),
-                                                                '%Y-%m-%dT%H:%M:%S'))
+      lufu_procedure_identifier_perf_date = fhirdate.FHIRDate.from_datetime(
+        datetime.strptime(self.data['untersuchungsdatum'], '%d.%m.%Y %H:%M:%S'))
 
       lufu_procedure.performedDateTime = lufu_procedure_identifier_perf_date
 
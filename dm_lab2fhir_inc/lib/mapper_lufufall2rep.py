@@ -70,8 +70,8 @@ class MapperLuFuFall2Rep:
                                                                   "system": self.systems['lufu_obs_id'],
                                                                   "value": str(lufu_diagnostic_report_identifier)})]
       dt_string = self.data['untersuchungsdatum']+" "+self.data['untersuchungsuhrzeit']
-      lufu_report_dt = datetime.strftime(datetime.strptime(dt_string, "%Y-%m-%d %H:%M:%S"), '%Y-%m-%dT%H:%M:%S')
-      lufu_diagnostic_report_date = fhirdate.FHIRDate(lufu_report_dt)
+      lufu_report_dt = datetime.strptime(dt_string, "%Y-%m-%d %H:%M:%S")
+      lufu_diagnostic_report_date = fhirdate.FHIRDate.from_datetime(lufu_report_dt)
 
       lufu_diagnostic_report.effectiveDateTime = lufu_diagnostic_report_date
 
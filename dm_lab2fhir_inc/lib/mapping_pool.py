@@ -0,0 +1,101 @@
+#!/usr/bin/python3.6
+
+'''Map batches of pseudonymized records to FHIR resources in worker
+   processes. The workers are forked from the main process, so that the
+   mappers and their mapping tables are shared copy-on-write instead of
+   being pickled; a worker returns the validated resources (resource type,
+   id, JSON) of a batch and the main process adds them to the bundle in
+   the order of the batches. With less than two workers (or without fork
+   support) the batches are mapped in the main process
+   Arguments: logger, workers, mappers
+   Returns: mapped batches
+   Date: 10-19-2026'''
+
+import multiprocessing
+from collections import deque
+from lib.mii_profiles.fhirabstractbase import FHIRValidationError
+
+# Mappers of the current pool, inherited by the forked workers
+_mappers = None
+
+class MappedResource:
+  '''Validated FHIR resource returned by a mapping worker; provides
+     resource_type, id and as_json like the resources of the mappers'''
+
+  __slots__ = ('resource_type', 'id', '_json')
+
+  def __init__(self, resource_type, id, res_json):
+    self.resource_type = resource_type
+    self.id = id
+    self._json = res_json
+
+  def as_json(self):
+    return self._json
+
+# Validate resource; returns MappedResource or None if it is invalid
+def validate(res):
+  try:
+    return MappedResource(res.resource_type, res.id, res.as_json())
+  except FHIRValidationError:
+    return None
+
+def _map_batch(map_batch, batch):
+  return map_batch(_mappers, batch)
+
+class MappingPool:
+  '''Apply map_batch(mappers, batch) to batches in worker processes; at
+     most max_pending batches are mapped ahead of the main process, results
+     are yielded in the order of the batches'''
+
+  def __init__(self, logger, workers, mappers, max_pending=None):
+    global _mappers
+    self.logger = logger
+    self.mappers = mappers
+    self.max_pending = max_pending or 2 * workers
+    self.pool = None
+    if workers > 1:
+      if 'fork' not in multiprocessing.get_all_start_methods():
+        self.logger.warning("Start method 'fork' is not supported, map records "
+                            "in the main process")
+        return
+      if _mappers is not None:
+        raise RuntimeError("Another mapping pool is still running")
+      _mappers = mappers
+      self.pool = multiprocessing.get_context('fork').Pool(workers)
+      self.logger.info(f"Map records in {workers} worker processes")
+
+  # Yield (batch, result) pairs in the order of the batches; exceptions of
+  # the workers are raised in the main process
+  def map(self, map_batch, batches):
+    if self.pool is None:
+      for batch in batches:
+        yield batch, map_batch(self.mappers, batch)
+      return
+    pending = deque()
+    for batch in batches:
+      pending.append((batch, self.pool.apply_async(_map_batch, (map_batch, batch))))
+      if len(pending) >= self.max_pending:
+        batch, result = pending.popleft()
+        yield batch, result.get()
+    while pending:
+      batch, result = pending.popleft()
+      yield batch, result.get()
+
+  def close(self, terminate=False):
+    global _mappers
+    if self.pool is None:
+      return
+    if terminate:
+      self.pool.terminate()
+    else:
+      self.pool.close()
+    self.pool.join()
+    self.pool = None
+    _mappers = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close(terminate=exc_type is not None)
+    return False
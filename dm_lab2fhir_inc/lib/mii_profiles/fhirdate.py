@@ -28,16 +28,42 @@ class FHIRDate(object):
                 raise TypeError("Expecting string when initializing {}, but got {}"
                     .format(type(self), type(jsonval)))
             try:
-                if 'T' in jsonval:
-                    self.date = isodate.parse_datetime(jsonval)
-                else:
-                    self.date = isodate.parse_date(jsonval)
+                self.date = self._parse(jsonval)
             except Exception as e:
                 logger.warning("Failed to initialize FHIRDate from \"{}\": {}"
                     .format(jsonval, e))
         
         self.origval = jsonval
     
+    @staticmethod
+    def _parse(jsonval):
+        """ Parse an ISO 8601 date or date-time string; `fromisoformat` is
+        much faster than isodate, which handles the variants `fromisoformat`
+        does not know (e.g. "Z" or reduced precision).
+        """
+        if 'T' in jsonval:
+            try:
+                return datetime.datetime.fromisoformat(jsonval)
+            except ValueError:
+                return isodate.parse_datetime(jsonval)
+        try:
+            return datetime.date.fromisoformat(jsonval)
+        except ValueError:
+            return isodate.parse_date(jsonval)
+    
+    @classmethod
+    def from_datetime(cls, value):
+        """ Fast constructor for a `datetime` (or `pandas.Timestamp`):
+        serializes to its local date-time without offset and fractional
+        seconds like `cls(value.strftime('%Y-%m-%dT%H:%M:%S'))`, but
+        without formatting via strftime and parsing the string again.
+        """
+        inst = cls()
+        inst.date = datetime.datetime(value.year, value.month, value.day,
+                                      value.hour, value.minute, value.second)
+        inst.origval = inst.date.isoformat()
+        return inst
+    
     def __setattr__(self, prop, value):
         if 'date' == prop:
             self.origval = None
@@ -0,0 +1,150 @@
+#!/usr/bin/python3.6
+
+'''Write FHIR resources to NDJSON files (one resource per line) per
+   resource type, optionally gzip compressed and rotated by size, plus a
+   manifest with counts and hashes of the files. The writer can be synced
+   with the checkpoint of the ETL job, so that a resumed job appends to the
+   files written before
+   Arguments: logger, outdir, compress, max_file_bytes, state
+   Returns: none
+   Date: 10-19-2026'''
+
+import gzip
+import os
+from datetime import datetime, timezone
+from hashlib import sha256
+from itertools import repeat
+from . import json_codec
+
+MANIFEST_FILE = 'manifest.json'
+# file with canceled resources (resourceType, id) per line
+DELETED_TYPE = 'deleted'
+
+class NDJSONWriter:
+  '''Write FHIR resources to NDJSON files (one resource per line) per
+     resource type, optionally gzip compressed and rotated by size, plus a
+     manifest with counts and hashes of the files; state (see sync)
+     resumes writing the files of an aborted job'''
+
+  def __init__(self, logger, outdir, compress=False, max_file_bytes=1000000000, state=None):
+    self.logger = logger
+    self.outdir = outdir
+    self.compress = compress
+    self.max_file_bytes = max_file_bytes
+    self._files = {}
+    self.parts = []
+    os.makedirs(outdir, exist_ok=True)
+    if state:
+      self.parts = state['parts']
+      for res_type, part in state['files'].items():
+        self._open(res_type, part['part'], part)
+      self._remove_unsynced()
+      self.logger.info(f"Resume writing {len(self._files)} NDJSON files in {outdir}")
+
+  def _get_file_name(self, res_type, part):
+    suffix = '.ndjson.gz' if self.compress else '.ndjson'
+    if part:
+      return f"{res_type}.{part}{suffix}"
+    return f"{res_type}{suffix}"
+
+  # Remove NDJSON files written after the last sync (e.g. parts of a
+  # rotation), they are neither closed parts nor open files of the state
+  def _remove_unsynced(self):
+    suffix = self._get_file_name('', 0)
+    synced = {part['url'] for part in self.parts}
+    synced.update(part['name'] for part in self._files.values())
+    for file_name in os.listdir(self.outdir):
+      if file_name.endswith(suffix) and file_name not in synced:
+        self.logger.warning(f"Remove NDJSON file {file_name} written after the checkpoint")
+        os.remove(os.path.join(self.outdir, file_name))
+
+  # Open part of a resource type; with synced (see sync), the file is
+  # truncated to the synced size and written from there
+  def _open(self, res_type, part, synced=None):
+    file_name = self._get_file_name(res_type, part)
+    path = os.path.join(self.outdir, file_name)
+    if synced:
+      raw_file = open(path, 'r+b')
+      raw_file.truncate(synced['size'])
+      # truncate does not move the position
+      raw_file.seek(synced['size'])
+    else:
+      raw_file = open(path, 'wb')
+    # a gzip member is started by the first line written (see _write_line)
+    file = None if self.compress else raw_file
+    self._files[res_type] = {'file': file, 'raw_file': raw_file, 'name': file_name,
+                             'part': part, 'count': synced['count'] if synced else 0,
+                             'bytes': synced['bytes'] if synced else 0}
+    return self._files[res_type]
+
+  def _close(self, res_type):
+    part = self._files.pop(res_type)
+    if part['file'] is not None:
+      part['file'].close()
+    part['raw_file'].close()
+    path = os.path.join(self.outdir, part['name'])
+    file_hash = sha256()
+    with open(path, 'rb') as file:
+      for block in iter(lambda: file.read(1048576), b''):
+        file_hash.update(block)
+    self.parts.append({'type': res_type, 'url': part['name'], 'count': part['count'],
+                       'bytes': os.path.getsize(path), 'sha256': file_hash.hexdigest()})
+
+  def _write_line(self, res_type, res, res_json=None):
+    line = (res_json if res_json is not None else json_codec.dumps(res)) + b'\n'
+    part = self._files.get(res_type)
+    if part is None:
+      part = self._open(res_type, 0)
+    elif part['count'] and part['bytes'] + len(line) > self.max_file_bytes:
+      next_part = part['part'] + 1
+      self._close(res_type)
+      part = self._open(res_type, next_part)
+    if part['file'] is None:
+      part['file'] = gzip.GzipFile(fileobj=part['raw_file'], mode='wb')
+    part['file'].write(line)
+    part['count'] += 1
+    part['bytes'] += len(line)
+
+  # Open a written NDJSON file for reading
+  def open(self, path):
+    return gzip.open(path, 'rb') if self.compress else open(path, 'rb')
+
+  # Append FHIR resources of bundle entries to the files of their type;
+  # entries_json are the serialized resources if the bundle kept them
+  def write(self, entries, entries_json=None):
+    for entry, res_json in zip(entries, entries_json or repeat(None)):
+      self._write_line(entry['resource']['resourceType'], entry['resource'], res_json)
+
+  # Append canceled resources to the file of deleted resources
+  def delete(self, canceled_ids):
+    for res_type, res_ids in canceled_ids.items():
+      for res_id in res_ids:
+        self._write_line(DELETED_TYPE, {'resourceType': res_type, 'id': res_id})
+
+  # Flush the open files to disk and return the state to resume writing
+  # them; a gzip file is continued by a new gzip member once lines are
+  # written after the sync
+  def sync(self):
+    files = {}
+    for res_type, part in self._files.items():
+      if self.compress and part['file'] is not None:
+        part['file'].close()
+        part['file'] = None
+      part['raw_file'].flush()
+      os.fsync(part['raw_file'].fileno())
+      files[res_type] = {'part': part['part'], 'count': part['count'], 'bytes': part['bytes'],
+                         'size': part['raw_file'].tell()}
+    return {'parts': list(self.parts), 'files': files}
+
+  # Close all files and write manifest
+  def close(self):
+    for res_type in list(self._files):
+      self._close(res_type)
+    manifest = {'transactionTime': datetime.now(timezone.utc).isoformat(),
+                'output': [part for part in self.parts if part['type'] != DELETED_TYPE],
+                'deleted': [part for part in self.parts if part['type'] == DELETED_TYPE]}
+    with open(os.path.join(self.outdir, MANIFEST_FILE), 'w') as file:
+      file.write(json_codec.dumps_pretty(manifest))
+    self.logger.info(f"Wrote {sum(part['count'] for part in manifest['output'])} FHIR "
+                     f"resources to {len(manifest['output'])} NDJSON files in {self.outdir}")
+    return manifest
@@ -0,0 +1,41 @@
+#!/usr/bin/python3.6
+
+'''Discard FHIR resources after serializing them, counting resources and
+   bytes per resource type (dry run)
+   Arguments: logger
+   Returns: none
+   Date: 10-19-2026'''
+
+from itertools import repeat
+from . import json_codec
+
+class NullWriter:
+  '''Discard FHIR resources after serializing them, counting resources and
+     bytes per resource type (dry run)'''
+
+  def __init__(self, logger):
+    self.logger = logger
+    self.stats = {}
+    self.canceled = {}
+
+  def write(self, entries, entries_json=None):
+    for entry, res_json in zip(entries, entries_json or repeat(None)):
+      res_stats = self.stats.setdefault(entry['resource']['resourceType'],
+                                        {'resources': 0, 'bytes': 0})
+      res_stats['resources'] += 1
+      if res_json is None:
+        res_json = json_codec.dumps(entry['resource'])
+      res_stats['bytes'] += len(res_json)
+
+  def delete(self, canceled_ids):
+    for res_type, res_ids in canceled_ids.items():
+      self.canceled[res_type] = self.canceled.get(res_type, 0) + len(res_ids)
+
+  def close(self):
+    self.logger.info("Dry run results:")
+    for res_type, res_stats in sorted(self.stats.items()):
+      self.logger.info(f"  {res_type}: {res_stats['resources']} resources, "
+                       f"{res_stats['bytes']} bytes")
+    for res_type, nof_canceled in sorted(self.canceled.items()):
+      if nof_canceled:
+        self.logger.info(f"  {res_type}: {nof_canceled} requests for deletion")
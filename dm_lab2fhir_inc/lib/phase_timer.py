@@ -0,0 +1,99 @@
+#!/usr/bin/python3.6
+
+'''Measure the time spent in the phases of the ETL job (extract,
+   pseudonymize, map, validate, serialize, load). Nested phases are timed
+   exclusively, e.g. a bundle flush within the map phase counts as load.
+   Phases are nested per thread; if the phases of a stage run in
+   concurrent threads (stage pipeline), their times add up to more than
+   the total time
+   Arguments: none
+   Returns: none
+   Date: 10-19-2026'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+class PhaseTimer:
+  '''Measure the time spent in the phases of the ETL job'''
+
+  def __init__(self):
+    self.durations = {}
+    self.calls = {}
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._start_ts = time.perf_counter()
+
+  @property
+  def _stack(self):
+    if not hasattr(self._local, 'stack'):
+      self._local.stack = []
+    return self._local.stack
+
+  def _add(self, name, duration):
+    with self._lock:
+      self.durations[name] = self.durations.get(name, 0.0) + duration
+
+  @contextmanager
+  def phase(self, name):
+    stack = self._stack
+    now = time.perf_counter()
+    if stack:
+      parent_name, parent_ts = stack[-1]
+      self._add(parent_name, now - parent_ts)
+    stack.append((name, now))
+    with self._lock:
+      self.calls[name] = self.calls.get(name, 0) + 1
+    try:
+      yield
+    finally:
+      now = time.perf_counter()
+      name, phase_ts = stack.pop()
+      self._add(name, now - phase_ts)
+      if stack:
+        # resume parent phase
+        stack[-1] = (stack[-1][0], now)
+
+  # Time the retrieval of each item of iterable, e.g. chunks of a DB query
+  def iter(self, name, iterable):
+    iterator = iter(iterable)
+    while True:
+      with self.phase(name):
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  # Return proxy of obj timing all its method calls
+  def timed(self, name, obj):
+    return TimedProxy(self, name, obj)
+
+  def report(self, logger):
+    total = time.perf_counter() - self._start_ts
+    logger.info(f"Phase timing ({total:.2f}s in total):")
+    for name, duration in sorted(self.durations.items(), key=lambda item: -item[1]):
+      logger.info(f"  {name}: {duration:.2f}s ({100 * duration / total:.1f}%, "
+                  f"{self.calls[name]} calls)")
+    other = total - sum(self.durations.values())
+    if other >= 0:
+      logger.info(f"  other: {other:.2f}s ({100 * other / total:.1f}%)")
+    else:
+      logger.info(f"  overlap of concurrent phases: {-other:.2f}s")
+
+class TimedProxy:
+  '''Proxy timing the method calls of the wrapped object as phase name'''
+
+  def __init__(self, timer, name, obj):
+    self._timer = timer
+    self._name = name
+    self._obj = obj
+
+  def __getattr__(self, attr):
+    value = getattr(self._obj, attr)
+    if not callable(value):
+      return value
+    def timed_call(*args, **kwargs):
+      with self._timer.phase(self._name):
+        return value(*args, **kwargs)
+    return timed_call
@@ -0,0 +1,116 @@
+#!/usr/bin/python3.6
+
+'''Store FHIR resources in an embedded SQLite DB mirroring the table
+   resources_inc of the FHIR DB (upserts, soft deletions and reference
+   rewrites) for local runs and benchmarks
+   Arguments: logger, path, batch_size
+   Returns: none
+   Date: 10-19-2026'''
+
+import os
+import sqlite3
+from itertools import repeat
+from . import fhir_bundle
+
+SQL_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS resources_inc (
+                        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                        fhir_id         TEXT    NOT NULL,
+                        type            TEXT    NOT NULL,
+                        data            TEXT    NOT NULL,
+                        hash            TEXT,
+                        created_at      TEXT    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        last_updated_at TEXT    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        is_deleted      INTEGER NOT NULL DEFAULT 0,
+                        CONSTRAINT fhir_id_unique UNIQUE (fhir_id, type))'''
+
+# unchanged resources (same content hash) are skipped as in the FHIR DB
+SQL_UPSERT = '''INSERT INTO resources_inc (fhir_id, type, data, hash, is_deleted)
+                VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT (fhir_id, type) DO UPDATE
+                SET data = excluded.data,
+                    hash = excluded.hash,
+                    last_updated_at = CURRENT_TIMESTAMP,
+                    is_deleted = 0
+                WHERE resources_inc.hash IS NOT excluded.hash OR resources_inc.is_deleted'''
+
+SQL_SOFT_DELETE = '''UPDATE resources_inc
+                     SET is_deleted = 1, last_updated_at = CURRENT_TIMESTAMP
+                     WHERE fhir_id = ? AND type = ?'''
+
+SQL_SOFT_DELETE_REF = '''UPDATE resources_inc
+                         SET is_deleted = 1, last_updated_at = CURRENT_TIMESTAMP
+                         WHERE json_extract(data, '$.{field}.reference') = ? AND
+                               type IN ({types})'''
+
+SQL_UNKNOWN_REF = '''UPDATE resources_inc
+                     SET data = json_set(data, '$.{field}.reference', 'UNKNOWN'), hash = NULL,
+                         last_updated_at = CURRENT_TIMESTAMP
+                     WHERE json_extract(data, '$.{field}.reference') = ? AND
+                           type IN ({types})'''
+
+SQL_UNKNOWN_DIAG_REF = '''UPDATE resources_inc
+                          SET data = json_set(data, '$.diagnosis[' ||
+                                (SELECT key FROM json_each(resources_inc.data, '$.diagnosis')
+                                 WHERE json_extract(value, '$.condition.reference') = ?1) ||
+                                '].condition.reference', 'UNKNOWN'), hash = NULL,
+                              last_updated_at = CURRENT_TIMESTAMP
+                          WHERE type = 'Encounter' AND EXISTS
+                                (SELECT 1 FROM json_each(resources_inc.data, '$.diagnosis')
+                                 WHERE json_extract(value, '$.condition.reference') = ?1)'''
+
+class SQLiteWriter:
+  '''Store FHIR resources in an embedded SQLite DB mirroring the table
+     resources_inc of the FHIR DB'''
+
+  def __init__(self, logger, path, batch_size=1000):
+    self.logger = logger
+    self.path = path
+    self.batch_size = batch_size
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self.con = sqlite3.connect(path)
+    self.con.execute('PRAGMA journal_mode = WAL')
+    self.con.execute('PRAGMA synchronous = NORMAL')
+    self.con.execute(SQL_CREATE_TABLE)
+    self.con.commit()
+
+  # Upsert FHIR resources of bundle entries in batches
+  def write(self, entries, entries_json=None):
+    rows = []
+    with self.con:
+      for entry, res_json in zip(entries, entries_json or repeat(None)):
+        res = entry['resource']
+        rows.append((res['id'], res['resourceType'], fhir_bundle.get_json_str(res, res_json),
+                     fhir_bundle.get_content_hash(res)))
+        if len(rows) >= self.batch_size:
+          self.con.executemany(SQL_UPSERT, rows)
+          rows = []
+      if rows:
+        self.con.executemany(SQL_UPSERT, rows)
+
+  # Mark canceled resources as deleted and replace references to them by
+  # 'UNKNOWN' as done in the FHIR DB
+  def delete(self, canceled_ids):
+    with self.con:
+      for res_type, res_ids in canceled_ids.items():
+        if not res_ids:
+          continue
+        self.con.executemany(SQL_SOFT_DELETE, [(res_id, res_type) for res_id in res_ids])
+        refs = [(f"{res_type}/{res_id}",) for res_id in res_ids]
+        if res_type == 'Encounter':
+          self.con.executemany(SQL_UNKNOWN_REF.format(
+            field='encounter', types="'Condition', 'Procedure', 'Observation'"), refs)
+          self.con.executemany(SQL_UNKNOWN_REF.format(
+            field='context', types="'MedicationStatement'"), refs)
+        elif res_type == 'Patient':
+          self.con.executemany(SQL_SOFT_DELETE_REF.format(
+            field='subject', types="'Condition', 'Procedure', 'Observation'"), refs)
+          self.con.executemany(SQL_UNKNOWN_REF.format(
+            field='subject', types="'Encounter', 'MedicationStatement'"), refs)
+        elif res_type == 'Condition':
+          self.con.executemany(SQL_UNKNOWN_DIAG_REF, refs)
+
+  def close(self):
+    self.con.commit()
+    nof_res = self.con.execute('SELECT count(*) FROM resources_inc WHERE NOT is_deleted')
+    self.logger.info(f"SQLite DB {self.path} holds {nof_res.fetchone()[0]} FHIR resources")
+    self.con.close()
@@ -0,0 +1,133 @@
+#!/usr/bin/python3.6
+
+'''Run the phases of a stage concurrently, so that the next chunk is read
+   from the DWH and pseudonymized while the current one is mapped and the
+   previous one is loaded: an extract thread reads the chunks, a
+   pseudonymize thread requests the pseudonyms of a chunk by a pool of
+   threads, a map thread passes the chunks to the mapping pool and the
+   calling thread adds the mapped chunks to the bundle (load). The threads
+   are connected by queues of queue_size chunks, so a slow phase blocks
+   the phases before it; if a phase fails, all threads are stopped and the
+   error is raised in the calling thread
+   Arguments: logger, enabled, queue_size, pseudonymize_threads, timer
+   Returns: mapped chunks
+   Date: 10-19-2026'''
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from lib import phase_timer
+
+_END = object()
+
+class StagePipeline:
+  '''Pipeline of the phases of a stage; without enabled, the phases run
+     one after another in the calling thread'''
+
+  def __init__(self, logger, enabled=False, queue_size=2, pseudonymize_threads=4, timer=None):
+    self.logger = logger
+    self.enabled = enabled
+    self.queue_size = queue_size
+    self.pseudonymize_threads = pseudonymize_threads
+    self.timer = timer if timer else phase_timer.PhaseTimer()
+    self._threads = []
+    self._stop = threading.Event()
+    self._error = None
+    self._lock = threading.Lock()
+
+  def _fail(self, exc):
+    with self._lock:
+      if self._error is None:
+        self._error = exc
+    self._stop.set()
+
+  # Put item into queue, waits while it is full; False if the pipeline was
+  # stopped
+  def _put(self, out_queue, item):
+    with self.timer.phase('wait'):
+      while not self._stop.is_set():
+        try:
+          out_queue.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+    return False
+
+  # Yield items of queue until its end or until the pipeline was stopped
+  def _iter(self, in_queue):
+    while True:
+      with self.timer.phase('wait'):
+        item = _END
+        while not self._stop.is_set():
+          try:
+            item = in_queue.get(timeout=0.1)
+            break
+          except queue.Empty:
+            pass
+      if item is _END:
+        return
+      yield item
+
+  def _start(self, name, target, *args):
+    def run():
+      try:
+        target(*args)
+      except BaseException as exc:
+        self.logger.error(f"In {__name__}: Phase '{name}' failed ({exc})")
+        self._fail(exc)
+    thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+    self._threads.append(thread)
+    thread.start()
+
+  def _extract(self, chunks, out_queue):
+    for chunk in chunks:
+      if not self._put(out_queue, chunk):
+        return
+    self._put(out_queue, _END)
+
+  def _pseudonymize(self, pseudonymize, in_queue, out_queue):
+    with ThreadPoolExecutor(max_workers=self.pseudonymize_threads) as executor:
+      for chunk in self._iter(in_queue):
+        if not self._put(out_queue, pseudonymize(chunk, executor)):
+          return
+    self._put(out_queue, _END)
+
+  def _map(self, map_batches, in_queue, out_queue):
+    with self.timer.phase('map'):
+      for mapped in map_batches(self._iter(in_queue)):
+        if not self._put(out_queue, mapped):
+          return
+    self._put(out_queue, _END)
+
+  def _shutdown(self):
+    self._stop.set()
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  # Yield the mapped chunks in the order of the chunks; pseudonymize(chunk,
+  # executor) returns the batch of a chunk (executor is None if the
+  # pipeline is disabled), map_batches(batches) yields the mapped batches
+  def run(self, chunks, pseudonymize, map_batches):
+    if not self.enabled:
+      yield from map_batches(pseudonymize(chunk, None) for chunk in chunks)
+      return
+    extracted, pseudonymized, mapped = [queue.Queue(maxsize=self.queue_size)
+                                        for _ in range(3)]
+    self._start('extract', self._extract, chunks, extracted)
+    self._start('pseudonymize', self._pseudonymize, pseudonymize, extracted, pseudonymized)
+    self._start('map', self._map, map_batches, pseudonymized, mapped)
+    yield from self._iter(mapped)
+    self._shutdown()
+    if self._error is not None:
+      raise self._error
+
+  def __enter__(self):
+    return self
+
+  # Stop the threads if the calling thread failed or stopped early
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._shutdown()
+    if exc_type is None and self._error is not None:
+      raise self._error
+    return False
@@ -0,0 +1,72 @@
+#!/usr/bin/python3.6
+
+'''Cache the parsed mapping tables (dat/*.csv) as pickle files, so that
+   later jobs load the DataFrame instead of parsing the CSV. A cache entry
+   is keyed by path, read options, size, mtime and sha256 of the CSV; if
+   only the mtime changed, the content hash decides whether the entry is
+   still valid
+   Arguments: logger, cache_dir
+   Returns: DataFrame
+   Date: 10-19-2026'''
+
+import os
+import pickle
+from hashlib import sha256
+import pandas as pd
+
+class TableCache:
+  '''Read CSV files via a pickle cache; without cache_dir the CSV files
+     are parsed on each call'''
+
+  def __init__(self, logger, cache_dir=None):
+    self.logger = logger
+    self.cache_dir = cache_dir
+    if cache_dir:
+      os.makedirs(cache_dir, exist_ok=True)
+
+  def _get_cache_path(self, path, read_options):
+    cache_name = sha256(f"{os.path.abspath(path)}{read_options}".encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, f"{cache_name}.pkl")
+
+  def _load(self, cache_path):
+    if not os.path.exists(cache_path):
+      return None
+    try:
+      with open(cache_path, 'rb') as file:
+        return pickle.load(file)
+    except Exception as exc:
+      self.logger.warning(f"Ignore unreadable cache file {cache_path} ({exc})")
+      return None
+
+  def _store(self, cache_path, entry):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+      pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+  def read_csv(self, path, **read_options):
+    if not self.cache_dir:
+      return pd.read_csv(path, **read_options)
+    read_options_key = repr(sorted(read_options.items()))
+    cache_path = self._get_cache_path(path, read_options_key)
+    stat = os.stat(path)
+    entry = self._load(cache_path)
+    if entry and entry['pandas'] == pd.__version__ and entry['size'] == stat.st_size:
+      if entry['mtime'] == stat.st_mtime_ns:
+        return entry['table']
+      with open(path, 'rb') as file:
+        content_hash = sha256(file.read()).hexdigest()
+      if entry['sha256'] == content_hash:
+        entry['mtime'] = stat.st_mtime_ns
+        self._store(cache_path, entry)
+        return entry['table']
+
+    with open(path, 'rb') as file:
+      content_hash = sha256(file.read()).hexdigest()
+    table = pd.read_csv(path, **read_options)
+    self._store(cache_path, {'path': path, 'read_options': read_options_key,
+                             'pandas': pd.__version__, 'size': stat.st_size,
+                             'mtime': stat.st_mtime_ns, 'sha256': content_hash,
+                             'table': table})
+    self.logger.info(f"Cached mapping table {path} in {cache_path}")
+    return table
@@ -10,26 +10,101 @@
             Lukas Goetz, Lukas.Goetz@medma.uni-heidelberg.de
    Date: 01-04-2021'''
 
+import functools
 import pandas as pd
-from datetime import datetime
 
 from lib.mii_profiles import fhirreference
 from lib.mii_profiles.fhirabstractbase import FHIRValidationError
 
-from . import umm_db_lib
 from . import (mapper_dmpat2pat, mapper_dmlab2obs, mapper_dmdiag2cond,
                mapper_dmenc2obs, mapper_dmpro2pro_med, mapper_dmenc2enc,
                mapper_dmdep2enc, mapper_dmtrans2obs,
                mapper_lufu_snomed_lookup, mapper_lufu_i2b2basecode_lookup,
                mapper_lufufall2obs, mapper_lufufall2rep, mapper_lufu_loinc_lookup,
                mapper_lufufall2proc, mapper_lufu_procedure_lookup,
-               fhir_bundle, pseudonymizer)
+               fhir_bundle, fhir_datetime, pseudonymizer, phase_timer, checkpoint,
+               lookup_tables, table_cache, mapping_pool, stage_pipeline)
 
 class UMMPeriod:
   def __init__(self, start, end):
     self.start = start
     self.end = end
 
+def timed_stage(process):
+  '''Time stage as phase 'map'; as phases are timed exclusively, this is
+     the time not spent in extract, pseudonymize, validate, serialize or load'''
+  @functools.wraps(process)
+  def timed_process(self, *args, **kwargs):
+    with self.timer.phase('map'):
+      return process(self, *args, **kwargs)
+  return timed_process
+
+def resumable_stage(stage):
+  '''Skip stage if it was completed before the job was resumed, otherwise
+     record its progress in the checkpoint'''
+  def decorator(process):
+    @functools.wraps(process)
+    def resumable_process(self, *args, **kwargs):
+      if self.checkpoint.is_completed(stage):
+        self.logger.info(f"Skip stage '{stage}' which was completed before")
+        return {}
+      self._progress = self.checkpoint.start_stage(stage)
+      res_stats = process(self, *args, **kwargs)
+      self.checkpoint.complete_stage(stage)
+      return res_stats
+    return resumable_process
+  return decorator
+
+# Batch functions of the mapping pool: map a batch (chunk, encounter and
+# patient pseudonyms) and return one result per record, None for canceled
+# records which are removed by the main process
+def _map_transfer_batch(mapper, batch):
+  chunk, encounter_psns, patient_psns = batch
+  results = []
+  for record, encounter_psn, patient_psn in zip(chunk.itertuples(), encounter_psns,
+                                                patient_psns):
+    if record.stdat:
+      results.append(None)
+      continue
+    mapper.read(encounter_psn, patient_psn, record)
+    results.append([mapping_pool.validate(res) for res in mapper.map_template()])
+  return results
+
+def _map_diagnosis_batch(mapper, batch):
+  chunk, encounter_psns, patient_psns = batch
+  results = []
+  for record, encounter_psn, patient_psn in zip(chunk.itertuples(), encounter_psns,
+                                                patient_psns):
+    if record.stdat:
+      results.append(None)
+      continue
+    mapper.read(encounter_psn, patient_psn, record, mapper.logger)
+    results.append(mapping_pool.validate(mapper.map_template()[0]))
+  return results
+
+# Medication/ MedicationStatement are False if the mapper created none
+def _map_procedure_batch(mapper, batch):
+  chunk, encounter_psns, patient_psns = batch
+  results = []
+  for record, encounter_psn, patient_psn in zip(chunk.itertuples(), encounter_psns,
+                                                patient_psns):
+    if record.stdat:
+      results.append(None)
+      continue
+    mapper.read(encounter_psn, patient_psn, record.procedure_begin_timestamp,
+                record.procedure_end_timestamp, record)
+    results.append([mapping_pool.validate(res) if res else False for res in mapper.map()])
+  return results
+
+def _map_lab_batch(mapper, batch):
+  chunk, encounter_psns, patient_psns = batch
+  results = []
+  for record, encounter_psn, patient_psn in zip(chunk.itertuples(), encounter_psns,
+                                                patient_psns):
+    mapper.read(encounter_psn, patient_psn, record)
+    results.append(mapping_pool.validate(mapper.map_template()))
+  return results
+
 class UMMDestination:
   def __init__(self, dtype, endpoint):
     self.dtype = dtype
@@ -42,32 +117,127 @@ class UMMonFHIR:
      Condition and DiagnosticReport
    Arguments: config, logger'''
 
-  def __init__(self, config, logger):
-    admissionreason_1_2 = pd.read_csv(config['dat_paths']['admissionreason_1_2'])
-    admissionreason_3_4 = pd.read_csv(config['dat_paths']['admissionreason_3_4'])
-    dischargereason_1_2 = pd.read_csv(config['dat_paths']['dischargereason_1_2'])
-    dischargereason_3 = pd.read_csv(config['dat_paths']['dischargereason_3'])
-    dep_codes = pd.read_csv(config['dat_paths']['department_codes'])
+  def __init__(self, config, logger, stage_checkpoint=None):
     self.systems = config['systems']
-
-    self.map_table = []
-    self.map_table.append([admissionreason_1_2, admissionreason_3_4,
-                           dischargereason_1_2, dischargereason_3])
-    ops_drug_mapping = pd.read_csv(config['dat_paths']['ops_drug_mapping'], sep=';')
-    drug_unii_mapping = pd.read_csv(config['dat_paths']['drug_unii_mapping'], sep=';')
-    self.map_table.append([ops_drug_mapping, drug_unii_mapping])
-    self.map_table.append(dep_codes)
-    lufuloincmapping = pd.read_csv(config['dat_paths']['lufu_loinc_mapping'], encoding='utf-8')
-    self.map_table.append(lufuloincmapping)
+    self.dat_paths = config['dat_paths']
+    self.table_cache = table_cache.TableCache(logger, config.get('dat_cache', 'path',
+                                                                 fallback=None))
+    self._lookups = {}
 
     self.input_chunk_size = 100
+    self.mapping_workers = config.getint('mapping', 'workers', fallback=0)
+    self.pipeline = config.getboolean('pipeline', 'enabled', fallback=False)
+    self.pipeline_queue_size = config.getint('pipeline', 'queue_size', fallback=2)
+    self.pseudonymize_threads = config.getint('pipeline', 'pseudonymize_threads', fallback=4)
+    self.flush_entries = config.getint('bundle', 'flush_entries', fallback=5000)
+    self.flush_bytes = config.getint('bundle', 'flush_bytes', fallback=50000000)
+    self.dedup_max_keys = config.getint('bundle', 'dedup_max_keys', fallback=100000)
+    self.dedup_policy = config.get('bundle', 'dedup_policy', fallback='first')
+    self.dedup_fingerprint = config.getboolean('bundle', 'dedup_fingerprint', fallback=False)
+    self.entry_mode = config.get('hapi', 'entry_mode', fallback='conditional')
+    self.timer = phase_timer.PhaseTimer()
+    self.checkpoint = stage_checkpoint if stage_checkpoint else checkpoint.Checkpoint(logger)
+    self._progress = checkpoint.StageProgress(self.checkpoint, None)
     self.psn_url = config['server']['url_gpas']
     self.loinc_url = config['server']['url_loinc_converter']
     self.logger = logger
 
+  # Mapping/code tables are loaded on first use, i.e. only for the stages
+  # which are processed
+  def _get_terminology(self):
+    if 'terminology' not in self._lookups:
+      read_csv = self.table_cache.read_csv
+      self._lookups['terminology'] = lookup_tables.TerminologyLookup(
+        read_csv(self.dat_paths['admissionreason_1_2']),
+        read_csv(self.dat_paths['admissionreason_3_4']),
+        read_csv(self.dat_paths['dischargereason_1_2']),
+        read_csv(self.dat_paths['dischargereason_3']),
+        read_csv(self.dat_paths['department_codes']))
+    return self._lookups['terminology']
+
+  def _get_drug_lookups(self):
+    if 'drug' not in self._lookups:
+      ops_drug_mapping = self.table_cache.read_csv(self.dat_paths['ops_drug_mapping'], sep=';')
+      drug_unii_mapping = self.table_cache.read_csv(self.dat_paths['drug_unii_mapping'], sep=';')
+      self._lookups['drug'] = [lookup_tables.build_ops_drug_index(ops_drug_mapping),
+                               lookup_tables.build_substance_index(drug_unii_mapping)]
+    return self._lookups['drug']
+
+  def _get_lufu_loinc_mapping(self):
+    if 'lufu_loinc' not in self._lookups:
+      self._lookups['lufu_loinc'] = self.table_cache.read_csv(
+        self.dat_paths['lufu_loinc_mapping'], encoding='utf-8')
+    return self._lookups['lufu_loinc']
+
+  def _create_pseudonymizer(self):
+    return self.timer.timed('pseudonymize',
+                            pseudonymizer.Pseudonymizer(self.logger, self.psn_url))
+
+  # Read records from DWH; chunks of chunked queries are read lazily
+  def _read_sql(self, sql_query, db_con_dwh, chunksize=None):
+    with self.timer.phase('extract'):
+      result = pd.read_sql_query(sql_query, db_con_dwh, chunksize=chunksize)
+    if chunksize:
+      return self.timer.iter('extract', result)
+    return result
+
+  # Validate FHIR resource, raises FHIRValidationError
+  def _validate(self, res):
+    with self.timer.phase('validate'):
+      res.as_json()
+
+  def _create_mapping_pool(self, mappers):
+    return mapping_pool.MappingPool(self.logger, self.mapping_workers, mappers)
+
+  def _create_pipeline(self):
+    return stage_pipeline.StagePipeline(self.logger, self.pipeline, self.pipeline_queue_size,
+                                        self.pseudonymize_threads, self.timer)
+
+  # Pseudonymize the pending records of a chunk and return the batch (chunk,
+  # encounter pseudonyms, patient pseudonyms) for the mapping pool; the
+  # records are pseudonymized concurrently if executor is given. Canceled
+  # records (stdat) are pseudonymized by the encounter id in delete_column
+  def _pseudonymize_chunk(self, chunk, executor, new_pseudonymizer, timestamp_columns=(),
+                          delete_column=None):
+    def request_psns(record):
+      if delete_column and record.stdat:
+        return new_pseudonymizer.request_encounter_psn(getattr(record, delete_column)), None
+      patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
+      return new_pseudonymizer.request_encounter_psn(record.encounter_id), patient_psn
+
+    fhir_datetime.format_datetime_columns(chunk, timestamp_columns)
+    chunk = self._progress.pending_rows(chunk)
+    records = chunk.itertuples()
+    psns = list(executor.map(request_psns, records) if executor else map(request_psns, records))
+    return (chunk, [encounter_psn for encounter_psn, _ in psns],
+            [patient_psn for _, patient_psn in psns])
+
+  # Map the records of the chunks by map_batch in the mapping pool and yield
+  # (batch, results) in the order of the chunks; with the stage pipeline,
+  # the chunks are read, pseudonymized and mapped in threads while the
+  # caller adds the results to the bundle
+  def _map_chunks(self, chunks, new_pseudonymizer, mappers, map_batch, timestamp_columns=(),
+                  delete_column=None):
+    pseudonymize = functools.partial(self._pseudonymize_chunk,
+                                     new_pseudonymizer=new_pseudonymizer,
+                                     timestamp_columns=timestamp_columns,
+                                     delete_column=delete_column)
+    # the mapping pool forks its workers before the pipeline starts threads
+    with self._create_mapping_pool(mappers) as pool, self._create_pipeline() as pipeline:
+      yield from pipeline.run(chunks, pseudonymize, functools.partial(pool.map, map_batch))
+
+  def _create_bundle(self, dest):
+    return fhir_bundle.StreamingFHIRBundle(self.logger, dest, self.flush_entries,
+                                           self.flush_bytes, self.dedup_max_keys,
+                                           self.dedup_policy, self.dedup_fingerprint,
+                                           self.entry_mode, self.timer,
+                                           self._progress.on_flush)
+
+  @resumable_stage('patients')
+  @timed_stage
   def process_patients(self, period, db_con_dwh, dest, verbose):
-      new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)
-      new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+      new_pseudonymizer = self._create_pseudonymizer()
+      new_fhir_bundle = self._create_bundle(dest)
       new_mapper_dmpat2pat = mapper_dmpat2pat.MapperDMPat2Pat(self.logger,
                                                               self.systems)    
       self.logger.info("I. Process new/ updated/ canceled patient records "
@@ -84,15 +254,15 @@ class UMMonFHIR:
                           SELECT * FROM ups_pat
                           FULL OUTER JOIN del_pat
                           ON ups_pat.patient_id = del_pat.patnr::int
-                          ORDER BY stdat DESC'''
+                          ORDER BY stdat DESC, patient_id, patnr'''
       first_upsert = True
       first_rm = True
       added_res_pat = 0
       res_pat_invalid = 0
       rm_res_pat = 0
-      for chunk in pd.read_sql_query(sql_query_pat, db_con_dwh,
-                                     chunksize=self.input_chunk_size):
-        for record in chunk.itertuples():
+      for chunk in self._read_sql(sql_query_pat, db_con_dwh,
+                                  chunksize=self.input_chunk_size):
+        for record in self._progress.records(chunk.itertuples()):
           # Upsert FHIR patient resources
           if not record.stdat:
             if first_upsert:
@@ -103,7 +273,7 @@ class UMMonFHIR:
               patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
               new_mapper_dmpat2pat.read(patient_psn, record)
               inpatient = new_mapper_dmpat2pat.map()
-              inpatient.as_json()
+              self._validate(inpatient)
               new_fhir_bundle.add_resources([inpatient])
               added_res_pat += 1
             except FHIRValidationError:
@@ -119,6 +289,7 @@ class UMMonFHIR:
             patient_psn = new_pseudonymizer.request_patient_psn(record.patnr)
             new_fhir_bundle.rm_resources('Patient', patient_psn)
             rm_res_pat += 1
+          new_fhir_bundle.end_record()
 
       res_stats = {'valid_pat': added_res_pat, 'invalid_pat': res_pat_invalid,
                    'rm_req_pat': rm_res_pat}
@@ -136,11 +307,8 @@ class UMMonFHIR:
                           "Patient resources")
 
       if dest.dtype == 'psql':
-        current_ts = datetime.now()
-        print(current_ts)
         new_fhir_bundle.execute(dest)
-        ups_res_pat, rm_res_pat = umm_db_lib.get_ups_rm_num_fhir('Patient', current_ts,
-                                                                 dest.endpoint)
+        ups_res_pat, rm_res_pat = new_fhir_bundle.get_ups_rm_num('Patient')
         res_stats_ext = {'ups_pat': ups_res_pat, 'rm_pat': rm_res_pat}
         res_stats.update(res_stats_ext)
         if verbose:
@@ -152,16 +320,18 @@ class UMMonFHIR:
 
       return res_stats
 
+  @resumable_stage('encounters')
+  @timed_stage
   def process_encounters(self, period, db_con_dwh, dest, verbose):
-      new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)
-      new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+      new_pseudonymizer = self._create_pseudonymizer()
+      new_fhir_bundle = self._create_bundle(dest)
       new_mapper_dmdiag2cond = mapper_dmdiag2cond.MapperDMDiag2Cond(self.logger,
                                                                     self.systems)
       new_mapper_dmenc2obs = mapper_dmenc2obs.MapperDMEnc2Obs(self.logger, self.systems)
       new_mapper_dmenc2enc = mapper_dmenc2enc.MapperDMEnc2Enc(self.logger, self.systems,
-                                                              self.map_table[0])
+                                                              self._get_terminology())
       new_mapper_dmdep2enc = mapper_dmdep2enc.MapperDMDep2Enc(self.logger, self.systems,
-                                                              self.map_table[2])
+                                                              self._get_terminology())
       self.logger.info("II. Process new/ updated/ canceled encounter records "
                       f"between {period.start} and {period.end} ...")
       sql_query_enc = f'''WITH ups_enc AS (
@@ -179,7 +349,7 @@ class UMMonFHIR:
                           SELECT * FROM ups_enc
                           FULL OUTER JOIN del_enc
                           ON ups_enc.encounter_id = del_enc.falnr::int
-                          ORDER BY stdat DESC'''
+                          ORDER BY stdat DESC, encounter_id, falnr'''
       first_upsert = True
       first_rm = True
       added_res_subenc = 0
@@ -193,9 +363,9 @@ class UMMonFHIR:
       added_res_loc = 0
       res_loc_invalid = 0
       rm_res_enc = 0
-      for chunk in pd.read_sql_query(sql_query_enc, db_con_dwh,
-                                     chunksize=self.input_chunk_size):
-        for record in chunk.itertuples():
+      for chunk in self._read_sql(sql_query_enc, db_con_dwh,
+                                  chunksize=self.input_chunk_size):
+        for record in self._progress.records(chunk.itertuples()):
           # Upsert new/ updated encounters
           if not record.stdat:
             if first_upsert:
@@ -204,7 +374,7 @@ class UMMonFHIR:
               first_upsert = False
             # Extract and map conditions
             condition_list = []
-            cond_chunk = pd.read_sql_query(f'''SELECT * FROM dwh.rf_med_cov_diagnosis
+            cond_chunk = self._read_sql(f'''SELECT * FROM dwh.rf_med_cov_diagnosis
                                                WHERE encounter_id =
                                                {record.encounter_id}''', db_con_dwh)
             patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
@@ -214,8 +384,8 @@ class UMMonFHIR:
               try:
                 new_mapper_dmdiag2cond.read(encounter_psn, patient_psn, cond_record,
                                             self.logger)
-                icd_condition = new_mapper_dmdiag2cond.map()
-                icd_condition[0].as_json()
+                icd_condition = new_mapper_dmdiag2cond.map_template()
+                self._validate(icd_condition[0])
                 condition_list.append(icd_condition)
                 added_res_con += 1
               except FHIRValidationError:
@@ -237,7 +407,7 @@ class UMMonFHIR:
             sub_encounter_list = []
             location_list_total = []
             # Extract p301 departments
-            department_set = pd.read_sql_query(f'''SELECT DISTINCT dwh_unit.dept_p301_code
+            department_set = self._read_sql(f'''SELECT DISTINCT dwh_unit.dept_p301_code
                                                    FROM dwh.rf_med_cov_transfer dwh_trans
                                                    JOIN dwh.rd_med_cov_unit dwh_unit
                                                    ON dwh_unit.unit_id = dwh_trans.event_unit_id
@@ -246,7 +416,7 @@ class UMMonFHIR:
             ## Extract and map transfers within each p301 department
             for department in department_set.itertuples():
             #  # todo: adjust timezone, currently UTC?!
-              transfer_set = pd.read_sql_query(f'''SELECT *
+              transfer_set = self._read_sql(f'''SELECT *
                                                    FROM dwh.rf_med_cov_transfer dwh_trans
                                                    JOIN dwh.rd_med_cov_unit dwh_unit
                                                    ON dwh_unit.unit_id = dwh_trans.event_unit_id
@@ -261,7 +431,7 @@ class UMMonFHIR:
               res_loc_invalid += res_loc_invalid2
               location_list_total = location_list_total + location_list
               try:
-                sub_encounter.as_json()
+                self._validate(sub_encounter)
                 sub_encounter_list.append(sub_encounter)
                 added_res_subenc += 1
               except FHIRValidationError:
@@ -273,8 +443,8 @@ class UMMonFHIR:
 
             try:
               new_mapper_dmenc2obs.read(encounter_psn, patient_psn, record)
-              vent_observation = new_mapper_dmenc2obs.map()
-              vent_observation.as_json()
+              vent_observation = new_mapper_dmenc2obs.map_template()
+              self._validate(vent_observation)
               new_fhir_bundle.add_resources([vent_observation])
               added_res_obs += 1
             except FHIRValidationError:
@@ -286,7 +456,7 @@ class UMMonFHIR:
               new_mapper_dmenc2enc.read(ranked_cond_ref, patient_psn,
                                         encounter_psn, record)
               main_encounter = new_mapper_dmenc2enc.map()
-              main_encounter.as_json()
+              self._validate(main_encounter)
               new_fhir_bundle.add_resources([main_encounter])
               new_fhir_bundle.add_resources(condition_list_2)
               new_fhir_bundle.add_resources(sub_encounter_list)
@@ -312,6 +482,7 @@ class UMMonFHIR:
             obs_id = encounter_psn + '_vent'
             new_fhir_bundle.rm_resources('Observation', obs_id)
             rm_res_enc += 1
+          new_fhir_bundle.end_record()
 
       res_stats = {'valid_con': added_res_con, 'invalid_con': res_con_invalid,
                    'valid_enc': added_res_enc, 'invalid_enc': res_enc_invalid,
@@ -347,14 +518,10 @@ class UMMonFHIR:
         self.logger.info(f"Created {res_stats['rm_req_enc']} requests to delete Encounter/ Observation "
                       "(ventilation) resources")    
       if dest.dtype == 'psql':
-        current_ts = datetime.now()
         new_fhir_bundle.execute(dest)
-        ups_res_con, rm_res_con = umm_db_lib.get_ups_rm_num_fhir('Condition', current_ts,
-                                                                   dest.endpoint)
-        ups_res_enc, rm_res_enc = umm_db_lib.get_ups_rm_num_fhir('Encounter', current_ts,
-                                                                   dest.endpoint)
-        ups_res_obs, rm_res_obs = umm_db_lib.get_ups_rm_num_fhir('Obs_vent', current_ts,
-                                                                   dest.endpoint)
+        ups_res_con, rm_res_con = new_fhir_bundle.get_ups_rm_num('Condition')
+        ups_res_enc, rm_res_enc = new_fhir_bundle.get_ups_rm_num('Encounter')
+        ups_res_obs, rm_res_obs = new_fhir_bundle.get_ups_rm_num('Obs_vent')
         res_stats_ext = {'ups_con': ups_res_con, 'rm_con': rm_res_con,
                          'ups_enc': ups_res_enc, 'rm_enc': rm_res_enc,
                          'ups_obs': ups_res_obs, 'rm_obs': rm_res_obs}
@@ -371,9 +538,11 @@ class UMMonFHIR:
 
       return res_stats
   
+  @resumable_stage('transfers')
+  @timed_stage
   def process_transfers(self, period, db_con_dwh, dest, verbose):
-      new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)    
-      new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+      new_pseudonymizer = self._create_pseudonymizer()    
+      new_fhir_bundle = self._create_bundle(dest)
       new_mapper_dmtrans2obs = mapper_dmtrans2obs.MapperDMTrans2Obs(self.logger, self.systems)
       self.logger.info("III. Process new/ updated/ canceled transfer records "
                       f"between {period.start} and {period.end} ...")
@@ -403,7 +572,9 @@ class UMMonFHIR:
                            FULL OUTER JOIN del_trans
                            ON ups_trans.encounter_id = del_trans.falnr_delete::int AND
                               ups_trans.event_nr = del_trans.lfdnr_delete::int
-                           ORDER BY stdat DESC'''
+                           ORDER BY stdat DESC, encounter_id, falnr_delete, patient_id,
+                                    icu_days, intercurrent_dialyses, admission_timestamp,
+                                    discharge_timestamp'''
       first_upsert = True
       first_rm = True
       added_res_dial_obs = 0
@@ -411,34 +582,30 @@ class UMMonFHIR:
       added_res_icu_obs = 0
       res_icu_obs_invalid = 0
       rm_res = 0
-      for chunk in pd.read_sql_query(sql_query_trans, db_con_dwh,
-                                     chunksize=self.input_chunk_size):
-        for record in chunk.itertuples():
+      chunks = self._read_sql(sql_query_trans, db_con_dwh, chunksize=self.input_chunk_size)
+      for (chunk, encounter_psns, _), results in self._map_chunks(
+          chunks, new_pseudonymizer, new_mapper_dmtrans2obs, _map_transfer_batch,
+          ['admission_timestamp', 'discharge_timestamp'], 'falnr_delete'):
+        for record, encounter_psn, result in zip(chunk.itertuples(), encounter_psns,
+                                                 results):
           # Upsert new/ updated transfers
           if not record.stdat:
             if first_upsert:
               self.logger.info("Create & validate FHIR Observation (ICU days, dialysis) "
                                "resources ...")
               first_upsert = False
-            patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.encounter_id)
-
-
-            new_mapper_dmtrans2obs.read(encounter_psn, patient_psn, record)
-            [dialysis_obs, icu_obs] = new_mapper_dmtrans2obs.map()
-            try:
-              dialysis_obs.as_json()
+            [dialysis_obs, icu_obs] = result
+            if dialysis_obs is not None:
               new_fhir_bundle.add_resources([dialysis_obs])
               added_res_dial_obs += 1
-            except FHIRValidationError as exc:
+            else:
               self.logger.debug("Validation error for created Observation resource "
                                f"(id: {encounter_psn}-dia)")
               res_dial_obs_invalid += 1
-            try:
-              icu_obs.as_json()
+            if icu_obs is not None:
               new_fhir_bundle.add_resources([icu_obs])
               added_res_icu_obs += 1
-            except FHIRValidationError:
+            else:
               self.logger.debug("Validation error for created Observation resource "
                                f"(id: {encounter_psn}-icu)")
               res_icu_obs_invalid += 1
@@ -447,12 +614,13 @@ class UMMonFHIR:
               self.logger.info("Create request to remove canceled FHIR Observation "
                                "(ICU days, dialysis) resources ...")
               first_rm = False
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.falnr_delete)
             obs_id = encounter_psn + '_icu'
             new_fhir_bundle.rm_resources('Observation', obs_id)
             obs_id = encounter_psn + '_dia'
             new_fhir_bundle.rm_resources('Observation', obs_id)
             rm_res += 1
+          self._progress.done()
+          new_fhir_bundle.end_record()
 
       res_stats = {'valid_dial': added_res_dial_obs, 'invalid_dial': res_dial_obs_invalid,
                    'valid_icu': added_res_icu_obs, 'invalid_icu': res_icu_obs_invalid,
@@ -473,12 +641,9 @@ class UMMonFHIR:
         self.logger.info(f"Created {res_stats['rm_req_res']} requests to delete Observation "
                       "(dialysis, ICU days) resources")
       if dest.dtype == 'psql':
-        current_ts = datetime.now()
         new_fhir_bundle.execute(dest)
-        ups_res_dial, rm_res_dial = umm_db_lib.get_ups_rm_num_fhir('Obs_dial', current_ts,
-                                                                     dest.endpoint)
-        ups_res_icu, rm_res_icu = umm_db_lib.get_ups_rm_num_fhir('Obs_icu', current_ts,
-                                                                    dest.endpoint)
+        ups_res_dial, rm_res_dial = new_fhir_bundle.get_ups_rm_num('Obs_dial')
+        ups_res_icu, rm_res_icu = new_fhir_bundle.get_ups_rm_num('Obs_icu')
         res_stats_ext = {'ups_dial': ups_res_dial, 'rm_dial': rm_res_dial,
                          'ups_icu': ups_res_icu, 'rm_icu': rm_res_icu}
         res_stats.update(res_stats_ext)
@@ -493,9 +658,11 @@ class UMMonFHIR:
 
       return res_stats
 
+  @resumable_stage('conditions')
+  @timed_stage
   def process_conditions(self, period, db_con_dwh, dest, verbose):
-      new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)      
-      new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+      new_pseudonymizer = self._create_pseudonymizer()      
+      new_fhir_bundle = self._create_bundle(dest)
       new_mapper_dmdiag2cond = mapper_dmdiag2cond.MapperDMDiag2Cond(self.logger,
                                                                     self.systems)    
       self.logger.info("IV. Process new/ updated/ canceled diagnosis records "
@@ -520,40 +687,40 @@ class UMMonFHIR:
                            FULL OUTER JOIN del_cond
                            ON ups_cond.encounter_id = del_cond.falnr_delete::int AND
                               ups_cond.diagnosis_nr = del_cond.lfdnr_delete::int
-                           ORDER BY stdat DESC'''
+                           ORDER BY stdat DESC, encounter_id, diagnosis_nr, falnr_delete,
+                                    lfdnr_delete'''
       first_upsert = True
       first_rm = True
       added_res = 0
       invalid_res = 0
       rm_res = 0
-      for chunk in pd.read_sql_query(sql_query_cond, db_con_dwh,
-                                     chunksize=self.input_chunk_size):
-        for record in chunk.itertuples():
+      chunks = self._read_sql(sql_query_cond, db_con_dwh, chunksize=self.input_chunk_size)
+      for (chunk, encounter_psns, _), results in self._map_chunks(
+          chunks, new_pseudonymizer, new_mapper_dmdiag2cond, _map_diagnosis_batch,
+          delete_column='falnr_delete'):
+        for record, encounter_psn, icd_condition in zip(chunk.itertuples(),
+                                                        encounter_psns, results):
           if not record.stdat:
             if first_upsert:
               self.logger.info("Create & validate FHIR Condition resources ...")
               first_upsert = False
-            patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.encounter_id)
-            try:
-              new_mapper_dmdiag2cond.read(encounter_psn, patient_psn, record, self.logger)
-              icd_condition = new_mapper_dmdiag2cond.map()
-              icd_condition = icd_condition[0]
-              icd_condition.as_json()
+            if icd_condition is not None:
               new_fhir_bundle.add_resources([icd_condition])
               added_res += 1
-            except FHIRValidationError:
+            else:
               self.logger.debug("Validation error for created Observation resource "
                                f"(id: {encounter_psn}_{record.diagnosis_nr})")
               invalid_res += 1
           else:
             if first_rm:
-              self.logger.info("Create request to remove canceled FHIR Condition resources ...")
+              self.logger.info("Create request to remove canceled FHIR Condition "
+                               "resources ...")
               first_rm = False
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.falnr_delete)
             cond_id = encounter_psn + '_' + str(record.lfdnr_delete)
             new_fhir_bundle.rm_resources('Condition', cond_id)
             rm_res += 1
+          self._progress.done()
+          new_fhir_bundle.end_record()
 
       res_stats = {'valid_con': added_res, 'invalid_con': invalid_res, 'rm_req_con': rm_res}
       if verbose:
@@ -569,10 +736,8 @@ class UMMonFHIR:
                           "resources")
 
       if dest.dtype == 'psql':
-        current_ts = datetime.now()
         new_fhir_bundle.execute(dest)
-        ups_res_con, rm_res_con = umm_db_lib.get_ups_rm_num_fhir('Condition', current_ts,
-                                                                   dest.endpoint)
+        ups_res_con, rm_res_con = new_fhir_bundle.get_ups_rm_num('Condition')
         res_stats_ext = {'ups_con': ups_res_con, 'rm_con': rm_res_con}
         res_stats.update(res_stats_ext)
         if verbose:
@@ -584,12 +749,14 @@ class UMMonFHIR:
 
       return res_stats
 
+  @resumable_stage('procedures')
+  @timed_stage
   def process_procedures(self, period, db_con_dwh, dest, verbose):
-      new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)      
-      new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+      new_pseudonymizer = self._create_pseudonymizer()      
+      new_fhir_bundle = self._create_bundle(dest)
       new_mapper_dmpro2pro_med = mapper_dmpro2pro_med.MapperDMPro2ProMed(self.logger,
                                                                          self.systems,
-                                                                         self.map_table[1])
+                                                                         self._get_drug_lookups())
       self.logger.info("V. Process new/ updated/ canceled procedure records "
                       f"between {period.start} and {period.end} ...")
       sql_query_prod = f'''WITH nicp_extr AS (
@@ -613,7 +780,8 @@ class UMMonFHIR:
                            FULL OUTER JOIN del_prod
                            ON ups_prod.encounter_id = del_prod.falnr_delete::int AND
                               ups_prod.procedure_nr = del_prod.lnric_delete::int
-                           ORDER BY stdat DESC'''
+                           ORDER BY stdat DESC, encounter_id, procedure_nr, falnr_delete,
+                                    lnric_delete'''
       first_upsert = True
       first_rm = True
       added_res_prod = 0
@@ -623,55 +791,44 @@ class UMMonFHIR:
       added_res_medstm = 0
       res_medstm_invalid = 0
       rm_res_prod = 0
-      for chunk in pd.read_sql_query(sql_query_prod, db_con_dwh,
-                                     chunksize=self.input_chunk_size):
-        for record in chunk.itertuples():
+      chunks = self._read_sql(sql_query_prod, db_con_dwh, chunksize=self.input_chunk_size)
+      for (chunk, encounter_psns, _), results in self._map_chunks(
+          chunks, new_pseudonymizer, new_mapper_dmpro2pro_med, _map_procedure_batch,
+          delete_column='falnr_delete'):
+        for record, encounter_psn, result in zip(chunk.itertuples(), encounter_psns,
+                                                 results):
           if not record.stdat:
             if first_upsert:
               self.logger.info("Create & validate FHIR Procedure/ Medication/ "
                                "MedicationStatement resources ...")
               first_upsert = False
-            patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.encounter_id)
-            
-            new_mapper_dmpro2pro_med.read(encounter_psn, patient_psn,
-                                          record.procedure_begin_timestamp,
-                                          record.procedure_end_timestamp, record)
-
-            [procedure, medication,
-             medication_stm] = new_mapper_dmpro2pro_med.map()
-            try:
-              procedure.as_json()
+            [procedure, medication, medication_stm] = result
+            if procedure is not None:
               new_fhir_bundle.add_resources([procedure])
               added_res_prod += 1
-            except FHIRValidationError:
+            else:
               self.logger.debug("Validation error for created Procedure resource "
                                f"(id: {encounter_psn}_{record.procedure_nr})")
               res_prod_invalid += 1
-            try:
-              if medication:
-                medication.as_json()
-                new_fhir_bundle.add_resources([medication])
-                added_res_med += 1
-            except FHIRValidationError:
+            if medication:
+              new_fhir_bundle.add_resources([medication])
+              added_res_med += 1
+            elif medication is None:
               self.logger.debug("Validation error for created Medication resource "
                                f"(id: {encounter_psn}_med)")
               res_med_invalid += 1
-            try:
-              if medication_stm:
-                medication_stm.as_json()
-                new_fhir_bundle.add_resources([medication_stm])
-                added_res_medstm += 1
-            except FHIRValidationError:
-              self.logger.debug("Validation error for created MedicationStatement resource "
-                               f"(id: {encounter_psn}_{record.procedure_nr}_med_stm)")
+            if medication_stm:
+              new_fhir_bundle.add_resources([medication_stm])
+              added_res_medstm += 1
+            elif medication_stm is None:
+              self.logger.debug("Validation error for created MedicationStatement "
+                               f"resource (id: {encounter_psn}_{record.procedure_nr}_med_stm)")
               res_medstm_invalid += 1
           else:
             if first_rm:
-              self.logger.info("Create request to remove canceled FHIR Procedure/ Medication/ "
-                               "MedicationStatement resources ...")
+              self.logger.info("Create request to remove canceled FHIR Procedure/ "
+                               "Medication/ MedicationStatement resources ...")
               first_rm = False
-            encounter_psn = new_pseudonymizer.request_encounter_psn(record.falnr_delete)
             if record.ops_code_delete and record.ops_code_delete[0] == '6':
               med_id = encounter_psn + '_' + str(record.lnric_delete) + '_med_stat'
               new_fhir_bundle.rm_resources('MedicationStatement', med_id)
@@ -679,6 +836,8 @@ class UMMonFHIR:
               prod_id = encounter_psn + '_' + str(record.lnric_delete)
               new_fhir_bundle.rm_resources('Procedure', prod_id)
             rm_res_prod += 1
+          self._progress.done()
+          new_fhir_bundle.end_record()
 
       res_stats = {'valid_prod': added_res_prod, 'invalid_prod': res_prod_invalid,
                    'valid_med': added_res_med, 'invalid_med': res_med_invalid,
@@ -704,14 +863,10 @@ class UMMonFHIR:
         self.logger.info(f"Created {res_stats['rm_req_prod']} requests to delete Procedure/ "
                       "Medication/ MedicationStatement resources")    
       if dest.dtype == 'psql':
-        current_ts = datetime.now()
         new_fhir_bundle.execute(dest)
-        ups_res_prod, rm_res_prod = umm_db_lib.get_ups_rm_num_fhir('Procedure',
-                                                        current_ts, dest.endpoint)
-        ups_res_med, rm_res_med = umm_db_lib.get_ups_rm_num_fhir('Medication',
-                                                       current_ts, dest.endpoint)
-        ups_res_medstm, rm_res_medstm = umm_db_lib.get_ups_rm_num_fhir('MedicationStatement',
-                                                            current_ts, dest.endpoint)
+        ups_res_prod, rm_res_prod = new_fhir_bundle.get_ups_rm_num('Procedure')
+        ups_res_med, rm_res_med = new_fhir_bundle.get_ups_rm_num('Medication')
+        ups_res_medstm, rm_res_medstm = new_fhir_bundle.get_ups_rm_num('MedicationStatement')
         res_stats_ext = {'ups_prod': ups_res_prod, 'rm_prod': rm_res_prod,
                          'ups_med': ups_res_med, 'rm_med': rm_res_med,
                          'ups_medstm': ups_res_medstm, 'rm_medstm': rm_res_medstm}
@@ -729,9 +884,11 @@ class UMMonFHIR:
 
       return res_stats
 
+  @resumable_stage('lufu')
+  @timed_stage
   def process_lufu(self, period, db_con_dwh, dest, verbose):
-    new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)    
-    new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)
+    new_pseudonymizer = self._create_pseudonymizer()    
+    new_fhir_bundle = self._create_bundle(dest)
     new_mapper_lufu_loinc = mapper_lufu_loinc_lookup.MapperLuFu2Loinc(self.logger,
                                                                       self.systems)
     new_mapper_lufu_snomed = mapper_lufu_snomed_lookup.MapperLuFu2Snomed(self.logger,
@@ -740,7 +897,7 @@ class UMMonFHIR:
                                                                            self.systems)
     new_mapper_lufufall2rep = mapper_lufufall2rep.MapperLuFuFall2Rep(self.logger, self.systems)
     new_mapper_lufufall2obs = mapper_lufufall2obs.MapperLuFuFall2Obs(self.logger, self.systems,
-                                                      self.map_table[3], new_mapper_lufu_loinc,
+                                                      self._get_lufu_loinc_mapping(), new_mapper_lufu_loinc,
                                                   new_mapper_lufu_snomed, new_mapper_lufu_i2b2)
     self.logger.info("VI. Process new/ updated lung function (lufu) records "
                     f"between {period.start} and {period.end} ...")
@@ -751,16 +908,17 @@ class UMMonFHIR:
                          WHERE encounter_id::int = dwh_encounter_id AND
                                (sendedatum > '{period.start}' AND sendedatum < '{period.end}') AND
                                untersuchung_status = 'geschlossen'
-                         ORDER BY untersuchung_id'''
+                         ORDER BY untersuchung_id, dwh_encounter_id'''
     added_res_rep = 0
     added_res_obs = 0
     res_rep_invalid = 0
     res_obs_invalid = 0
     self.logger.info("Create & validate FHIR Observation (lufu)/ "
                      "DiagnosticReport resources ...")
-    for chunk in pd.read_sql_query(sql_query_lufu, db_con_dwh,
-                                   chunksize=self.input_chunk_size):
-      for idx, record in chunk.iterrows():
+    for chunk in self._read_sql(sql_query_lufu, db_con_dwh,
+                                chunksize=self.input_chunk_size):
+      lufu_records = new_mapper_lufufall2obs.read_chunk(chunk)
+      for row_idx, record in self._progress.records(enumerate(lufu_records)):
       #for record in chunk.itertuples():
         # create diagnostic report
         patient_psn = new_pseudonymizer.request_patient_psn(record['patient_id'])
@@ -768,11 +926,11 @@ class UMMonFHIR:
         new_mapper_lufufall2rep.read(encounter_psn, patient_psn, record)
         lufu_diagnostic_report = new_mapper_lufufall2rep.map()
         # create lufu observations and return lists with observations for distinct procedures
-        new_mapper_lufufall2obs.read(encounter_psn, patient_psn, record)
+        new_mapper_lufufall2obs.read(encounter_psn, patient_psn, record, row_idx)
         lufu_observation_list = new_mapper_lufufall2obs.map()
 
         try:
-          lufu_diagnostic_report.as_json()
+          self._validate(lufu_diagnostic_report)
 
           if lufu_observation_list:
 
@@ -781,7 +939,7 @@ class UMMonFHIR:
             for obs in lufu_observation_list:
               obs_ref = {"reference": f"Observation/{obs.id}"}
               try:
-                obs.as_json()
+                self._validate(obs)
                 lufu_obs_ref_list.append(fhirreference.FHIRReference(jsondict=obs_ref))
                 added_res_obs += 1
               except FHIRValidationError:
@@ -797,6 +955,7 @@ class UMMonFHIR:
           res_rep_invalid += 1
           self.logger.debug("Validation error for created DiagnosticReport (lufu) resource "
                            f"(id: ??)")
+        new_fhir_bundle.end_record()
     res_stats = {'valid_obs': len(lufu_obs_ref_list), 'invalid_obs': res_obs_invalid,
                  'valid_rep': added_res_rep, 'invalid_rep': res_rep_invalid}
 
@@ -818,12 +977,9 @@ class UMMonFHIR:
       else:
         self.logger.info(f"Detected NO invalid DiagnosticReport (lufu) resources")    
     if dest.dtype == 'psql':
-      current_ts = datetime.now()
       new_fhir_bundle.execute(dest)
-      ups_res_obs, rm_res_obs = umm_db_lib.get_ups_rm_num_fhir('Obs_lufu', current_ts,
-                                                      dest.endpoint)
-      ups_res_rep, rm_res_rep = umm_db_lib.get_ups_rm_num_fhir('DiagnosticReport', current_ts,
-                                                      dest.endpoint)
+      ups_res_obs, rm_res_obs = new_fhir_bundle.get_ups_rm_num('Obs_lufu')
+      ups_res_rep, rm_res_rep = new_fhir_bundle.get_ups_rm_num('DiagnosticReport')
       res_stats_ext = {'ups_obs': ups_res_obs, 'rm_obs': rm_res_obs,
                        'ups_rep': ups_res_rep, 'rm_rep': rm_res_rep}
       res_stats.update(res_stats_ext)
@@ -836,9 +992,11 @@ class UMMonFHIR:
 
     return res_stats
 
+  @resumable_stage('lab_results')
+  @timed_stage
   def process_lab_results(self, period, db_con_dwh, dest, verbose):
-    new_pseudonymizer = pseudonymizer.Pseudonymizer(self.logger, self.psn_url)    
-    new_fhir_bundle = fhir_bundle.FHIRBundle(self.logger)   
+    new_pseudonymizer = self._create_pseudonymizer()    
+    new_fhir_bundle = self._create_bundle(dest)   
     new_mapper_dmlab2obs = mapper_dmlab2obs.MapperDMLab2Obs(self.logger, self.systems,
                                                             self.loinc_url)
     self.logger.info("VII. Process new/ updated lab records "
@@ -847,25 +1005,24 @@ class UMMonFHIR:
                     WHERE (collection_timestamp > '{period.start}' AND
                            collection_timestamp < '{period.end}') AND
                            loinc_code <> 'noLoinc'
-                    ORDER BY encounter_id '''
-    lab_observation_list = []
+                    ORDER BY encounter_id, result_id '''
+    added_res = 0
     res_invalid = 0
     self.logger.info("Create & validate FHIR Observation (laboratory) resources ...")
-    for chunk in pd.read_sql_query(sql_query, db_con_dwh,
-                                   chunksize=1000):
-      for record in chunk.itertuples():      
-        patient_psn = new_pseudonymizer.request_patient_psn(record.patient_id)
-        encounter_psn = new_pseudonymizer.request_encounter_psn(record.encounter_id)
-        new_mapper_dmlab2obs.read(encounter_psn, patient_psn, record)
-        lab_observation = new_mapper_dmlab2obs.map()
-        try:
-          lab_observation.as_json()
-          lab_observation_list.append(lab_observation)
-        except FHIRValidationError:
+    chunks = self._read_sql(sql_query, db_con_dwh, chunksize=1000)
+    for _, results in self._map_chunks(
+        chunks, new_pseudonymizer, new_mapper_dmlab2obs, _map_lab_batch,
+        ['collection_timestamp']):
+      for lab_observation in results:
+        if lab_observation is not None:
+          new_fhir_bundle.add_resources([lab_observation])
+          added_res += 1
+        else:
           res_invalid += 1
+        self._progress.done()
+        new_fhir_bundle.end_record()
 
-    new_fhir_bundle.add_resources(lab_observation_list)
-    res_stats = {'valid_obs': len(lab_observation_list), 'invalid_obs': res_invalid}
+    res_stats = {'valid_obs': added_res, 'invalid_obs': res_invalid}
 
     if verbose:
       self.logger.info("Results:")
@@ -878,10 +1035,8 @@ class UMMonFHIR:
         self.logger.info(f"Detected NO invalid Observation (Laboratory) resources")
 
     if dest.dtype == 'psql':      
-      current_ts = datetime.now()
       new_fhir_bundle.execute(dest)
-      ups_res_obs, rm_res_obs = umm_db_lib.get_ups_rm_num_fhir('Obs_lab', current_ts,
-                                                               dest.endpoint)
+      ups_res_obs, rm_res_obs = new_fhir_bundle.get_ups_rm_num('Obs_lab')
       res_stats_ext = {'ups_obs': ups_res_obs, 'rm_obs': rm_res_obs}
       res_stats.update(res_stats_ext)
       if verbose:
@@ -0,0 +1,5 @@
+--add content hash column to resources_inc
+--the column stores the sha256 hash of the canonical JSON representation of a
+--FHIR resource and is used to skip upserts of unchanged resources; existing
+--rows keep NULL until they are upserted the next time
+ALTER TABLE stg_fhir_dm.resources_inc ADD COLUMN IF NOT EXISTS hash char(64);
@@ -0,0 +1,73 @@
+--optional: convert resources_inc into a table list-partitioned by resource type
+--(PostgreSQL >= 11, apply 001_resources_inc_hash.sql before)
+--Observation is sub-partitioned by hash of fhir_id: the unique constraint
+--(fhir_id, type) used by the upsert (ON CONFLICT) has to contain all partition
+--key columns, which rules out partitioning by meta.source (an expression on
+--data) or by time; a hash spreads the lab, p21 and lufu observations evenly
+--the former table is kept as resources_inc_unpartitioned and can be dropped
+--after verification
+BEGIN;
+
+ALTER TABLE stg_fhir_dm.resources_inc RENAME TO resources_inc_unpartitioned;
+ALTER TABLE stg_fhir_dm.resources_inc_unpartitioned
+  RENAME CONSTRAINT fhir_id_unique TO fhir_id_unique_unpartitioned;
+
+CREATE TABLE stg_fhir_dm.resources_inc
+(
+    id              integer     NOT NULL DEFAULT nextval('stg_fhir_dm.resources_inc_id_seq'),
+    fhir_id         varchar(64) NOT NULL,
+    type            varchar(64) NOT NULL,
+    data            jsonb       NOT NULL,
+    hash            char(64),
+    created_at      timestamp   NOT NULL DEFAULT NOW(),
+    last_updated_at timestamp   NOT NULL DEFAULT NOW(),
+    is_deleted      boolean     NOT NULL DEFAULT FALSE,
+    CONSTRAINT fhir_id_unique UNIQUE (fhir_id, type)
+) PARTITION BY LIST (type);
+
+CREATE TABLE stg_fhir_dm.resources_inc_patient PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Patient');
+CREATE TABLE stg_fhir_dm.resources_inc_encounter PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Encounter');
+CREATE TABLE stg_fhir_dm.resources_inc_location PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Location');
+CREATE TABLE stg_fhir_dm.resources_inc_condition PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Condition');
+CREATE TABLE stg_fhir_dm.resources_inc_procedure PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Procedure');
+CREATE TABLE stg_fhir_dm.resources_inc_medication PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Medication', 'MedicationStatement');
+CREATE TABLE stg_fhir_dm.resources_inc_diagnosticreport PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('DiagnosticReport');
+CREATE TABLE stg_fhir_dm.resources_inc_default PARTITION OF stg_fhir_dm.resources_inc
+  DEFAULT;
+
+CREATE TABLE stg_fhir_dm.resources_inc_observation PARTITION OF stg_fhir_dm.resources_inc
+  FOR VALUES IN ('Observation') PARTITION BY HASH (fhir_id);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_0 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 0);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_1 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 1);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_2 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 2);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_3 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 3);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_4 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 4);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_5 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 5);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_6 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 6);
+CREATE TABLE stg_fhir_dm.resources_inc_observation_7 PARTITION OF stg_fhir_dm.resources_inc_observation
+  FOR VALUES WITH (MODULUS 8, REMAINDER 7);
+
+INSERT INTO stg_fhir_dm.resources_inc
+  SELECT id, fhir_id, type, data, hash, created_at, last_updated_at, is_deleted
+  FROM stg_fhir_dm.resources_inc_unpartitioned;
+
+ALTER SEQUENCE stg_fhir_dm.resources_inc_id_seq OWNED BY stg_fhir_dm.resources_inc.id;
+ALTER TABLE stg_fhir_dm.resources_inc OWNER TO stg_fhir_dm;
+
+COMMIT;
+
+ANALYZE stg_fhir_dm.resources_inc;
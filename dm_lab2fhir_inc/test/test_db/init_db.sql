@@ -190,6 +190,7 @@ CREATE TABLE stg_fhir_dm.resources_inc
     fhir_id         varchar(64) NOT NULL,
     type            varchar(64) NOT NULL,
     data            jsonb       NOT NULL,
+    hash            char(64),
     created_at      timestamp   NOT NULL DEFAULT NOW(),
     last_updated_at timestamp   NOT NULL DEFAULT NOW(),
     is_deleted      boolean     NOT NULL DEFAULT FALSE,
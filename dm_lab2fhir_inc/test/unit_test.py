@@ -6,12 +6,19 @@
    Authors: Lukas Goetz, Lukas.Goetz@medma.uni-heidelberg.de
    Date: 01-04-2021'''
 
-import subprocess, sys, unittest, pandas as pd, re, json
-import pytest, logging, configparser
+import subprocess, sys, unittest, pandas as pd, numpy as np, re, json, os, tempfile, gzip
+import importlib, hashlib, socket, time, urllib.request, gc
+from datetime import datetime
+import pytest, logging, configparser, requests
 from lib import (umm_db_lib, mapper_dmpat2pat, mapper_dmenc2enc, mapper_dmdiag2cond,
-                 mapper_dmpro2pro_med, mapper_dmlab2obs, pseudonymizer, fhir_bundle)
+                 mapper_dmpro2pro_med, mapper_dmlab2obs, mapper_dmenc2obs, mapper_dmtrans2obs,
+                 pseudonymizer, fhir_bundle, fhir_datetime, checkpoint, umm_on_fhir,
+                 lookup_tables, mapping_pool, stage_pipeline, json_codec, hapi_writer,
+                 ndjson_writer, hapi_bulk_writer, sqlite_writer, null_writer, phase_timer,
+                 mapper_lufufall2obs, mapper_lufu_loinc_lookup, mapper_lufu_snomed_lookup,
+                 mapper_lufu_i2b2basecode_lookup)
 from lib.mii_profiles.fhirabstractbase import FHIRValidationError
-from lib.mii_profiles import fhirreference, mii_patient
+from lib.mii_profiles import fhirdate, fhirreference, mii_patient
 
 @pytest.fixture()
 def cfile(pytestconfig):
@@ -165,6 +172,31 @@ def _test_lab_observation_mapper(valid_record, invalid_record, logger, systems):
     logger.error("Actual Result: PASSED")
   logger.info("Actual Result: FAILED")
 
+def _map_to_json(map_func):
+  try:
+    resources = map_func()
+    if not isinstance(resources, list):
+      resources = [resources]
+    return [json.dumps(res.as_json()) if hasattr(res, 'as_json') else res for res in resources]
+  except FHIRValidationError:
+    return 'invalid'
+
+def _test_template_mapper(new_mapper, records, read, logger):
+  logger.info("Step: Positive test FHIR mapping via templates")
+  logger.info(f"Action: Map records with {type(new_mapper).__name__} via the object model and "
+              "via the templates and check if the created resources are identical")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  try:
+    for record in records:
+      read(new_mapper, record)
+      expected = _map_to_json(new_mapper.map)
+      read(new_mapper, record)
+      assert _map_to_json(new_mapper.map_template) == expected
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error("Actual Result: FAILED")
+    raise
+
 def test(cfile):
   logging.basicConfig(level=logging.INFO,
                       format="%(asctime)s [%(levelname)s] %(message)s",
@@ -179,13 +211,16 @@ def test(cfile):
   dischargereason_1_2 = pd.read_csv(config['dat_paths']['dischargereason_1_2'])
   dischargereason_3 = pd.read_csv(config['dat_paths']['dischargereason_3'])
   dep_codes = pd.read_csv(config['dat_paths']['department_codes'])
+  terminology = lookup_tables.TerminologyLookup(admissionreason_1_2, admissionreason_3_4,
+                                                dischargereason_1_2, dischargereason_3,
+                                                dep_codes)
   map_table_set = []
-  map_table_set.append([admissionreason_1_2, admissionreason_3_4,
-                       dischargereason_1_2, dischargereason_3])
+  map_table_set.append(terminology)
   ops_drug_mapping = pd.read_csv(config['dat_paths']['ops_drug_mapping'], sep=';')
   drug_unii_mapping = pd.read_csv(config['dat_paths']['drug_unii_mapping'], sep=';')
-  map_table_set.append([ops_drug_mapping, drug_unii_mapping])
-  map_table_set.append(dep_codes)
+  map_table_set.append([lookup_tables.build_ops_drug_index(ops_drug_mapping),
+                        lookup_tables.build_substance_index(drug_unii_mapping)])
+  map_table_set.append(terminology)
   systems = config['systems']
   psn_url = config['server']['url_gpas']
 
@@ -233,6 +268,101 @@ def test(cfile):
   invalid_record = df.iloc[0]
   invalid_record['collection_timestamp'] = None
   _test_lab_observation_mapper(valid_record, invalid_record, logger, systems)
+  _test_template_mapper(mapper_dmlab2obs.MapperDMLab2Obs(logger, systems, None),
+                        [record for _, record in df.iterrows()] + [invalid_record],
+                        lambda mapper, record: mapper.read('dic-eid-110', 'dic-pid-110', record),
+                        logger)
+
+  df = pd.read_csv("/opt/dm_lab2fhir_inc/test/test_db/test_data/rf_med_cov_encounter.csv")
+  df['admission_timestamp'] = pd.to_datetime(df['admission_timestamp'], utc=True)
+  df['discharge_timestamp'] = pd.to_datetime(df['discharge_timestamp'], utc=True)
+  df['ventilation_hours'] = range(len(df))
+  df['icu_days'] = [days / 3 for days in range(len(df))]
+  df['intercurrent_dialyses'] = range(len(df))
+  read_encounter = lambda mapper, record: mapper.read('dic-eid-110', 'dic-pid-110', record)
+  _test_template_mapper(mapper_dmenc2obs.MapperDMEnc2Obs(logger, systems),
+                        [record for _, record in df.iterrows()], read_encounter, logger)
+  _test_template_mapper(mapper_dmtrans2obs.MapperDMTrans2Obs(logger, systems),
+                        [record for _, record in df.iterrows()], read_encounter, logger)
+
+  df = pd.read_csv("/opt/dm_lab2fhir_inc/test/test_db/test_data/rf_med_cov_diagnosis.csv")
+  df['diagnosis_documentation_timestamp'] = pd.to_datetime(df['diagnosis_documentation_timestamp'],
+                                            utc=True)
+  df['supplementary_icd_code'] = pd.Series(['A01.1!', 'B02*', 'C03!*', None] * len(df),
+                                           dtype=object)[:len(df)]
+  df['diagnosis_laterality'] = pd.Series(['L', 'R', 'B', None] * len(df), dtype=object)[:len(df)]
+  _test_template_mapper(mapper_dmdiag2cond.MapperDMDiag2Cond(logger, systems),
+                        [record for _, record in df.iterrows()],
+                        lambda mapper, record: mapper.read('dic-eid-110', 'dic-pid-110', record,
+                                                           logger),
+                        logger)
+
+
+
+  logger.info("Step: Positive test formatting timestamps as FHIR dateTime")
+  logger.info("Action: Format a timestamp column with missing values at once and per value "
+              "and check if the FHIR dates equal the ones parsed from the formatted strings")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  timestamps = df['diagnosis_documentation_timestamp'].copy()
+  timestamps.iloc[0] = pd.NaT
+  formatted = fhir_datetime.format_datetime_columns(pd.DataFrame({'ts': timestamps}), ['ts'])
+  try:
+    assert formatted['ts'].tolist() == [fhir_datetime.format_datetime(ts) for ts in timestamps]
+    assert formatted['ts'].iloc[0] is None
+    for ts in timestamps.iloc[1:]:
+      fhir_date = fhirdate.FHIRDate.from_datetime(ts)
+      parsed_date = fhirdate.FHIRDate(datetime.strftime(ts, '%Y-%m-%dT%H:%M:%S'))
+      assert (fhir_date.as_json(), fhir_date.date) == (parsed_date.as_json(), parsed_date.date)
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error("Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test mapping lab records in worker processes")
+  logger.info("Action: Map batches of lab records by two worker processes and in the main "
+              "process and check if the same resources are returned in the same order")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  df = pd.read_csv("/opt/dm_lab2fhir_inc/test/test_db/test_data/f_med_lab_result.csv")
+  df['collection_timestamp'] = pd.to_datetime(df['collection_timestamp'], utc=True)
+  fhir_datetime.format_datetime_columns(df, ['collection_timestamp'])
+  batches = [(df.iloc[pos:pos + 3], [f'dic-eid-{pos + 110}'] * len(df.iloc[pos:pos + 3]),
+              [f'dic-pid-{pos + 110}'] * len(df.iloc[pos:pos + 3]))
+             for pos in range(0, len(df), 3)]
+  mapped = []
+  for workers in [2, 0]:
+    with mapping_pool.MappingPool(logger, workers,
+                                  mapper_dmlab2obs.MapperDMLab2Obs(logger, systems, None)) as pool:
+      mapped.append([[res.as_json() if res else None for res in results]
+                     for _, results in pool.map(umm_on_fhir._map_lab_batch, batches)])
+  try:
+    assert mapped[0] == mapped[1]
+    assert sum(len(results) for results in mapped[0]) == len(df)
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error("Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test mapping lab records by the stage pipeline")
+  logger.info("Action: Pseudonymize and map chunks of lab records in the threads of the stage "
+              "pipeline and check if the same resources are returned in the same order as by "
+              "the mapping pool")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  batch_psns = {id(chunk): (encounter_psns, patient_psns)
+                for chunk, encounter_psns, patient_psns in batches}
+  pseudonymize = lambda chunk, executor: (chunk,) + batch_psns[id(chunk)]
+  with mapping_pool.MappingPool(logger, 0,
+                                mapper_dmlab2obs.MapperDMLab2Obs(logger, systems, None)) as pool, \
+       stage_pipeline.StagePipeline(logger, True, queue_size=1) as pipeline:
+    pipelined = [[res.as_json() if res else None for res in results]
+                 for _, results in pipeline.run([chunk for chunk, _, _ in batches], pseudonymize,
+                                                lambda batches: pool.map(
+                                                  umm_on_fhir._map_lab_batch, batches))]
+  try:
+    assert pipelined == mapped[1]
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error("Actual Result: FAILED")
+    raise
 
 
 
@@ -285,6 +415,22 @@ def test(cfile):
   nof_ups, nof_rm = umm_db_lib.get_ups_rm_num_fhir('Patient', '2020-12-01', dest.endpoint)
   try:
     assert nof_ups == 1 and nof_rm == 0
+    assert new_fhir_bundle.get_ups_rm_num('Patient') == (1, 0)
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+
+  logger.info("Step: Positive test skipping unchanged FHIR resource")
+  logger.info("Action: Send unchanged FHIR resource of type Patient to postgreSQL database "
+              "again and check if the stored record was not updated")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  current_ts = datetime.now()
+  new_fhir_bundle.execute(dest)
+  nof_ups, nof_rm = umm_db_lib.get_ups_rm_num_fhir('Patient', current_ts, dest.endpoint)
+  try:
+    assert nof_ups == 0 and nof_rm == 0
     logger.info("Actual Result: PASSED")
   except AssertionError as exc:
     logger.error(f"Actual Result: FAILED")
@@ -305,3 +451,714 @@ def test(cfile):
   except AssertionError as exc:
     logger.error(f"Actual Result: FAILED")
     raise
+
+
+  logger.info("Step: Positive test flushing streaming FHIR bundle")
+  logger.info("Action: Add two records with a FHIR resource of type Patient to a streaming "
+              "FHIR bundle with a maximum of one entry and check if it was flushed twice")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=1)
+  new_streaming_bundle.add_resources([new_patient, new_patient])
+  new_streaming_bundle.end_record()
+  json_obj['id'] = 'dic-pid-111'
+  new_streaming_bundle.add_resources([mii_patient.Patient(json_obj)])
+  new_streaming_bundle.end_record()
+  new_streaming_bundle.execute(dest)
+  try:
+    assert len(new_streaming_bundle.flush_stats) == 2
+    assert [stats['entries'] for stats in new_streaming_bundle.flush_stats] == [1, 1]
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+
+  logger.info("Step: Positive test detecting duplicate FHIR resources")
+  logger.info("Action: Add the same FHIR resource of type Patient to a FHIR bundle in "
+              "two calls and check if only the last one is kept")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_fhir_bundle = fhir_bundle.FHIRBundle(logger, dedup_policy='last')
+  new_fhir_bundle.add_resources([new_patient])
+  json_obj['id'] = 'dic-pid-110'
+  json_obj['gender'] = 'other'
+  new_fhir_bundle.add_resources([mii_patient.Patient(json_obj)])
+  try:
+    assert len(new_fhir_bundle.bundle['entry']) == 1
+    assert new_fhir_bundle.bundle['entry'][0]['resource']['gender'] == 'other'
+    assert new_fhir_bundle.nof_duplicates == 1
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+
+  logger.info("Step: Positive test resuming stage from checkpoint")
+  logger.info("Action: Flush a streaming FHIR bundle while processing three records, "
+              "resume the stage from the stored checkpoint and check if only the records "
+              "not completely flushed before are processed again")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  cp_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+  period = umm_on_fhir.UMMPeriod('2020-12-01', '2020-12-31')
+  new_checkpoint = checkpoint.Checkpoint(logger, cp_path, period)
+  progress = new_checkpoint.start_stage('patients')
+  new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=2,
+                                                         on_flush=progress.on_flush)
+  for record in progress.records(['dic-pid-110', 'dic-pid-111', 'dic-pid-112']):
+    json_obj['id'] = record
+    new_streaming_bundle.add_resources([mii_patient.Patient(json_obj)])
+    new_streaming_bundle.end_record()
+  resumed_checkpoint = checkpoint.Checkpoint(logger, cp_path, period, resume=True)
+  resumed_progress = resumed_checkpoint.start_stage('patients')
+  try:
+    assert list(resumed_progress.records(['dic-pid-110', 'dic-pid-111', 'dic-pid-112'])) == \
+           ['dic-pid-112']
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+class _RecordingWriter:
+  '''Destination recording the bundle entries/ requests for deletion per
+     flush'''
+
+  def __init__(self):
+    self.flushes = []
+    self.canceled = []
+
+  def write(self, entries, entries_json=None):
+    self.flushes.append(([entry['resource'] for entry in entries], entries_json))
+
+  def delete(self, canceled_ids):
+    self.canceled.append({res_type: list(res_ids) for res_type, res_ids in canceled_ids.items()
+                          if res_ids})
+
+def _get_resource(res_type, res_id, **elements):
+  return mapping_pool.MappedResource(res_type, res_id, dict(resourceType=res_type, id=res_id,
+                                                            identifier=[{'value': res_id}],
+                                                            **elements))
+
+def _get_entry(res_type, res_id, **elements):
+  return {"fullurl": f"{res_type}/{res_id}",
+          "resource": _get_resource(res_type, res_id, **elements).as_json(),
+          "request": {"method": "PUT", "url": f"{res_type}/{res_id}"}}
+
+class _StubResponse:
+  def __init__(self, content, status_code=200, headers=None):
+    self.content = content
+    self.status_code = status_code
+    self.headers = headers or {}
+
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      raise requests.exceptions.HTTPError(f"{self.status_code} Error", response=self)
+
+class _StubSession:
+  '''Session of a FHIR server recording the posted bundles; entries of the
+     resources failed_ids fail once, searches are answered by search_results
+     per resource type'''
+
+  def __init__(self, search_results=None, failed_ids=()):
+    self.search_results = search_results or {}
+    self.failed_ids = set(failed_ids)
+    self.bundles = []
+    self.searches = []
+
+  def post(self, url, headers=None, data=None):
+    bundle = json_codec.loads(data if isinstance(data, bytes) else b''.join(data))
+    self.bundles.append(bundle)
+    response_entries = []
+    for entry in bundle['entry']:
+      res_id = entry.get('resource', {}).get('id')
+      status = '409 Conflict' if res_id in self.failed_ids else '200 OK'
+      self.failed_ids.discard(res_id)
+      response_entries.append({"response": {"status": status}})
+    return _StubResponse(json_codec.dumps({"resourceType": "Bundle",
+                                           "type": "batch-response",
+                                           "entry": response_entries}))
+
+  def get(self, url, params=None):
+    res_type = url.rsplit('/', 1)[-1]
+    self.searches.append((res_type, params))
+    return _StubResponse(json_codec.dumps(self.search_results.get(
+      res_type, {"resourceType": "Bundle", "type": "searchset"})))
+
+class _StubImportSession:
+  '''Session of a FHIR server accepting a bulk $import; the NDJSON files of
+     the import parameters are fetched as the FHIR server would do'''
+
+  def __init__(self):
+    self.parameters = None
+    self.files = {}
+
+  def post(self, url, headers=None, data=None):
+    self.parameters = json_codec.loads(data)
+    for param in self.parameters['parameter']:
+      if param['name'] == 'input':
+        file_url = param['part'][1]['valueUri']
+        with urllib.request.urlopen(file_url) as response:
+          self.files[file_url] = response.read()
+    return _StubResponse(b'', 202, {'Content-Location': f"{url}-poll-status/1"})
+
+  def get(self, url, params=None):
+    return _StubResponse(json_codec.dumps({"output": [{"type": "Patient", "count": 2}]}))
+
+def _get_bundle_ids(bundle):
+  return [entry['resource']['id'] for entry in bundle['entry']]
+
+def test_writers(cfile):
+  logging.basicConfig(level=logging.INFO,
+                      format="%(asctime)s [%(levelname)s] %(message)s",
+                      handlers=[logging.FileHandler('debug.log'),
+                                logging.StreamHandler()])
+  logger = logging.getLogger(__name__)
+
+  logger.info("Step: Positive test flushing streaming FHIR bundle at record boundaries")
+  logger.info("Action: Add the resources of two encounter records in separate calls to a "
+              "streaming FHIR bundle with a maximum of one entry and check if the resources "
+              "of a record were sent in the same flush")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  dest = fhir_bundle.FHIRBundle.UMMDestination('ndjson', _RecordingWriter())
+  new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=1)
+  enc_ref = {'reference': 'Encounter/enc-1'}
+  new_streaming_bundle.add_resources([_get_resource('Observation', 'enc-1_vent',
+                                                    encounter=enc_ref)])
+  new_streaming_bundle.add_resources([_get_resource('Encounter', 'enc-1')])
+  new_streaming_bundle.add_resources([_get_resource('Condition', 'enc-1_1',
+                                                    encounter=enc_ref)])
+  new_streaming_bundle.rm_resources('Condition', 'enc-1_2')
+  nof_flushes = len(new_streaming_bundle.flush_stats)
+  new_streaming_bundle.end_record()
+  new_streaming_bundle.add_resources([_get_resource('Encounter', 'enc-2')])
+  new_streaming_bundle.end_record()
+  new_streaming_bundle.execute()
+  try:
+    assert nof_flushes == 0
+    assert [[res['id'] for res in resources] for resources, _ in dest.endpoint.flushes] == \
+           [['enc-1_vent', 'enc-1', 'enc-1_1'], ['enc-2']]
+    assert dest.endpoint.canceled == [{'Condition': ['enc-1_2']}, {}]
+    assert [stats['entries'] for stats in new_streaming_bundle.flush_stats] == [3, 1]
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test detecting duplicates of buffered FHIR resources")
+  logger.info("Action: Add more resources to a record of a streaming FHIR bundle than it "
+              "remembers keys of and duplicates of the first ones, check if the duplicates "
+              "are merged and the keys beyond the maximum are dropped after the flush")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  for dedup_policy in ('first', 'last'):
+    dest = fhir_bundle.FHIRBundle.UMMDestination('ndjson', _RecordingWriter())
+    new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=2,
+                                                           max_seen_ids=2,
+                                                           dedup_policy=dedup_policy)
+    new_streaming_bundle.add_resources([_get_resource('Condition', f"enc-1_{i}")
+                                        for i in range(4)])
+    new_streaming_bundle.add_resources([_get_resource('Condition', 'enc-1_0', note='dup'),
+                                        _get_resource('Condition', 'enc-1_1', note='dup')])
+    new_streaming_bundle.end_record()
+    nof_keys = len(new_streaming_bundle._res_keys)
+    new_streaming_bundle.add_resources([_get_resource('Condition', 'enc-2_1')])
+    new_streaming_bundle.end_record()
+    new_streaming_bundle.execute()
+    try:
+      resources = dest.endpoint.flushes[0][0]
+      assert [res['id'] for res in resources] == [f"enc-1_{i}" for i in range(4)]
+      assert [res.get('note') for res in resources[:2]] == \
+             ([None, None] if dedup_policy == 'first' else ['dup', 'dup'])
+      assert nof_keys == 4
+      assert len(new_streaming_bundle._res_keys) == 2
+      assert new_streaming_bundle.nof_duplicates == 2
+      logger.info("Actual Result: PASSED")
+    except AssertionError as exc:
+      logger.error(f"Actual Result: FAILED")
+      raise
+
+  logger.info("Step: Positive test counting bytes of streaming FHIR bundle")
+  logger.info("Action: Replace a FHIR resource of a streaming FHIR bundle (policy 'last') "
+              "and check if the buffered bytes and the JSON passed to the destination "
+              "match the serialized resources being sent")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  dest = fhir_bundle.FHIRBundle.UMMDestination('ndjson', _RecordingWriter())
+  new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, dedup_policy='last')
+  new_streaming_bundle.add_resources([_get_resource('Patient', 'dic-pid-110',
+                                                    gender='unknown'),
+                                      _get_resource('Patient', 'dic-pid-111')])
+  new_streaming_bundle.add_resources([_get_resource('Patient', 'dic-pid-110', gender='other')])
+  nof_bytes = sum(len(json_codec.dumps(entry['resource']))
+                  for entry in new_streaming_bundle.bundle['entry'])
+  buffer_bytes = new_streaming_bundle._buffer_bytes
+  new_streaming_bundle.execute()
+  try:
+    assert buffer_bytes == nof_bytes
+    resources, entries_json = dest.endpoint.flushes[0]
+    assert resources[0]['gender'] == 'other'
+    assert entries_json == [json_codec.dumps(res) for res in resources]
+    assert new_streaming_bundle.flush_stats[0]['bytes'] == nof_bytes
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test sending FHIR bundle to FHIR server in tiers")
+  logger.info("Action: Send bundle entries to a stubbed FHIR server with a sub-bundle size "
+              "of three and check if patients, shared resources and encounter clusters are "
+              "sent one after another without splitting a cluster")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  enc_ref = {'reference': 'Encounter/enc-1'}
+  entries = [_get_entry('Observation', 'enc-2_vent', encounter={'reference': 'Encounter/enc-2'}),
+             _get_entry('Condition', 'enc-1_1', encounter=enc_ref),
+             _get_entry('Encounter', 'enc-1-sub', partOf=enc_ref),
+             _get_entry('Location', 'loc-1'),
+             _get_entry('Encounter', 'enc-1'),
+             _get_entry('Encounter', 'enc-2'),
+             _get_entry('Patient', 'dic-pid-110')]
+  new_hapi_writer = hapi_writer.HAPIWriter(logger, 'http://fhir/fhir', bundle_size=3,
+                                           max_workers=1)
+  session = _StubSession()
+  new_hapi_writer.get_session = lambda: session
+  new_hapi_writer.write(entries)
+  try:
+    assert [_get_bundle_ids(bundle) for bundle in session.bundles] == \
+           [['dic-pid-110'], ['loc-1'], ['enc-2', 'enc-2_vent'],
+            ['enc-1', 'enc-1-sub', 'enc-1_1']]
+    assert hapi_writer.get_cluster_key(entries[2]['resource']) == 'Encounter/enc-1'
+    assert hapi_writer.get_cluster_key(entries[0]['resource']) == 'Encounter/enc-2'
+    assert hapi_writer.get_cluster_key(entries[3]['resource']) == 'Location/loc-1'
+    assert new_hapi_writer.stats['entries'] == 7 and new_hapi_writer.stats['bundles'] == 4
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test resending failed entries of batch bundle")
+  logger.info("Action: Send a batch bundle to a stubbed FHIR server failing one entry and "
+              "check if only the failed entry is sent again")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_hapi_writer = hapi_writer.HAPIWriter(logger, 'http://fhir/fhir', max_workers=1,
+                                           bundle_type='batch')
+  session = _StubSession(failed_ids=['dic-pid-111'])
+  new_hapi_writer.get_session = lambda: session
+  entries = [_get_entry('Patient', 'dic-pid-110'), _get_entry('Patient', 'dic-pid-111')]
+  failed_entries = hapi_writer.get_failed_batch_entries(
+    entries, {"entry": [{"response": {"status": "201 Created"}},
+                        {"response": {"status": "409 Conflict"}}]})
+  new_hapi_writer.write(entries)
+  try:
+    assert failed_entries == [entries[1]]
+    assert [_get_bundle_ids(bundle) for bundle in session.bundles] == \
+           [['dic-pid-110', 'dic-pid-111'], ['dic-pid-111']]
+    assert new_hapi_writer.stats['retries'] == 1 and new_hapi_writer.stats['failed'] == 0
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test building PUT bundle entries")
+  logger.info("Action: Add a FHIR resource to FHIR bundles with entry mode 'put' and "
+              "'conditional' and check the requests of the bundle entries")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  put_bundle = fhir_bundle.FHIRBundle(logger, entry_mode='put')
+  put_bundle.add_resources([_get_resource('Patient', 'dic-pid-110')])
+  conditional_bundle = fhir_bundle.FHIRBundle(logger)
+  res = _get_resource('Patient', 'dic-pid-110')
+  res.as_json()['identifier'][0]['system'] = 'https://fhir.example.org/pid'
+  conditional_bundle.add_resources([res])
+  try:
+    assert put_bundle.bundle['entry'][0]['request'] == \
+           {"method": "PUT", "url": "Patient/dic-pid-110"}
+    assert conditional_bundle.bundle['entry'][0]['request'] == \
+           {"method": "POST", "url": "Patient",
+            "ifNoneExist": "identifier=https://fhir.example.org/pid|dic-pid-110"}
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test compressing FHIR bundle")
+  logger.info("Action: Serialize a FHIR bundle gzip compressed in small chunks, decompress "
+              "it and check if the bundle is unchanged")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  bundle = {"resourceType": "Bundle", "type": "transaction",
+            "entry": [_get_entry('Patient', os.urandom(16).hex()) for _ in range(2000)]}
+  gzip_chunks = list(hapi_writer.iter_gzip_bundle(bundle, chunk_size=256))
+  try:
+    assert len(gzip_chunks) > 1
+    assert json_codec.loads(gzip.decompress(b''.join(gzip_chunks))) == bundle
+    assert json_codec.loads(b''.join(hapi_writer.iter_bundle_json(bundle))) == bundle
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test deleting canceled FHIR resources from FHIR server")
+  logger.info("Action: Delete a canceled encounter from a stubbed FHIR server and check if "
+              "the references to it are replaced by 'UNKNOWN' before it is deleted")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  enc_ref = {'reference': 'Encounter/enc-1'}
+  search_results = {
+    res_type: {"resourceType": "Bundle", "type": "searchset",
+               "entry": [{"resource": _get_resource(res_type, res_id, **elements).as_json()}]}
+    for res_type, res_id, elements in (('Encounter', 'enc-1-sub', {'partOf': enc_ref}),
+                                       ('Condition', 'enc-1_1', {'encounter': enc_ref}),
+                                       ('Observation', 'enc-1_vent', {'encounter': enc_ref}))}
+  new_hapi_writer = hapi_writer.HAPIWriter(logger, 'http://fhir/fhir', max_workers=1)
+  session = _StubSession(search_results)
+  new_hapi_writer.get_session = lambda: session
+  new_hapi_writer.delete({'Patient': [], 'Encounter': ['enc-1']})
+  try:
+    assert [res_type for res_type, _ in session.searches] == \
+           ['Encounter', 'Condition', 'Procedure', 'Observation', 'MedicationStatement']
+    assert session.searches[0][1]['part-of'] == 'Encounter/enc-1'
+    assert [[(entry['request']['method'], entry['request']['url']) for entry in bundle['entry']]
+            for bundle in session.bundles] == \
+           [[('PATCH', 'Encounter/enc-1-sub'), ('PATCH', 'Condition/enc-1_1'),
+             ('PATCH', 'Observation/enc-1_vent')], [('DELETE', 'Encounter/enc-1')]]
+    assert session.bundles[0]['entry'][1]['resource']['parameter'][0]['part'] == \
+           [{"name": "type", "valueCode": "replace"},
+            {"name": "path", "valueString": "Condition.encounter"},
+            {"name": "value", "valueReference": {"display": "UNKNOWN"}}]
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test serializing numpy values")
+  logger.info("Action: Serialize a FHIR resource with numpy values with the orjson and json "
+              "backend and check if the JSON of both backends is identical")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  resource = _get_resource('Observation', 'lab-1', valueQuantity={
+    'value': np.float64(5.25), 'comparator': np.str_('<')},
+    component=[{'valueInteger': np.int64(3)}, {'valueBoolean': np.bool_(True)}]).as_json()
+  expected = {**resource, 'valueQuantity': {'value': 5.25, 'comparator': '<'},
+              'component': [{'valueInteger': 3}, {'valueBoolean': True}]}
+  resources_json = {}
+  orjson_module = sys.modules.get('orjson')
+  try:
+    for backend in ('orjson', 'json'):
+      if backend == 'json':
+        sys.modules['orjson'] = None
+      importlib.reload(json_codec)
+      resources_json[json_codec.BACKEND] = (json_codec.dumps(resource),
+                                            json_codec.dumps_canonical(resource))
+  finally:
+    if orjson_module is not None:
+      sys.modules['orjson'] = orjson_module
+    else:
+      sys.modules.pop('orjson', None)
+    importlib.reload(json_codec)
+  try:
+    if 'orjson' in resources_json:
+      assert resources_json['orjson'] == resources_json['json']
+    assert json_codec.loads(resources_json['json'][0]) == expected
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test writing rotated NDJSON files")
+  logger.info("Action: Write FHIR resources to NDJSON files limited to one resource each "
+              "and check the written parts and the counts and hashes of the manifest")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  outdir = tempfile.mkdtemp()
+  new_ndjson_writer = ndjson_writer.NDJSONWriter(logger, outdir, max_file_bytes=100)
+  new_ndjson_writer.write([_get_entry('Patient', f"dic-pid-{i}") for i in range(110, 113)])
+  new_ndjson_writer.write([_get_entry('Location', 'loc-1')])
+  new_ndjson_writer.delete({'Patient': [], 'Encounter': ['enc-1']})
+  manifest = new_ndjson_writer.close()
+  try:
+    assert [(part['type'], part['url'], part['count']) for part in manifest['output']] == \
+           [('Patient', 'Patient.ndjson', 1), ('Patient', 'Patient.1.ndjson', 1),
+            ('Patient', 'Patient.2.ndjson', 1), ('Location', 'Location.ndjson', 1)]
+    assert [(part['url'], part['count']) for part in manifest['deleted']] == \
+           [('deleted.ndjson', 1)]
+    for part in manifest['output'] + manifest['deleted']:
+      with open(os.path.join(outdir, part['url']), 'rb') as file:
+        content = file.read()
+      assert part['sha256'] == hashlib.sha256(content).hexdigest()
+      assert part['bytes'] == len(content)
+    with open(os.path.join(outdir, 'Patient.1.ndjson'), 'rb') as file:
+      assert json_codec.loads(file.readline())['id'] == 'dic-pid-111'
+    with open(os.path.join(outdir, ndjson_writer.MANIFEST_FILE), 'rb') as file:
+      assert json_codec.loads(file.read()) == manifest
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test bulk import into FHIR server")
+  logger.info("Action: Import NDJSON files served by the local HTTP server into a stubbed "
+              "FHIR server and check the import parameters and the served files")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    serve_port = sock.getsockname()[1]
+  outdir = tempfile.mkdtemp()
+  new_hapi_writer = hapi_writer.HAPIWriter(logger, 'http://fhir/fhir')
+  session = _StubImportSession()
+  new_hapi_writer.get_session = lambda: session
+  base_url = f"http://127.0.0.1:{serve_port}/"
+  new_bulk_writer = hapi_bulk_writer.HAPIBulkWriter(
+    logger, ndjson_writer.NDJSONWriter(logger, outdir), new_hapi_writer, base_url, serve_port,
+    poll_interval=0)
+  new_bulk_writer.write([_get_entry('Patient', 'dic-pid-110'),
+                         _get_entry('Patient', 'dic-pid-111')])
+  new_bulk_writer.close()
+  try:
+    parameters = {param['name']: param for param in session.parameters['parameter']}
+    assert parameters['inputSource']['valueUri'] == base_url.rstrip('/')
+    assert parameters['storageDetail']['part'] == [{"name": "type", "valueCode": "http"}]
+    assert parameters['input']['part'] == \
+           [{"name": "type", "valueCode": "Patient"},
+            {"name": "url", "valueUri": f"{base_url}Patient.ndjson"}]
+    with open(os.path.join(outdir, 'Patient.ndjson'), 'rb') as file:
+      assert session.files == {f"{base_url}Patient.ndjson": file.read()}
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test storing FHIR resources in SQLite DB")
+  logger.info("Action: Upsert FHIR resources into a SQLite DB, cancel the encounter and "
+              "check the stored resources and the rewritten reference")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_sqlite_writer = sqlite_writer.SQLiteWriter(logger,
+                                                 os.path.join(tempfile.mkdtemp(), 'fhir.db'))
+  enc_ref = {'reference': 'Encounter/enc-1'}
+  new_sqlite_writer.write([_get_entry('Encounter', 'enc-1', status='in-progress'),
+                           _get_entry('Condition', 'enc-1_1', encounter=enc_ref)])
+  new_sqlite_writer.write([_get_entry('Encounter', 'enc-1', status='finished')])
+  new_sqlite_writer.delete({'Patient': [], 'Encounter': ['enc-1']})
+  rows = {res_type: (json_codec.loads(data), res_hash, is_deleted)
+          for res_type, data, res_hash, is_deleted in new_sqlite_writer.con.execute(
+            'SELECT type, data, hash, is_deleted FROM resources_inc')}
+  new_sqlite_writer.close()
+  try:
+    assert rows['Encounter'][0]['status'] == 'finished' and rows['Encounter'][2] == 1
+    assert rows['Condition'][0]['encounter'] == {'reference': 'UNKNOWN'}
+    assert rows['Condition'][1] is None and rows['Condition'][2] == 0
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test dry run")
+  logger.info("Action: Send FHIR resources and requests for deletion to the null writer and "
+              "check the counted resources and bytes")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_null_writer = null_writer.NullWriter(logger)
+  entries = [_get_entry('Patient', 'dic-pid-110'), _get_entry('Patient', 'dic-pid-111')]
+  new_null_writer.write(entries)
+  entries = [_get_entry('Location', 'loc-1')]
+  new_null_writer.write(entries, [json_codec.dumps(entries[0]['resource'])])
+  new_null_writer.delete({'Patient': [], 'Encounter': ['enc-1', 'enc-2']})
+  new_null_writer.close()
+  try:
+    assert new_null_writer.stats == {
+      'Patient': {'resources': 2,
+                  'bytes': len(json_codec.dumps(_get_entry('Patient', 'dic-pid-110')['resource']))
+                           * 2},
+      'Location': {'resources': 1, 'bytes': len(json_codec.dumps(entries[0]['resource']))}}
+    assert new_null_writer.canceled == {'Patient': 0, 'Encounter': 2}
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test timing nested phases")
+  logger.info("Action: Time a load phase nested in a map phase and check if the time of the "
+              "load phase is not counted for the map phase")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  new_timer = phase_timer.PhaseTimer()
+  with new_timer.phase('map'):
+    time.sleep(0.02)
+    with new_timer.phase('load'):
+      time.sleep(0.2)
+    time.sleep(0.02)
+  new_timer.report(logger)
+  try:
+    assert new_timer.calls == {'map': 1, 'load': 1}
+    assert new_timer.durations['load'] >= 0.2
+    assert 0.04 <= new_timer.durations['map'] < 0.2
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test resuming stage into NDJSON files")
+  logger.info("Action: Abort a stage after a bundle was written to NDJSON files but before "
+              "the checkpoint was saved, resume it and check if the files hold every "
+              "resource exactly once")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  period = umm_on_fhir.UMMPeriod('2020-12-01', '2020-12-31')
+  for compress in (False, True):
+    outdir = tempfile.mkdtemp()
+    cp_path = os.path.join(outdir, 'checkpoint.json')
+    for resume in (False, True):
+      new_checkpoint = checkpoint.Checkpoint(logger, cp_path, period, resume)
+      new_ndjson_writer = ndjson_writer.NDJSONWriter(logger, outdir, compress,
+                                                     state=new_checkpoint.writer_state)
+      new_checkpoint.attach_writer(new_ndjson_writer)
+      dest = fhir_bundle.FHIRBundle.UMMDestination('ndjson', new_ndjson_writer)
+      if not new_checkpoint.is_completed('patients'):
+        progress = new_checkpoint.start_stage('patients')
+        new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=2,
+                                                               on_flush=progress.on_flush)
+        for record in progress.records(['dic-pid-110', 'dic-pid-111', 'dic-pid-112']):
+          new_streaming_bundle.add_resources([_get_resource('Patient', record)])
+          new_streaming_bundle.end_record()
+        new_streaming_bundle.execute()
+        new_checkpoint.complete_stage('patients')
+      progress = new_checkpoint.start_stage('encounters')
+      new_streaming_bundle = fhir_bundle.StreamingFHIRBundle(logger, dest, max_entries=2,
+                                                             on_flush=progress.on_flush)
+      try:
+        for record in progress.records([f"enc-{i}" for i in range(5)]):
+          new_streaming_bundle.add_resources([_get_resource('Encounter', record)])
+          if not resume and record == 'enc-3':
+            # abort after the second bundle was written, before the checkpoint is saved
+            new_streaming_bundle.on_flush = None
+            new_streaming_bundle.end_record()
+            raise KeyboardInterrupt
+          new_streaming_bundle.end_record()
+        new_streaming_bundle.execute()
+        new_checkpoint.complete_stage('encounters')
+        manifest = new_ndjson_writer.close()
+      except KeyboardInterrupt:
+        # open files are flushed when the aborted job releases them
+        del new_checkpoint, progress, new_ndjson_writer, dest, new_streaming_bundle
+        gc.collect()
+    file_ids = {}
+    for part in manifest['output']:
+      with new_ndjson_writer.open(os.path.join(outdir, part['url'])) as file:
+        file_ids[part['type']] = [json_codec.loads(line)['id'] for line in file]
+    try:
+      assert file_ids == {'Patient': ['dic-pid-110', 'dic-pid-111', 'dic-pid-112'],
+                          'Encounter': [f"enc-{i}" for i in range(5)]}
+      assert [part['count'] for part in manifest['output']] == [3, 5]
+      logger.info("Actual Result: PASSED")
+    except AssertionError as exc:
+      logger.error(f"Actual Result: FAILED")
+      raise
+
+  logger.info("Step: Positive test resuming NDJSON files synced without new lines")
+  logger.info("Action: Resume NDJSON files twice from states synced before further lines and "
+              "a rotation were written, sync them again without writing and check the synced "
+              "sizes and the resources of the files")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  patients = [_get_entry('Patient', f"pat-{i}") for i in range(5)]
+  line_bytes = len(json_codec.dumps(patients[0]['resource'])) + 1
+  for compress in (False, True):
+    outdir = tempfile.mkdtemp()
+    file_name = 'Patient.ndjson.gz' if compress else 'Patient.ndjson'
+    states = []
+    new_ndjson_writer = ndjson_writer.NDJSONWriter(logger, outdir, compress, 2 * line_bytes)
+    try:
+      for written, unsynced in ((patients[:1], patients[1:3]), (patients[3:4], patients[4:])):
+        new_ndjson_writer.write(written)
+        states.append(new_ndjson_writer.sync())
+        # lines and a rotation written after the checkpoint, then aborted
+        new_ndjson_writer.write(unsynced)
+        del new_ndjson_writer
+        gc.collect()
+        new_ndjson_writer = ndjson_writer.NDJSONWriter(logger, outdir, compress, 2 * line_bytes,
+                                                       state=states[-1])
+        assert new_ndjson_writer.sync() == states[-1]
+        assert new_ndjson_writer.sync() == states[-1]
+        assert os.path.getsize(os.path.join(outdir, file_name)) == \
+               states[-1]['files']['Patient']['size']
+      manifest = new_ndjson_writer.close()
+      with new_ndjson_writer.open(os.path.join(outdir, file_name)) as file:
+        file_ids = [json_codec.loads(line)['id'] for line in file]
+      assert file_ids == ['pat-0', 'pat-3']
+      assert [part['url'] for part in manifest['output']] == [file_name]
+      assert sorted(os.listdir(outdir)) == sorted([file_name, ndjson_writer.MANIFEST_FILE])
+      logger.info("Actual Result: PASSED")
+    except AssertionError as exc:
+      logger.error(f"Actual Result: FAILED")
+      raise
+
+def test_lufu_mapper(cfile):
+  logging.basicConfig(level=logging.INFO,
+                      format="%(asctime)s [%(levelname)s] %(message)s",
+                      handlers=[logging.FileHandler('debug.log'),
+                                logging.StreamHandler()])
+  logger = logging.getLogger(__name__)
+  config = configparser.ConfigParser()
+  config.read(cfile)
+  systems = config['systems']
+  lufu_loinc_mapping = pd.read_csv(config['dat_paths']['lufu_loinc_mapping'], encoding='utf-8')
+  new_mapper_lufufall2obs = mapper_lufufall2obs.MapperLuFuFall2Obs(
+    logger, systems, lufu_loinc_mapping, mapper_lufu_loinc_lookup.MapperLuFu2Loinc(logger, systems),
+    mapper_lufu_snomed_lookup.MapperLuFu2Snomed(logger, systems),
+    mapper_lufu_i2b2basecode_lookup.MapperLuFu2i2b2(logger, systems))
+  chunk = pd.read_csv("/opt/dm_lab2fhir_inc/test/test_db/test_data/f_med_din_lungenfunktion.csv")
+  # created by the former mapper; missing target values are kept as NaN
+  with open("/opt/dm_lab2fhir_inc/test/test_db/test_data/lufu_observations.json") as file:
+    expected = json.load(file)
+
+  logger.info("Step: Positive test lufu observation FHIR mapping")
+  logger.info("Action: Map lufu records chunk-wise and compare the created resources (ids "
+              "included) with the resources created record by record by the former mapper")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  # effectiveDateTime is converted to the local time zone
+  local_tz = os.environ.get('TZ')
+  os.environ['TZ'] = 'UTC'
+  time.tzset()
+  try:
+    lufu_observations = []
+    for row_idx, record in enumerate(new_mapper_lufufall2obs.read_chunk(chunk)):
+      new_mapper_lufufall2obs.read(f"enc-{row_idx}", f"pat-{row_idx}", record, row_idx)
+      lufu_observations.append([obs.as_json() for obs in new_mapper_lufufall2obs.map()])
+  finally:
+    if local_tz is None:
+      os.environ.pop('TZ')
+    else:
+      os.environ['TZ'] = local_tz
+    time.tzset()
+  concat_string = ''.join(str(value) for column, value in chunk.iloc[0].items()
+                          if column != 'quelldatenjahr')
+  try:
+    assert json.dumps(lufu_observations) == json.dumps(expected)
+    assert lufu_observations[0][0]['id'] == \
+           hashlib.sha256((concat_string + 'B_PRE').encode('utf-8')).hexdigest()
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Positive test lufu observation FHIR mapping of unknown procedure")
+  logger.info("Action: Map lufu values of a procedure without SNOMED code and check if the "
+              "code of the former lookup is used")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  lufu_observation = mapper_lufufall2obs.mapLufuItems2Obs(new_mapper_lufufall2obs, 'FE_',
+                                                         ['TRA_bp_dlcosb_actual'])
+  try:
+    assert lufu_observation.as_json()['code']['coding'][0]['code'] == 'No Text'
+    assert lufu_observation.as_json()['code']['coding'][0]['display'] == \
+           'No Code-Display Value'
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise
+
+  logger.info("Step: Negative test modifying constant FHIR elements of a resource")
+  logger.info("Action: Modify the meta source and category coding of a lufu observation and "
+              "check if it is refused and the next observation is unchanged")
+  logger.info("Expected Result: Return value should be 'PASSED'")
+  records = list(new_mapper_lufufall2obs.read_chunk(chunk))
+  new_mapper_lufufall2obs.read("enc-0", "pat-0", records[0], 0)
+  lufu_observation = new_mapper_lufufall2obs.map()[0].as_json()
+  try:
+    with pytest.raises(TypeError):
+      lufu_observation['meta']['source'] = '#modified'
+    with pytest.raises(TypeError):
+      lufu_observation['category'][0]['coding'].append({'code': 'modified'})
+    new_mapper_lufufall2obs.read("enc-1", "pat-1", records[1], 1)
+    lufu_observation = new_mapper_lufufall2obs.map()[0].as_json()
+    assert lufu_observation['meta'] == {'source': '#lufu-cwd'}
+    assert json.dumps(lufu_observation['category']) == json.dumps(expected[1][0]['category'])
+    logger.info("Actual Result: PASSED")
+  except AssertionError as exc:
+    logger.error(f"Actual Result: FAILED")
+    raise